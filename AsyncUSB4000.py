@@ -0,0 +1,166 @@
+#!/usr/bin/env python -w
+# -*- coding: UTF-8 -*-
+
+# asyncio front end for OceanOptics.USB4000 (needs python 3.7 or newer).
+#
+# Every spectrometer gets one worker thread for its blocking USB transfers,
+# so commands to one device never interleave while any number of devices
+# share a single event loop. The integration time is waited out with
+# asyncio.sleep on the loop instead of polling the device every 10 ms.
+#
+#   async def main():
+#           spec = await AsyncUSB4000.open()
+#           await spec.setIntegrationTime(100000)
+#           counts = await spec.getSpectrum(timeout = 1.0)
+#           async for frame in spec.iterFrames(10):
+#                   print (frame.counts.max())
+
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from OceanOptics import USB4000, TransferError
+
+#: seconds added to the default timeout for the hops to the worker thread
+ACQUIRE_MARGIN = 1.0
+
+
+class AsyncUSB4000:
+    """Coroutine based access to a USB4000.
+
+    The methods mirror USB4000 (getSpectrum, getFrame, setIntegrationTime,
+    getIntegrationTime, iterFrames). The timeout of an acquisition runs from
+    the moment it gets the device, so waiting for another coroutine that
+    uses the device does not count; by default it is ACQUIRE_MARGIN seconds
+    more than the 2.1 x the integration time USB4000.getFrame waits.
+    Timeouts raise asyncio.TimeoutError and every call can be cancelled; a
+    frame that was requested but not read because of a cancellation is
+    thrown away before the next acquisition.
+    """
+
+    def __init__(self, spec, executor = None):
+        self.spec = spec
+        self._ownExecutor = executor == None
+        if executor == None:
+                executor = ThreadPoolExecutor(1)
+        self._executor = executor
+        self._lock     = None
+        self._stale    = False
+
+    @classmethod
+    async def open(cls, *args, **kwargs):
+        """Create the USB4000 (same arguments) without blocking the loop."""
+        executor = ThreadPoolExecutor(1)
+        loop = asyncio.get_running_loop()
+        spec = await loop.run_in_executor(executor, functools.partial(USB4000, *args, **kwargs))
+        self = cls(spec, executor)
+        self._ownExecutor = True
+        return self
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    def _deviceLock(self):
+        # created lazily so it belongs to the running loop
+        if self._lock == None:
+                self._lock = asyncio.Lock()
+        return self._lock
+
+    async def getFrame(self, timeout = None, copy = True):
+        """Acquire one frame as SpectrumFrame (see USB4000.getFrame)."""
+        if timeout == None:
+                timeout = self.spec.integrationTime / 1000000.0 * 2.1 + ACQUIRE_MARGIN
+        return await self._acquire(timeout, copy)
+
+    async def getSpectrum(self, timeout = None, copy = True):
+        """Acquire one spectrum (see USB4000.getSpectrum)."""
+        copyRaw = copy and self.spec.correction == None
+        frame = await self.getFrame(timeout, copyRaw)
+        if frame == None:
+                return None
+        if self.spec.correction != None:
+                return self.spec.correction(frame.counts, copy = copy)
+        return frame.counts
+
+    async def _acquire(self, timeout, copy):
+        if self.spec.usedInterface not in ('pyusb', 'kernel'):
+                return None
+        async with self._deviceLock():
+                if self._stale:
+                        await self._run(self._drain)
+                return await asyncio.wait_for(self._requestAndRead(timeout, copy), timeout)
+
+    async def _requestAndRead(self, timeout, copy):
+        # one frame, the caller holds the device lock
+
+        # stale from here on: a cancellation while the request is in
+        # the worker thread still leaves a frame on the device
+        self._stale = True
+        startT = await self._run(self.spec._requestFrame)
+        # the frame cannot be there before the integration is over
+        remaining = startT + self.spec.integrationTime / 1000000.0 - time.time()
+        if remaining > 0:
+                await asyncio.sleep(remaining)
+        # once submitted the read finishes in the worker thread even
+        # if we get cancelled, so the frame does not go stale
+        self._stale = False
+        try:
+                return await self._run(self.spec._readFrame, startT, timeout, copy)
+        except TransferError:
+                if time.time() - startT > timeout:
+                        raise asyncio.TimeoutError()
+                raise
+
+    def _drain(self):
+        # read the frame left over from a cancelled acquisition
+        try:
+                self.spec._readFrame(time.time(), self.spec.integrationTime / 1000000.0 * 2.1, False)
+        except IOError:
+                pass
+        self._stale = False
+
+    async def setIntegrationTime(self, intTime, test = True, timeout = 1.0):
+        """Set the integration time; with test it is read back until it matches."""
+        async with self._deviceLock():
+                if not await self._run(self.spec.setIntegrationTime, intTime, False):
+                        return False
+                if not test:
+                        return True
+                deadline = time.time() + timeout
+                while True:
+                        devIT = await self._run(self.spec.getIntegrationTime)
+                        if devIT == intTime:
+                                # what USB4000.setIntegrationTime remembers after its own readback
+                                self.spec._confirmedIntTime = intTime
+                                return True
+                        if time.time() > deadline:
+                                return False
+                        await asyncio.sleep(0.001)
+
+    async def getIntegrationTime(self):
+        async with self._deviceLock():
+                return await self._run(self.spec.getIntegrationTime)
+
+    async def iterFrames(self, count = None, timeout = None, copy = True):
+        """Asynchronously yield count frames (forever if None)."""
+        n = 0
+        while count == None or n < count:
+                yield await self.getFrame(timeout, copy)
+                n += 1
+
+    def close(self):
+        if self._ownExecutor:
+                self._executor.shutdown(wait = False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+
+async def gatherSpectra(specs, timeout = None):
+    """Acquire one spectrum from each AsyncUSB4000 at the same time."""
+    return await asyncio.gather(*[spec.getSpectrum(timeout) for spec in specs])
@@ -20,283 +20,1207 @@ import re
 import time
 import sys
 import numpy as np
-import multiprocessing
-import ctypes
-
-sys.path.append('/home/carsten/Programme/python/FiaSia')
-sys.path.append('/home/carsten/Programme/python')
-
-from findUSBserialDevice import getDeviceFileFromAddress, testAddress
-
-import usb.core, usb.util
+import array
+import bisect
+import io
+import json
+import select
+import threading
+import importlib
+import warnings
+try:
+        import queue
+except ImportError:
+        import Queue as queue
+from collections import namedtuple
+
+# The USB libraries (pyusb, findUSBserialDevice for the kernel driver) are
+# only imported by the transport that needs them, see TRANSPORTS.
 
 USB_USBSPEC_VENDOR_ID = 0x2457
 USB_USBSPEC_PRODUCT_ID_USB4000 = 0x1022
 USB_USBSPEC_PRODUCT_ID_USB650 = 0x1014   # not working, kept for future use
 PIXEL_COUNT_USB4000 = 3840
 
+# A USB4000 frame is 15 packets of 512 bytes: the first four are delivered on
+# ep6, the remaining eleven on ep2, followed by a single sync byte on ep2.
+USB4000_PACKET_SIZE   = 512
+USB4000_EP6_PACKETS   = 4
+USB4000_EP2_PACKETS   = 11
+USB4000_FRAME_BYTES   = USB4000_PACKET_SIZE * (USB4000_EP6_PACKETS + USB4000_EP2_PACKETS)
+#: Every pixel is a little-endian unsigned 16 bit number.
+FRAME_DTYPE = np.dtype('<u2')
+
+
+class TransferError(IOError):
+    """A transfer to or from the spectrometer failed or timed out.
+
+    The errors of the transports themselves (usb.core.USBError, the OSError
+    of the kernel device) are IOErrors as well, so catching IOError covers
+    every transport.
+    """
+
+
+class SpectrumFrame(namedtuple('SpectrumFrame', 'counts status counter activePixels startIndex endIndex pixelCount')):
+    """One decoded frame: the raw uint16 counts plus the header fields
+    described in USB4000.getSpectrum (status word, counter, active pixels,
+    start index, end index and total amount of pixels).
+    """
+    __slots__ = ()
+
+    @property
+    def spectrumStart(self):
+        # see USB4000.getSpectrum for the reasoning behind this formula
+        return self.startIndex + (self.pixelCount - self.activePixels) // 2
+
+    @property
+    def darkPixels(self):
+        # the masked pixels from the start index up to the spectrum
+        return slice(self.startIndex, self.spectrumStart)
+
+    @property
+    def window(self):
+        # the active pixels
+        return slice(self.spectrumStart, self.spectrumStart + self.activePixels)
+
+
+#: words of the frame header in front of the pixels, see SpectrumFrame
+FRAME_HEADER_WORDS = 6
+
+
+def decodeFrame(raw, copy = False):
+    """Interpret USB4000_FRAME_BYTES of raw data as a SpectrumFrame.
+
+    raw may be anything supporting the buffer protocol (bytes, bytearray,
+    array.array, numpy array). With copy=False the counts are a view into raw,
+    so no pixel data is touched at all.
+    """
+    counts = np.frombuffer(raw, dtype = FRAME_DTYPE, count = PIXEL_COUNT_USB4000)
+    if copy:
+            counts = counts.copy()
+    return SpectrumFrame(counts, *counts[:FRAME_HEADER_WORDS].tolist())
+
+
+def frameLayout(counts):
+    """(darkPixels, window) of raw frames, taken from the header of one of
+    them: slices of the masked pixels in front of the spectrum and of the
+    active pixels. Raises ValueError if the header does not describe the
+    frame (e.g. all zero because the device was not ready).
+    """
+    counts = np.asarray(counts)
+    if counts.dtype != FRAME_DTYPE or counts.shape != (PIXEL_COUNT_USB4000,):
+            raise ValueError("only raw frames of %d uint16 counts have a header" % (PIXEL_COUNT_USB4000))
+    frame = decodeFrame(counts)
+    if not (FRAME_HEADER_WORDS <= frame.startIndex < frame.spectrumStart and frame.activePixels > 0
+            and frame.spectrumStart + frame.activePixels <= PIXEL_COUNT_USB4000):
+            raise ValueError("frame header does not describe the frame (start index %d, %d active of %d pixels)"
+                             % (frame.startIndex, frame.activePixels, frame.pixelCount))
+    return frame.darkPixels, frame.window
+
+
+class StreamedFrame(namedtuple('StreamedFrame', 'sequence timestamp counts')):
+    """One frame taken from a FrameRingBuffer."""
+    __slots__ = ()
+
+
+class FrameRingBuffer:
+    """Fixed size ring of frames filled by an acquisition thread.
+
+    All storage (frames x pixels counts, timestamps and sequence numbers) is
+    allocated once. Every acquired frame gets the next sequence number, so
+    gaps in the sequence tell a consumer that frames were lost.
+
+    If overwrite is True a full ring overwrites the oldest unread frame
+    (counted as overrun), otherwise put() waits up to blockTimeout seconds for
+    a consumer to make room and drops the frame if none does.
+    """
+
+    def __init__(self, capacity, pixels = PIXEL_COUNT_USB4000, overwrite = True, blockTimeout = None):
+        self.capacity     = capacity
+        self.overwrite    = overwrite
+        self.blockTimeout = blockTimeout
+        self.frames       = np.zeros((capacity, pixels), dtype = FRAME_DTYPE)
+        self.timestamps   = np.zeros(capacity)
+        self.sequence     = np.zeros(capacity, dtype = np.int64)
+
+        self._cond    = threading.Condition()
+        self._nextSequence = 0
+        self._written = 0     # amount of frames stored so far
+        self._read    = 0     # amount of frames handed out (or overwritten)
+        self._closed  = False
+
+        #: frames handed out by get()
+        self.consumed = 0
+
+        #: frames overwritten before a consumer got them
+        self.overruns = 0
+        #: frames thrown away because the ring stayed full (overwrite = False)
+        self.dropped  = 0
+        #: acquisitions that failed on the USB side
+        self.errors   = 0
+
+    def put(self, counts, timestamp):
+        """Copy counts into the next slot. Returns False if the frame was dropped."""
+        with self._cond:
+                seq = self._nextSequence
+                self._nextSequence += 1
+                if self._written - self._read >= self.capacity:
+                        if self.overwrite:
+                                self.overruns += 1
+                                self._read += 1
+                        else:
+                                deadline = None
+                                if self.blockTimeout != None:
+                                        deadline = time.time() + self.blockTimeout
+                                while self._written - self._read >= self.capacity and not self._closed:
+                                        if deadline == None:
+                                                self._cond.wait()
+                                                continue
+                                        remaining = deadline - time.time()
+                                        if remaining <= 0:
+                                                break
+                                        self._cond.wait(remaining)
+                                if self._written - self._read >= self.capacity:
+                                        self.dropped += 1
+                                        return False
+                slot = self._written % self.capacity
+                self.frames[slot]     = counts
+                self.timestamps[slot] = timestamp
+                self.sequence[slot]   = seq
+                self._written += 1
+                self._cond.notify_all()
+        return True
+
+    def get(self, timeout = None):
+        """Return the oldest unread frame as a StreamedFrame (counts copied).
+
+        Waits up to timeout seconds (forever if None) and returns None if no
+        frame arrived or the ring was closed and is empty.
+        """
+        deadline = None
+        if timeout != None:
+                deadline = time.time() + timeout
+        with self._cond:
+                while self._read >= self._written:
+                        if self._closed:
+                                return None
+                        if deadline == None:
+                                self._cond.wait()
+                                continue
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                                return None
+                        self._cond.wait(remaining)
+                slot = self._read % self.capacity
+                self._read += 1
+                self.consumed += 1
+                frame = StreamedFrame(int(self.sequence[slot]), float(self.timestamps[slot]), self.frames[slot].copy())
+                self._cond.notify_all()
+        return frame
+
+    def latest(self, n):
+        """Copies of the newest n frames in acquisition order.
+
+        Returns (counts, timestamps, sequence) with counts shaped n x pixels.
+        Does not change what get() hands out next.
+        """
+        with self._cond:
+                n = min(n, self._written, self.capacity)
+                slots = (np.arange(self._written - n, self._written) % self.capacity) if n else np.zeros(0, dtype = np.intp)
+                return self.frames[slots], self.timestamps[slots], self.sequence[slots]
+
+    def close(self):
+        """Wake up all waiting producers and consumers."""
+        with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+
+    def __iter__(self):
+        while 1:
+                frame = self.get()
+                if frame == None:
+                        return
+                yield frame
+
+    def __len__(self):
+        with self._cond:
+                return max(0, self._written - self._read)
+
+    def stats(self):
+        with self._cond:
+                return {'acquired' : self._nextSequence,
+                        'consumed' : self.consumed,
+                        'pending'  : max(0, self._written - self._read),
+                        'overruns' : self.overruns,
+                        'dropped'  : self.dropped,
+                        'errors'   : self.errors}
+
+
+def _queryDevice(epOut, epIn, byte, decode=None):
+    # query information (0x05) from the EEPROM of the device
+    epOut.write(bytearray([0x05, byte]))
+    res = epIn.read(64)
+    if   decode == 'str':
+        s   = ''.join(map(chr,res[2:])).rstrip()
+        res = s.replace('\x00','')
+        res = res.replace('\xa4','')
+    elif decode == 'num':
+        s   = ''.join(map(chr,res[2:])).rstrip()
+        res = s.replace('\x00','')
+        res = res.replace('\xa4','')  #FIXME: ??
+        res = float(res)
+    return res
+
+
+def _waitUntilReady(epOut, epIn, timeout = 1.0):
+    # poll the status (0xfe) until the device answers
+    startT = time.time()
+    while (time.time() - startT) < timeout:
+        try:
+            epOut.write(bytearray([0xfe]))
+            epIn.read(64, 50)
+        except IOError:
+            time.sleep(.005)
+            continue
+        return True
+    return False
+
+
+#: sysfs directory of the usbhspec kernel driver
+KERNEL_BASE_PATH = "/sys/bus/usb/drivers/usbhspec/"
+#: sysfs attributes the usbhspec driver exports for every device
+KERNEL_ATTRIBUTES = ("serial_number", "device_name", "sensor_name", "a0", "a1", "a2", "a3", "a4", "a5")
+
+_kernelAttributeCache = {}
+
+def readKernelAttributes(path, serialNumber = None):
+    """All KERNEL_ATTRIBUTES of the device at the sysfs path as a dict.
+
+    They are read in one go and cached per path. A cached entry is only used
+    if its serial number matches serialNumber (when given), so a different
+    device plugged into the same port is read again.
+    """
+    attrs = _kernelAttributeCache.get(path)
+    if attrs != None and (serialNumber == None or attrs["serial_number"] == serialNumber):
+        return attrs
+    attrs = {}
+    for name in KERNEL_ATTRIBUTES:
+        try:
+            with open(os.path.join(path, name)) as f:
+                attrs[name] = f.read().strip()
+        except IOError:
+            attrs[name] = ""
+    _kernelAttributeCache[path] = attrs
+    return attrs
+
+
+#: Directory of the on-disk device info cache (one json file per serial number)
+DEVICE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "OceanOptics")
+
+
+class DeviceInfoCache:
+    """On-disk cache of the EEPROM data of spectrometers.
+
+    Every serial number gets one json file holding the calibration
+    coefficients (a0 ... a5) and the sensor name. The cache is only an
+    optimization, so unreadable or unwritable files are ignored.
+    """
+
+    def __init__(self, directory = None):
+        if directory == None:
+                directory = DEVICE_CACHE_DIR
+        self.directory = directory
+
+    def _path(self, serialNumber):
+        return os.path.join(self.directory, "%s.json" % (re.sub(r"[^\w\-]", "_", serialNumber)))
+
+    def load(self, serialNumber):
+        """Cached info dictionary of the device or None."""
+        try:
+                with open(self._path(serialNumber)) as f:
+                        info = json.load(f)
+        except (IOError, OSError, ValueError):
+                return None
+        if info.get('serialNumber') != serialNumber or len(info.get('coefficients', ())) != 6:
+                return None
+        return info
+
+    def store(self, serialNumber, info):
+        info = dict(info, serialNumber = serialNumber)
+        path = self._path(serialNumber)
+        try:
+                if not os.path.isdir(self.directory):
+                        os.makedirs(self.directory)
+                tmp = "%s.%d.tmp" % (path, os.getpid())
+                with open(tmp, "w") as f:
+                        json.dump(info, f)
+                os.rename(tmp, path)
+        except (IOError, OSError):
+                pass
+
+    def invalidate(self, serialNumber = None):
+        """Forget one device or, without serial number, all devices."""
+        if serialNumber == None:
+                names = [n for n in os.listdir(self.directory) if n.endswith(".json")] if os.path.isdir(self.directory) else []
+                paths = [os.path.join(self.directory, n) for n in names]
+        else:
+                paths = [self._path(serialNumber)]
+        for path in paths:
+                try:
+                        os.remove(path)
+                except OSError:
+                        pass
+
+
+class Calibration:
+    """Wavelength calibration of one spectrometer.
+
+    The coefficients are a0 ... a5 (startWavelength ... fifthKoeff) of the
+    polynomial wl = a0 + a1*p + ... + a5*p**5, where p counts from the first
+    real pixel, i.e. frame index minus pixelOffset. The wavelengths of all
+    pixels are evaluated once (Horner scheme) and cached per serial number.
+    """
+
+    _cache = {}
+
+    def __init__(self, coefficients, pixelOffset = 0, pixels = PIXEL_COUNT_USB4000):
+        self.coefficients = tuple(float(c) for c in coefficients)
+        self.pixelOffset  = pixelOffset
+        self.pixels       = pixels
+        pix = np.arange(pixels, dtype = float) - pixelOffset
+        self.wavelengths = np.polyval(self.coefficients[::-1], pix)
+        self._pixelIndex = np.arange(pixels, dtype = float)
+        # the inverse lookup needs increasing wavelengths
+        self._ascending  = self.wavelengths[-1] >= self.wavelengths[0]
+
+    @classmethod
+    def forDevice(cls, serialNumber, coefficients, pixelOffset = 0, pixels = PIXEL_COUNT_USB4000):
+        """Cached Calibration for the given serial number."""
+        key = (serialNumber, tuple(float(c) for c in coefficients), pixelOffset, pixels)
+        cal = cls._cache.get(key)
+        if cal == None:
+                cal = cls._cache[key] = cls(coefficients, pixelOffset, pixels)
+        return cal
+
+    def wavelengthOf(self, pixel):
+        """Wavelength(s) at the given (fractional) frame index."""
+        pix = np.asarray(pixel, dtype = float) - self.pixelOffset
+        return np.polyval(self.coefficients[::-1], pix)
+
+    def pixelOf(self, wavelength):
+        """Fractional frame index of the given wavelength(s).
+
+        Wavelengths outside the calibrated range give NaN.
+        """
+        wl = np.asarray(wavelength, dtype = float)
+        if self._ascending:
+                return np.interp(wl, self.wavelengths, self._pixelIndex, left = np.nan, right = np.nan)
+        return np.interp(wl, self.wavelengths[::-1], self._pixelIndex[::-1], left = np.nan, right = np.nan)
+
+    def resampler(self, grid):
+        """Resampler from this calibration onto the wavelength grid."""
+        return Resampler(self, grid)
+
+
+class Resampler:
+    """Linear interpolation of spectra onto a fixed wavelength grid.
+
+    The two neighbouring pixels and their weights are computed once per
+    (calibration, grid), so resampling a whole batch (frames x pixels) is a
+    single gather and multiply-add. Grid points outside the calibrated range
+    become fillValue.
+    """
+
+    def __init__(self, calibration, grid, fillValue = np.nan):
+        self.grid = np.asarray(grid, dtype = float)
+        pos = calibration.pixelOf(self.grid)
+        self._outside = np.isnan(pos)
+        pos = np.where(self._outside, 0.0, pos)
+        lower = np.minimum(np.floor(pos).astype(np.intp), calibration.pixels - 2)
+        self._lower   = lower
+        self._upper   = lower + 1
+        self._wUpper  = pos - lower
+        self._wLower  = 1.0 - self._wUpper
+        self.fillValue = fillValue
+
+    def __call__(self, spectra, out = None):
+        """Resample a single spectrum or a (frames x pixels) batch."""
+        spectra = np.asarray(spectra)
+        if out is None:
+                out = np.empty(spectra.shape[:-1] + self.grid.shape)
+        np.multiply(spectra[..., self._lower], self._wLower, out = out)
+        out += spectra[..., self._upper] * self._wUpper
+        if self._outside.any():
+                out[..., self._outside] = self.fillValue
+        return out
+
+
+def nonlinearityFactors(coefficients, maxCount = 65535):
+    """Lookup table of the linearization factor of every 16 bit count.
+
+    coefficients are the nonlinearity polynomial (constant term first) as
+    stored in the EEPROM. They are fitted to dark corrected counts, so
+    linear = counts / poly(counts) of counts the dark is already subtracted
+    from: linear = counts * factors[counts].
+    """
+    x = np.arange(maxCount + 1, dtype = float)
+    poly = np.polyval(np.asarray(coefficients, dtype = float)[::-1], x)
+    poly[poly == 0] = 1.0
+    return (1.0 / poly).astype(np.float32)
+
+
+def _linearize(values, factors, index, scratch):
+    # values (float32, dark corrected) *= factors at the truncated count;
+    # index (intp) and scratch (float32) are buffers of the same shape, the
+    # lookup clips counts below zero and above the table
+    index[...] = values
+    np.take(factors, index, out = scratch, mode = 'clip')
+    values *= scratch
+
+
+class DetectorCorrection:
+    """Correction of raw counts for the detector properties.
+
+    All steps are optional and run in place on a float32 buffer that is kept
+    per input shape, so single frames and (frames x pixels) batches are
+    handled alike and a call allocates nothing but the per frame levels:
+
+    - electrical dark: the mean of the masked darkPixels (see frameLayout)
+      is subtracted
+    - nonlinearity: the dark corrected counts are linearized with
+      nonlinearityFactors
+    - stray light: the mean of strayPixels (pixels that should not see any
+      light) and/or a fixed strayLight profile is subtracted
+    - window: the result is trimmed to the active pixels (a view)
+    """
+
+    def __init__(self, darkPixels = None, nonlinearity = None, strayPixels = None,
+                 strayLight = None, window = None, pixels = PIXEL_COUNT_USB4000):
+        self.darkPixels  = darkPixels
+        self.strayPixels = strayPixels
+        self.strayLight  = None if strayLight is None else np.asarray(strayLight, dtype = np.float32)
+        self.window      = window if window is not None else slice(0, pixels)
+        self.lut         = None if nonlinearity is None else nonlinearityFactors(nonlinearity)
+        self._buffers    = {}
+        self._indices    = {}
+        self._scratch    = {}
+
+    def __call__(self, counts, out = None, copy = False):
+        """Correct counts (uint16) into out (float32, same shape).
+
+        Without out an internal buffer is used and the result is a view into
+        it, which the next call with the same shape overwrites unless copy is
+        True.
+        """
+        if out is None:
+                out = self._buffers.get(counts.shape)
+                if out is None:
+                        out = self._buffers[counts.shape] = np.empty(counts.shape, dtype = np.float32)
+        out[...] = counts
+        if self.darkPixels is not None:
+                out -= out[..., self.darkPixels].mean(axis = -1, keepdims = True)
+        if self.lut is not None:
+                index = self._indices.get(counts.shape)
+                if index is None:
+                        index = self._indices[counts.shape] = np.empty(counts.shape, dtype = np.intp)
+                        self._scratch[counts.shape] = np.empty(counts.shape, dtype = np.float32)
+                _linearize(out, self.lut, index, self._scratch[counts.shape])
+        if self.strayPixels is not None:
+                out -= out[..., self.strayPixels].mean(axis = -1, keepdims = True)
+        if self.strayLight is not None:
+                out -= self.strayLight
+        res = out[..., self.window]
+        if copy:
+                return res.copy()
+        return res
+
+    def wavelengths(self, calibration):
+        """Wavelengths belonging to the trimmed output."""
+        return calibration.wavelengths[self.window]
+
+
+class ReferenceSpectrum(namedtuple('ReferenceSpectrum', 'spectrum integrationTime frames timestamp settings')):
+    """An averaged dark or reference spectrum (float32, all pixels) with the
+    integration time, the amount of frames, the time it was taken and the
+    settings (nonlinearity coefficients) in effect."""
+    __slots__ = ()
+
+
+class TransmissionMeasurement:
+    """Transmittance and absorbance of raw frames against cached dark and
+    reference spectra.
+
+    Dark and reference spectra are averages of raw frames and are kept per
+    integration time. With nonlinearity coefficients the sample and the
+    reference are linearized after the dark is subtracted. The spectra are
+    stale once the nonlinearity coefficients differ from the
+    ones they were taken with or, with maxAge (seconds), once they get older
+    than that; spectra for another integration time are missing, which
+    counts as stale as well.
+
+    transmittance and absorbance take single frames or (frames x pixels)
+    batches of raw counts and write float32 into out (allocated if None),
+    restricted to the pixels in window. Pixels at or above saturationLevel,
+    in the sample or in the reference, and pixels where the reference does
+    not exceed the dark become maskValue.
+    """
+
+    def __init__(self, window = None, nonlinearity = None, saturationLevel = 65535, maskValue = np.nan,
+                 maxAge = None, pixels = PIXEL_COUNT_USB4000):
+        self.window          = window if window is not None else slice(0, pixels)
+        self.saturationLevel = saturationLevel
+        self.maskValue       = maskValue
+        self.maxAge          = maxAge
+        self.pixels          = pixels
+        self.darks      = {}
+        self.references = {}
+        self._prepared  = {}
+        self._masks     = {}
+        self._indices   = {}
+        self._scratch   = {}
+        self.setNonlinearity(nonlinearity)
+
+    def setNonlinearity(self, coefficients):
+        """Linearize with these coefficients (None: not at all); spectra taken
+        with other coefficients become stale."""
+        self.settings = None if coefficients is None else tuple(float(c) for c in coefficients)
+        self.lut      = None if coefficients is None else nonlinearityFactors(coefficients)
+        self._prepared = {}
+
+    def average(self, frames):
+        """Mean of an iterable of raw frames (or a batch) as float32."""
+        total = np.zeros(self.pixels)
+        n = 0
+        for counts in frames:
+                total += counts
+                n += 1
+        if n == 0:
+                raise ValueError("no frames to average")
+        return (total / n).astype(np.float32), n
+
+    def setDark(self, frames, integrationTime):
+        """Average the raw frames into the dark spectrum for integrationTime."""
+        spectrum, n = self.average(frames)
+        self.darks[integrationTime] = ReferenceSpectrum(spectrum, integrationTime, n, time.time(), self.settings)
+        self._prepared.pop(integrationTime, None)
+        return self.darks[integrationTime]
+
+    def setReference(self, frames, integrationTime):
+        """Average the raw frames into the reference spectrum for integrationTime."""
+        spectrum, n = self.average(frames)
+        self.references[integrationTime] = ReferenceSpectrum(spectrum, integrationTime, n, time.time(), self.settings)
+        self._prepared.pop(integrationTime, None)
+        return self.references[integrationTime]
+
+    def isStale(self, integrationTime):
+        """True if the dark or the reference for integrationTime is missing,
+        was taken with other settings or is older than maxAge."""
+        for cache in (self.darks, self.references):
+                entry = cache.get(integrationTime)
+                if entry == None or entry.settings != self.settings:
+                        return True
+                if self.maxAge != None and time.time() - entry.timestamp > self.maxAge:
+                        return True
+        return False
+
+    def _prepare(self, integrationTime):
+        # windowed dark and 1 / linearized (reference - dark), NaN where it
+        # is unusable
+        prepared = self._prepared.get(integrationTime)
+        if prepared != None:
+                return prepared
+        dark = self.darks.get(integrationTime)
+        ref  = self.references.get(integrationTime)
+        if dark == None or ref == None:
+                raise ValueError("no dark and reference spectrum for %d usec" % (integrationTime))
+        if dark.settings != self.settings or ref.settings != self.settings:
+                raise ValueError("dark or reference spectrum for %d usec was taken with other settings" % (integrationTime))
+        darkWin = dark.spectrum[self.window].copy()
+        denominator = ref.spectrum[self.window] - darkWin
+        invalid = denominator <= 0
+        if self.saturationLevel != None:
+                invalid |= ref.spectrum[self.window] >= self.saturationLevel
+        if self.lut is not None:
+                _linearize(denominator, self.lut, np.empty(denominator.shape, dtype = np.intp),
+                           np.empty_like(denominator))
+        inverse = np.ones_like(denominator)
+        np.divide(inverse, denominator, out = inverse, where = ~invalid)
+        inverse[invalid] = np.nan
+        prepared = self._prepared[integrationTime] = (darkWin, inverse, invalid)
+        return prepared
+
+    def transmittance(self, counts, integrationTime, out = None):
+        """(S - D) / (R - D) of raw counts into out (float32)."""
+        out, raw, invalid = self._transmittance(counts, integrationTime, out)
+        self._applyMask(raw, invalid, out)
+        return out
+
+    def absorbance(self, counts, integrationTime, out = None):
+        """-log10 of the transmittance into out (float32)."""
+        out, raw, invalid = self._transmittance(counts, integrationTime, out)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                np.log10(out, out = out)
+        np.negative(out, out = out)
+        self._applyMask(raw, invalid, out)
+        return out
+
+    def _transmittance(self, counts, integrationTime, out):
+        darkWin, inverse, invalid = self._prepare(integrationTime)
+        raw = np.asarray(counts)[..., self.window]
+        if out is None:
+                out = np.empty(raw.shape, dtype = np.float32)
+        out[...] = raw
+        out -= darkWin
+        if self.lut is not None:
+                index = self._indices.get(raw.shape)
+                if index is None:
+                        index = self._indices[raw.shape] = np.empty(raw.shape, dtype = np.intp)
+                        self._scratch[raw.shape] = np.empty(raw.shape, dtype = np.float32)
+                _linearize(out, self.lut, index, self._scratch[raw.shape])
+        # unusable reference pixels become NaN here already
+        out *= inverse
+        return out, raw, invalid
+
+    def _applyMask(self, raw, invalid, out):
+        if np.isnan(self.maskValue) or not invalid.any():
+                invalid = None
+        if self.saturationLevel != None or invalid is not None:
+                self._mask(raw, invalid, out)
+
+    def _mask(self, raw, invalid, out):
+        # the boolean buffer is kept per shape like the index buffer
+        mask = self._masks.get(raw.shape)
+        if mask is None:
+                mask = self._masks[raw.shape] = np.empty(raw.shape, dtype = bool)
+        if self.saturationLevel != None:
+                np.greater_equal(raw, self.saturationLevel, out = mask)
+        else:
+                mask[...] = False
+        if invalid is not None:
+                mask |= invalid
+        np.copyto(out, self.maskValue, where = mask)
+
+    def wavelengths(self, calibration):
+        """Wavelengths belonging to the windowed output."""
+        return calibration.wavelengths[self.window]
+
+
+class AutoExposure(namedtuple('AutoExposure', 'integrationTime peak frames converged counts')):
+    """Result of USB4000.autoExpose: the chosen integration time, the dark
+    corrected peak count of the last frame, the amount of frames it took,
+    whether the target was reached and the counts of the last frame.
+    """
+    __slots__ = ()
+
+
+class BurstCapture(namedtuple('BurstCapture', 'counts requested completed integrationTime startTime')):
+    """Result of USB4000.captureBurst.
+
+    counts is frames x PIXEL_COUNT_USB4000 raw uint16 (header included, as
+    getSpectrum returns them), requested and completed hold the monotonic
+    clock (seconds, see _clock) at which each frame was requested and fully
+    received, startTime is the wall clock time the burst started.
+    """
+    __slots__ = ()
+
+    @property
+    def intervals(self):
+        # time between consecutive frame completions
+        return np.diff(self.completed)
+
+    @property
+    def rate(self):
+        # achieved frames per second over the whole burst
+        if not len(self.counts):
+                return 0.0
+        return len(self.counts) / float(self.completed[-1] - self.requested[0])
+
+    @property
+    def jitter(self):
+        # standard deviation of the frame intervals in seconds
+        if len(self.counts) < 2:
+                return 0.0
+        return float(self.intervals.std())
+
+    def frame(self, index):
+        """The decoded SpectrumFrame of one frame (a view into counts)."""
+        return decodeFrame(self.counts[index])
+
+
+#: clock used for the stage timers (monotonic where available)
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class Instrumentation:
+    """Timers and counters for the acquisition hot path of a USB4000.
+
+    Stages (durations in seconds):
+    - write:    sending the request spectrum command
+    - wait:     from the request until the first packet arrived (integration
+                time plus USB latency and retries)
+    - transfer: reading the rest of the frame
+    - decode:   assembling and decoding the counts
+    Counters: frames, retries (ep6 reads that came back empty while
+    waiting), timeouts, shortReads and hookErrors.
+
+    Every recorded value is also passed to the hooks as hook(name, value),
+    with the duration for stages and the increment for counters. Hooks run in
+    the acquiring thread and should return quickly; exceptions raised by a
+    hook are counted as hookErrors and otherwise ignored.
+
+    The histograms have logarithmic bins, bins per decade from minTime to
+    maxTime seconds, plus an underflow and an overflow bin.
+    """
+
+    STAGES   = ('write', 'wait', 'transfer', 'decode')
+    COUNTERS = ('frames', 'retries', 'timeouts', 'shortReads', 'hookErrors')
+
+    def __init__(self, minTime = 1e-6, maxTime = 10.0, bins = 8):
+        decades = int(round(np.log10(maxTime / minTime)))
+        self.edges = np.logspace(np.log10(minTime), np.log10(maxTime), decades * bins + 1).tolist()
+        self._hooks = []
+        self._lock  = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Set all timers and counters to zero (the hooks stay)."""
+        with self._lock:
+                # per stage: [count, total, min, max]
+                self._stages = dict((stage, [0, 0.0, None, None]) for stage in self.STAGES)
+                self._histograms = dict((stage, [0] * (len(self.edges) + 1)) for stage in self.STAGES)
+                self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def addHook(self, hook):
+        """Call hook(name, value) for every recorded duration and count."""
+        self._hooks.append(hook)
+
+    def removeHook(self, hook):
+        self._hooks.remove(hook)
+
+    def record(self, stage, seconds):
+        with self._lock:
+                stats = self._stages[stage]
+                stats[0] += 1
+                stats[1] += seconds
+                if stats[2] == None or seconds < stats[2]:
+                        stats[2] = seconds
+                if stats[3] == None or seconds > stats[3]:
+                        stats[3] = seconds
+                self._histograms[stage][bisect.bisect_right(self.edges, seconds)] += 1
+        if self._hooks:
+                self._callHooks(stage, seconds)
+
+    def count(self, counter, n = 1):
+        with self._lock:
+                self.counters[counter] += n
+        if self._hooks:
+                self._callHooks(counter, n)
+
+    def _callHooks(self, name, value):
+        for hook in list(self._hooks):
+                try:
+                        hook(name, value)
+                except Exception:
+                        with self._lock:
+                                self.counters['hookErrors'] += 1
+
+    def snapshot(self):
+        """All timers, histograms and counters as a plain dict (JSON serializable)."""
+        with self._lock:
+                stages = {}
+                for stage in self.STAGES:
+                        count, total, minimum, maximum = self._stages[stage]
+                        stages[stage] = {'count'     : count,
+                                         'total'     : total,
+                                         'mean'      : total / count if count else None,
+                                         'min'       : minimum,
+                                         'max'       : maximum,
+                                         'histogram' : list(self._histograms[stage])}
+                return {'stages'   : stages,
+                        'counters' : dict(self.counters),
+                        'edges'    : list(self.edges)}
+
+
+class PyusbTransport:
+    """Bulk transfers through pyusb (libusb).
+
+    Devices are found by vendor and product id unless a list of devices is
+    given. All devices are INITIALIZEd at the same time, the EEPROM data
+    comes from the device cache where possible.
+    """
+
+    name      = 'pyusb'
+    interface = 'pyusb'
+
+    def find(self, spec, devices = None):
+        if devices == None:
+                import usb.core
+                try:
+                        devices = list(usb.core.find(idVendor = USB_USBSPEC_VENDOR_ID, idProduct = USB_USBSPEC_PRODUCT_ID_USB4000, find_all = True))
+                except usb.core.NoBackendError as e:
+                        raise ImportError(str(e))
+                #devices = usb.core.find(idVendor=USB_USBSPEC_VENDOR_ID, idProduct=USB_USBSPEC_PRODUCT_ID_USB650, find_all=True)
+
+        # initialize all connected devices at the same time
+        # get necessary data for all devices {'510C2114': ('usbhspec0', '5-2:1.0', '324'  )}
+        #                                    { serialNo : ( 'pyusb'   ,  None    , firstWL, dev, info)}
+        results = [None] * len(devices)
+        def init(i, dev):
+                try:
+                        results[i] = spec._initPyusbDevice(dev)
+                except IOError as e:
+                        spec._log("Initializing spectrometer %d failed: %s" % (i, e))
+        threads = [threading.Thread(target = init, args = (i, dev)) for i, dev in enumerate(devices)]
+        for t in threads:
+                t.start()
+        for t in threads:
+                t.join()
+        specs = {}
+        for res in results:
+                if res != None:
+                        serNr, info, dev = res
+                        specs[serNr] = ( 'pyusb'   ,  None    ,  "%.0f" % (info['coefficients'][0]), dev, info)
+        return specs
+
+    def select(self, specs, deviceName):
+        # only the serial number would be delivered as device name in this context (pyusb)
+        if deviceName == None:
+                # use the 'first' spectrometer
+                return list(specs.keys())[0]
+        if deviceName in specs:
+                return deviceName
+        return None
+
+    def _endpoints(self, dev):
+        import usb.control, usb.util
+        cfg = dev.get_active_configuration()
+        interface_number = cfg[(0,0)].bInterfaceNumber
+        alternate_setting = usb.control.get_interface(dev, interface_number)
+        intf = usb.util.find_descriptor(cfg, bInterfaceNumber = interface_number,bAlternateSetting = alternate_setting)
+        return [usb.util.find_descriptor(intf, custom_match = lambda e: e.bEndpointAddress == address)
+                for address in (0x01, 0x81, 0x82, 0x86)]
+
+    def open(self, spec, serialNumber):
+        value = spec.specs[serialNumber]
+        dev = value[3]
+
+        # create endpoints
+        spec.ep1Out, spec.ep1In, spec.ep2, spec.ep6 = self._endpoints(dev)
+        spec._allocateFrameBuffers()
+
+        # the EEPROM data was read (or taken from the cache) while initializing
+        info   = value[4]
+        spec.deviceInfo = info
+        coeffs = info['coefficients']
+        #: Get start wavelength
+        spec.startWavelength = coeffs[0]
+        #: Second calibration coefficient.
+        spec.firstKoeff      = coeffs[1]
+        #: Third calibration coefficient.
+        spec.secondKoeff     = coeffs[2]
+        #: Fourth calibration coefficient.
+        spec.thirdKoeff      = coeffs[3]
+        #: Fifth calibration coefficient.
+        spec.fourthKoeff     = coeffs[4]
+        #: Guess what!
+        spec.fifthKoeff      = coeffs[5]
+        spec.sensorName = info['sensorName']
+
+        spec.deviceName = dev
+
+
+class KernelTransport:
+    """The usbhspec kernel driver: frames are read from /dev/usbhspecN, the
+    calibration and the integration time live in sysfs (KERNEL_BASE_PATH).
+    Needs findUSBserialDevice to map USB addresses to device files.
+    """
+
+    name      = 'kernel'
+    interface = 'kernel'
+
+    def driverLoaded(self):
+        # the driver publishes its devices in sysfs
+        return os.path.exists(KERNEL_BASE_PATH)
+
+    def find(self, spec, devices = None):
+        if devices != None or not self.driverLoaded():
+                return {}
+        from findUSBserialDevice import getDeviceFileFromAddress
+
+        specs = {}
+        for i in os.listdir(KERNEL_BASE_PATH):
+                mtch = re.search(r"\d\-\d.*\:\d+\.\d+", i)
+                if mtch:
+                        serNr = open(os.path.join(KERNEL_BASE_PATH, i, "serial_number"), "r").read().strip()
+                        attrs = readKernelAttributes(os.path.join(KERNEL_BASE_PATH, i), serNr)
+                        res = getDeviceFileFromAddress("usb", i)
+                        if len(res) != 1:
+                                spec._log("Something went wrong. I found two USB devices with the same path!")
+                                for r in res:
+                                        spec._log(r)
+                                sys.exit("PLEASE call someone (Carsten) who knows what to do now!")
+
+                        specs[serNr] = (res[0][0], i, "%.0f" % (float(attrs["a0"])))
+        return specs
+
+    def select(self, specs, deviceName):
+        if deviceName == None:
+                # use random device (if more than one device is attached)
+                return list(specs.keys())[0]
+        from findUSBserialDevice import testAddress
+        for key, value in specs.items():
+                # if it is an valid usb address like '8-2:1.0'
+                if testAddress(deviceName):
+                        if value[1] == deviceName:
+                                return key
+                elif value[0] == deviceName or key == deviceName:
+                        return key
+        return None
+
+    def open(self, spec, serialNumber):
+        spec.basePath = os.path.join(KERNEL_BASE_PATH, spec.specs[serialNumber][1])
+        # all sysfs attributes were read (and cached) while searching
+        attrs = readKernelAttributes(spec.basePath)
+        spec.serialNumber    = attrs["serial_number"]
+        #: First calibration coefficient of the spectrometer. Pixel counting starts at 1!
+        spec.startWavelength = float(attrs["a0"])
+        #: Second calibration coefficient.
+        spec.firstKoeff      = float(attrs["a1"])
+        #: Third calibration coefficient.
+        spec.secondKoeff     = float(attrs["a2"])
+        #: Fourth calibration coefficient.
+        spec.thirdKoeff      = float(attrs["a3"])
+        #: Fifth calibration coefficient.
+        spec.fourthKoeff     = float(attrs["a4"])
+        #: Guess what!
+        spec.fifthKoeff      = float(attrs["a5"])
+        spec.deviceName = attrs["device_name"]
+        spec.sensorName = attrs["sensor_name"]
+        spec.deviceInfo = {'coefficients' : [spec.startWavelength, spec.firstKoeff, spec.secondKoeff,
+                                             spec.thirdKoeff, spec.fourthKoeff, spec.fifthKoeff],
+                           'sensorName'   : spec.sensorName}
+
+        spec.devicePath = "/dev/%s" % (spec.deviceName)
+        # unbuffered, frames are read straight into the frame buffer
+        spec._devFile = io.open(spec.devicePath, 'rb', buffering = 0)
+        spec._allocateFrameBuffers()
+
+
+#: name -> transport (an object with name, interface, find, select and open
+#: like PyusbTransport) or "module:Class" of one, imported when first used
+TRANSPORTS = {'pyusb'  : PyusbTransport(),
+              'kernel' : KernelTransport(),
+              'sim'    : "USB4000Simulator:SimulatedTransport"}
+#: transports searched by USB4000 if neither devices nor transport are given
+DEFAULT_TRANSPORTS = ('kernel', 'pyusb')
+
+
+def registerTransport(name, transport):
+    """Make a transport (or "module:Class") available under name."""
+    TRANSPORTS[name] = transport
+
+
+def getTransport(name):
+    """The transport registered as name; imports it if needed."""
+    try:
+            transport = TRANSPORTS[name]
+    except KeyError:
+            raise ValueError("Unknown transport %r (known: %s)" % (name, ", ".join(sorted(TRANSPORTS))))
+    if isinstance(transport, str):
+            moduleName, className = transport.split(":")
+            transport = TRANSPORTS[name] = getattr(importlib.import_module(moduleName), className)()
+    return transport
+
+
 class USB4000: ## GUI OoUSB4000 ## Adds this device to the spectrometers listed in the GUI
     """Connect to a Ocean Optics mini spectrometer via USB.
     """
 
     # device name should be either the USB-address or the serial numer
-    def __init__(self, deviceName = None):
+    # useCache = False queries the EEPROM again and refreshes the device cache
+    # devices is a list of pyusb devices (or USB4000Simulator devices) to use
+    # instead of searching the bus
+    # transport is the name (or a list of names) of the transports to search,
+    # see TRANSPORTS
+    # verbose prints what is found and done to the console
+    def __init__(self, deviceName = None, useCache = True, deviceCache = None, devices = None,
+                 transport = None, verbose = False):
         # the device name would be the 'device' in the "/dev/" folder (linux)
         self.deviceName   = None
         self.serialNumber = None
+        self._initState(verbose)
 
         # Only needed for pyUSB. Checks if the configuration was already set.
         self.configurationSet = False
 
-        # self.usedInterface is set in findAllConnectedSpectrometers
+        # EEPROM data (calibration, sensor) is cached on disk per serial number
+        self.useCache    = useCache
+        self.deviceCache = deviceCache if deviceCache != None else DeviceInfoCache()
+        self._devices    = list(devices) if devices != None else None
+
+        # self.usedInterface ('pyusb' or 'kernel', the way the device is
+        # talked to) and self.transport (name of the transport, see
+        # TRANSPORTS) are set in findAllConnectedSpectrometers.
         # self.usedInterface equals None if no device is found
-        devNotFound = True
+        self._transportNames = transport
 
         # If no spectrometer is foud this function complains and exits!
         self.specs = self._findAllConnectedSpectrometers()
 
-        if self.usedInterface == 'pyusb':
-                if  deviceName == None:
-                        # use the 'first' spectrometer
-                        self.serialNumber = self.specs.keys()[0]
-                        self.deviceName   = None
-                        self.basePath     = None
-                        devNotFound = False
-                else:
-                        # only the serial number would be delivered as device name in this context (pyusb)
-                        if self.specs.has_key(deviceName):
-                                self.serialNumber = key
-                                self.deviceName   = None
-                                self.basePath     = None
-                                devNotFound       = False
-
-        elif self.usedInterface == 'kernel':
-                if  deviceName == None:
-                        # use random device (if more than one device is attached)
-                        self.serialNumber = self.specs.keys()[0]
-                        self.deviceName = self.specs[self.serialNumber][0]
-                        self.basePath = os.path.join("/sys/bus/usb/drivers/usbhspec/", self.specs[self.serialNumber][1])
-                        devNotFound = False
-                else:
-                        # if it is an valid usb address like '8-2:1.0'
-                        if testAddress(deviceName):
-                                for key, value in self.specs.iteritems():
-                                        if value[1] == deviceName:
-                                                self.deviceName = value[0]
-                                                self.basePath = os.path.join("/sys/bus/usb/drivers/usbhspec/", value[1])
-                                                devNotFound = False
-                                                break
-                        else:
-                                for key, value in self.specs.iteritems():
-                                        if value[0] == deviceName:
-                                                self.deviceName = value[0]
-                                                self.basePath = os.path.join("/sys/bus/usb/drivers/usbhspec/", value[1])
-                                                devNotFound = False
-                                                break
-                                        if key == deviceName:
-                                                self.deviceName = value[0]
-                                                self.basePath = os.path.join("/sys/bus/usb/drivers/usbhspec/", value[1])
-                                                devNotFound = False
-                                                break
-
-        if devNotFound == True:
-                print("Device %s not found! Exiting ..." % (deviceName))
-                sys.exit()
-
-        if self.usedInterface == 'kernel':
-                #: First calibration coefficient of the spectrometer. Pixel counting starts at 1!
-                self.startWavelength = float(file(os.path.join(self.basePath,"a0")).read())
-                #: Second calibration coefficient.
-                self.firstKoeff      = float(file(os.path.join(self.basePath,"a1")).read())
-                #: Third calibration coefficient.
-                self.secondKoeff     = float(file(os.path.join(self.basePath,"a2")).read())
-                #: Fourth calibration coefficient.
-                self.thirdKoeff      = float(file(os.path.join(self.basePath,"a3")).read())
-                #: Fifth calibration coefficient.
-                self.fourthKoeff     = float(file(os.path.join(self.basePath,"a4")).read())
-                #: Guess what!
-                self.fifthKoeff      = float(file(os.path.join(self.basePath,"a5")).read())
-                self.deviceName = file(os.path.join(self.basePath,"device_name")).read().strip()
-                self.sensorName = file(os.path.join(self.basePath,"sensor_name")).read().strip()
-
-                self.devicePath = "/dev/%s" % (self.deviceName)
-        else: # self.usedInterface == 'pyusb'
-                # we do know the serialNumber!
-
-                value = self.specs[self.serialNumber]
-                dev = value[3]
-
-                # create endpoints
-
-                cfg = dev.get_active_configuration()
-                interface_number = cfg[(0,0)].bInterfaceNumber
-                alternate_setting = usb.control.get_interface(dev, interface_number)
-                intf = usb.util.find_descriptor(cfg, bInterfaceNumber = interface_number,bAlternateSetting = alternate_setting)
-
-                self.ep1Out = usb.util.find_descriptor(intf, custom_match = lambda e: e.bEndpointAddress == 0x01)
-                self.ep1In  = usb.util.find_descriptor(intf, custom_match = lambda e: e.bEndpointAddress == 0x81)
-                self.ep2    = usb.util.find_descriptor(intf, custom_match = lambda e: e.bEndpointAddress == 0x82)
-                self.ep6    = usb.util.find_descriptor(intf, custom_match = lambda e: e.bEndpointAddress == 0x86)
-
-                #: Get start wavelength
-                self.startWavelength = self._query(0x01, "num")
-                #: Second calibration coefficient.
-                self.firstKoeff      = self._query(0x02, "num")
-                #: Third calibration coefficient.
-                self.secondKoeff     = self._query(0x03, "num")
-                #: Fourth calibration coefficient.
-                self.thirdKoeff      = self._query(0x04, "num")
-                #: Fifth calibration coefficient.
-                self.fourthKoeff     = 0.0
-                #: Guess what!
-                self.fifthKoeff      = 0.0
-                self.sensorName = ''
-
-                self.deviceName = dev
-
+        serialNumber = None
+        if self.usedInterface != None:
+                serialNumber = self._transport.select(self.specs, deviceName)
+        if serialNumber == None:
+                sys.exit("Device %s not found!" % (deviceName))
+        self.serialNumber = serialNumber
+        self._transport.open(self, serialNumber)
 
         # Default
         self.pixelOffset = 0
         # S10420-1006/-1106 CCD image sensor see documentation (Device structure)
         if (self.sensorName == "S10420-1106") or (self.sensorName == "S10420-1006"):
                 self.pixelOffset = 10
-                print ("Sensor '%s' means pixel offset of %d" % (self.sensorName, self.pixelOffset))
+                self._log("Sensor '%s' means pixel offset of %d" % (self.sensorName, self.pixelOffset))
         elif (self.sensorName.find("S8377") > -1) or (self.sensorName.find("S8378") > -1):
                 self.pixelOffset = 0
-                print ("Sensor '%s' means pixel offset of %d" % (self.sensorName, self.pixelOffset))
+                self._log("Sensor '%s' means pixel offset of %d" % (self.sensorName, self.pixelOffset))
 
 
 
         # gereate wavelength array
-        self.wlArr = np.zeros(PIXEL_COUNT_USB4000)
-        for pix in range(PIXEL_COUNT_USB4000):
-                self.wlArr[pix] = self.startWavelength       + \
-                                   pix *   self.firstKoeff   + \
-                                  (pix**2)*self.secondKoeff  + \
-                                  (pix**3)*self.thirdKoeff   + \
-                                  (pix**4)*self.fourthKoeff  + \
-                                  (pix**5)*self.fifthKoeff
-        print (self.wlArr)
+        self.calibration = Calibration.forDevice(self.serialNumber,
+                                                 (self.startWavelength, self.firstKoeff, self.secondKoeff,
+                                                  self.thirdKoeff, self.fourthKoeff, self.fifthKoeff),
+                                                 self.pixelOffset)
+        self.wlArr = self.calibration.wavelengths
+        self._log(self.wlArr)
+
+    def _initState(self, verbose = False):
+        # state that does not depend on the device, shared with subclasses
+        # that are not backed by one (SpectrumReplay)
+        self.verbose = verbose
+
+        # integration time in usec as set by setIntegrationTime and the last
+        # value the device confirmed (None: unknown)
+        self.integrationTime   = None
+        self._confirmedIntTime = None
+
+        # dark pixels and active window of the frames, see getPixelLayout
+        self._pixelLayout = None
+        # optional DetectorCorrection applied by getSpectrum, see enableCorrection
+        self.correction = None
+        # dark and reference spectra for getTransmittance, see enableMeasurement
+        self.measurement = None
+        self.deviceInfo = {}
+
+        # optional Instrumentation of the acquisition, see enableInstrumentation
+        self.instrumentation = None
+
+        # continuous acquisition, see startStreaming
+        self.stream         = None
+        self._streamThread  = None
+        self._streamStop    = threading.Event()
+
+    def _log(self, message):
+        # console output only if asked for (verbose)
+        if self.verbose:
+                print (message)
 
     def findAllConnectedSpectrometers(self):
             return self.specs
     def _findAllConnectedSpectrometers(self):
         """Function to find all connected USB-spectrometers
 
-        Returns a list/dictionary? with spectrometers containing:
-        - device name
-        - serial number
-        - start wavelength
-        """
+        Returns a dictionary serial number -> tuple with the device file (or
+        'pyusb'), the USB address (or None) and the start wavelength; pyusb
+        entries also hold the device and its EEPROM data.
 
-        specs = {}
-        self.usedInterface = "kernel"
-
-        basePath = "/sys/bus/usb/drivers/usbhspec/"
-        if not os.path.exists(basePath):
-                self.usedInterface = "pyusb"
-                print ("No spectrometer found using the kernel module.")
-                print ("Now testing pyusb!")
-
-        if self.usedInterface == "kernel":
-                fList = os.listdir(basePath)
-
-                for i in fList:
-                        mtch = re.search("\d\-\d.*\:\d+\.\d+", i)
-                        if mtch:
-                                serNr = open(os.path.join(basePath, i, "serial_number"), "r").read().strip()
-                                res = getDeviceFileFromAddress("usb", i)
-                                if len(res) != 1:
-                                        print("Something went wrong. I found two USB devices with the same path!")
-                                        for i in res:
-                                                print (i)
-                                        print("PLEASE call someone (Carsten) who knows what to do now!")
-                                        sys.exit()
-
-                                specs[serNr] = (res[0][0], i, "%.0f" % (float(file(os.path.join(basePath, i,"a0")).read())))
-        elif self.usedInterface == "pyusb":
-                # use the pyusb interface (only ONE of these interfaces WILL work)
-                devs = usb.core.find(idVendor=USB_USBSPEC_VENDOR_ID, idProduct=USB_USBSPEC_PRODUCT_ID_USB4000, find_all=True)
-                #devs = usb.core.find(idVendor=USB_USBSPEC_VENDOR_ID, idProduct=USB_USBSPEC_PRODUCT_ID_USB650, find_all=True)
-
-                if len(devs) > 0:
-                        print "Found %d spectrometer(s) via pyusb!" % (len(devs))
+        The transports given to the constructor are tried in order, without
+        any the transport of the given devices or DEFAULT_TRANSPORTS. The
+        first one that finds a spectrometer is used; transports whose
+        libraries are missing are skipped, with a warning if their driver is
+        loaded (see KernelTransport.driverLoaded). A single transport asked
+        for by name raises the ImportError instead.
+        """
+        names = self._transportNames
+        if names == None:
+                if self._devices != None:
+                        names = [getattr(self._devices[0], 'transport', 'pyusb')] if len(self._devices) else ['pyusb']
                 else:
-                        print "Also no spectrometer found using pyusb."
-
-                # find alls connected devices
-                for dev in devs:
-                        #dev.set_configuration()
-                        #cfg = dev.get_active_configuration()
-                        #interface_number = cfg[(0,0)].bInterfaceNumber
-                        #alternate_setting = usb.control.get_interface(dev, interface_number)
-                        #intf = usb.util.find_descriptor(cfg, bInterfaceNumber = interface_number,bAlternateSetting = alternate_setting)
-
-                        cfg=dev[0]
-                        intf=cfg[(0, 0)]
-
-                        self.ep1Out=intf[0]
-                        self.ep1In =intf[3]
-
-                        #self.ep1Out = usb.util.find_descriptor(intf, custom_match = lambda e: e.bEndpointAddress == 0x01)
-                        #self.ep1In  = usb.util.find_descriptor(intf, custom_match = lambda e: e.bEndpointAddress == 0x81)
-
-                        readSuccess = False
-                        while not readSuccess:
-                                # INITIALIZE
-                                self.ep1Out.write(chr(0x01))
-                                time.sleep(0.5)
-                                readSuccess = True
-                                # get integration time
-
-                                #self.ep1Out.write(chr(0xfe))
-                                #try:
-                                        #res = self.ep1In.read(64)
-                                        #readSuccess = True
-                                #except usb.core.USBError:
-                                        #print "Failed"
-                                        #pass
-
-                        #int_time = (res[5]<<24)+(res[4]<<16)+(res[3]<<8)+res[2]
-                        #print int_time
-
-                        # get necessary data for all devices {'510C2114': ('usbhspec0', '5-2:1.0', '324'  )}
-                        #                                    { serialNo : ( 'pyusb'   ,  None    , firstWL)}
-                        # get serial number
-                        serNr = self._query(0x00, "str")
-                        # get a0
-                        a0 = self._query(0x01, "num")
-                        del(self.ep1Out, self.ep1In)
-                        specs[serNr] = ( 'pyusb'   ,  None    ,  "%.0f" % (float(a0)), dev)
-        else:
-                print ("This point should never be reached!")
-                sys.exit()
+                        names = DEFAULT_TRANSPORTS
+        elif isinstance(names, str):
+                names = [names]
+        explicit = self._transportNames != None and len(names) == 1
+
+        self.usedInterface = None
+        self.transport     = None
+        self._transport    = None
+        specs = {}
+        for name in names:
+                transport = getTransport(name)
+                try:
+                        specs = transport.find(self, self._devices)
+                except ImportError as e:
+                        message = "Transport %s is not available: %s" % (name, e)
+                        if explicit:
+                                raise ImportError(message)
+                        driverLoaded = getattr(transport, 'driverLoaded', None)
+                        if driverLoaded != None and driverLoaded():
+                                warnings.warn(message + " (its driver is loaded)", RuntimeWarning)
+                        self._log(message)
+                        continue
+                if len(specs) > 0:
+                        self._log("Found %d spectrometer(s) via %s!" % (len(specs), name))
+                        self.usedInterface = transport.interface
+                        self.transport     = transport.name
+                        self._transport    = transport
+                        break
+                self._log("No spectrometer found via %s." % (name))
+        return specs
 
-        if len(specs) == 0:
-                self.usedInterface = None
+    def _initPyusbDevice(self, dev):
+        """INITIALIZE one device and get its serial number and EEPROM data.
 
-        return specs
+        Returns (serialNumber, info, dev). The calibration comes from the
+        device cache if possible, so a warm start only asks for the serial.
+        """
+        #dev.set_configuration()
+        cfg=dev[0]
+        intf=cfg[(0, 0)]
+        epOut=intf[0]
+        epIn =intf[3]
+
+        # INITIALIZE and wait until the device answers instead of sleeping
+        epOut.write(bytearray([0x01]))
+        if not _waitUntilReady(epOut, epIn):
+                raise TransferError("Device does not answer after INITIALIZE")
+
+        serNr = _queryDevice(epOut, epIn, 0x00, "str")
+        info = None
+        if self.useCache:
+                info = self.deviceCache.load(serNr)
+        if info == None:
+                info = {'coefficients' : [_queryDevice(epOut, epIn, i, "num") for i in (0x01, 0x02, 0x03, 0x04)] + [0.0, 0.0],
+                        'sensorName'   : ''}
+                self.deviceCache.store(serNr, info)
+        return serNr, info, dev
 
     def _query(self, byte, decode=None):
-        self.ep1Out.write(chr(0x05) + chr(byte))
-        res = self.ep1In.read(64)
-        if   decode == 'str':
-            s   = ''.join(map(chr,res[2:])).rstrip()
-            res = s.replace('\x00','')
-            res = res.replace('\xa4','')
-        elif decode == 'num':
-            s   = ''.join(map(chr,res[2:])).rstrip()
-            res = s.replace('\x00','')
-            res = res.replace('\xa4','')  #FIXME: ??
-            res = float(res)
-        return res
+        return _queryDevice(self.ep1Out, self.ep1In, byte, decode)
 
-    def setIntegrationTime(self, intTime, test=True):
+    def setIntegrationTime(self, intTime, test=True, force=False):
         # integration_time possible values between 10 - 65535000 (in usec)
+        # The last integration time the device confirmed is remembered, setting
+        # it again does not touch the device unless force is True.
         if (intTime < 10) or  (intTime > 65535000):
-                print ("USB4000.setIntegrationTime : Integration Time not allowed! please use vaues between")
-                print ("10 and 65535000 µs")
+                self._log("USB4000.setIntegrationTime : Integration Time not allowed! please use vaues between")
+                self._log("10 and 65535000 µs")
                 return False
+        if not force and intTime == self._confirmedIntTime:
+                self.integrationTime = intTime
+                return True
+        self._confirmedIntTime = None
+        startT = time.time()
         while True:
                 if   self.usedInterface == 'pyusb':
                         c = []
@@ -304,20 +1228,20 @@ class USB4000: ## GUI OoUSB4000 ## Adds this device to the spectrometers listed
                         c.append((intTime >>  8) & 0xFF )
                         c.append((intTime >> 16) & 0xFF )
                         c.append((intTime >> 24) & 0xFF )
-                        self.ep1Out.write(chr(0x02) + bytearray(c))
+                        self.ep1Out.write(bytearray([0x02]) + bytearray(c))
                 else:
-                        print ("Interface not yet implemented")
-                        sys.exit()
+                        self._writeKernelAttribute("integration_time", intTime)
 
                 if not test:
                         break
-                time.sleep(.01)
                 devIT = self.getIntegrationTime()
-                print "setIntTime : %d  ----  deviceIntTime : %d" % (devIT, intTime)
                 if devIT == intTime:
+                        self._confirmedIntTime = intTime
                         break
+                self._log("setIntTime : %d  ----  deviceIntTime : %d" % (devIT, intTime))
                 if (time.time() - startT) > 1.0:
                         return False
+                time.sleep(.001)
         self.integrationTime = intTime
         return True
 
@@ -326,7 +1250,7 @@ class USB4000: ## GUI OoUSB4000 ## Adds this device to the spectrometers listed
         if   self.usedInterface == 'pyusb':
 
                 startT = time.time()
-                self.ep1Out.write(chr(0xfe))
+                self.ep1Out.write(bytearray([0xfe]))
                 res    = self.ep1In.read(64)
                 #while len(res) <> 4:
                         #print("--------------------------------- getIntegrationTime -- Answer incorrect (too long or too short)!")
@@ -336,17 +1260,206 @@ class USB4000: ## GUI OoUSB4000 ## Adds this device to the spectrometers listed
                                 #raise
                 intTime = (res[5] << 24) + (res[4] << 16) + (res[3] << 8) + res[2]
         elif self.usedInterface == 'kernel':
-                print ("Interface not yet implemented")
-                sys.exit()
+                with open(os.path.join(self.basePath, "integration_time")) as f:
+                        intTime = int(f.read())
         return intTime
 
+    def _writeKernelAttribute(self, name, value):
+        with open(os.path.join(self.basePath, name), "w") as f:
+                f.write("%d\n" % (value))
+
+    def autoExpose(self, target = 0.8, tolerance = 0.05, startTime = None, maxFrames = 8,
+                   pixels = None, maxCount = 65535, saturationLevel = None,
+                   minTime = 10, maxTime = 65535000, maxStep = 20.0):
+        """Find the integration time that puts the peak at target * maxCount.
+
+        Above the electrical dark level (mean of the masked pixels, see
+        getPixelLayout) the counts grow about linearly with the integration time, so every frame
+        predicts the next time directly and it usually takes two or three
+        frames. A saturated frame shortens the time well below the
+        prediction, a frame without signal above the dark noise lengthens it
+        by maxStep. pixels restricts the peak search (a slice, the active
+        pixels by default), the result is left set on the device. Returns an
+        AutoExposure.
+        """
+        if saturationLevel == None:
+                saturationLevel = 0.99 * maxCount
+        intTime = int(startTime or self.integrationTime or 10000)
+        # set before the layout is read, getFrame needs an integration time
+        self.setIntegrationTime(intTime)
+        darkPixels, window = self.getPixelLayout()
+        if pixels == None:
+                pixels = window
+
+        frame = None
+        for n in range(1, maxFrames + 1):
+                self.setIntegrationTime(intTime)
+                frame  = self.getFrame(copy = False)
+                counts = frame.counts
+                dark   = float(counts[darkPixels].mean())
+                noise  = float(counts[darkPixels].std()) + 1.0
+                raw    = float(counts[pixels].max())
+                peak   = raw - dark
+                wanted = target * maxCount - dark
+
+                if raw >= saturationLevel:
+                        # the real peak is unknown, only that it is too high
+                        newTime = intTime * min(wanted / peak, 1.0) * 0.5
+                elif peak < 5 * noise:
+                        # nothing but dark, the prediction would be noise
+                        newTime = intTime * maxStep
+                else:
+                        if abs(peak - wanted) <= tolerance * wanted:
+                                return AutoExposure(intTime, peak, n, True, counts.copy())
+                        newTime = intTime * wanted / peak
+                newTime = int(round(min(max(newTime, intTime / maxStep, minTime), intTime * maxStep, maxTime)))
+                if newTime == intTime:
+                        # clamped, nothing more to gain
+                        break
+                intTime = newTime
+        return AutoExposure(self.integrationTime, peak, n, False, frame.counts.copy())
+
     def getSensorName(self):
         return self.sensorName
 
     def getSerialNumber(self):
         return self.serialNumber
 
-    def getSpectrum(self, timeout = None):
+    def enableCorrection(self, nonlinearity = True, **kwargs):
+        """Let getSpectrum return corrected spectra.
+
+        Creates a DetectorCorrection (keyword arguments are passed on) using
+        the nonlinearity coefficients of the device, subtracting the mean of
+        the masked pixels and trimming to the active pixels (see
+        getPixelLayout). Returns the correction, which can also be applied to
+        streamed batches directly.
+        """
+        coeffs = None
+        if nonlinearity:
+                coeffs = self.getNonlinearityCoefficients()
+        if 'darkPixels' not in kwargs or 'window' not in kwargs:
+                darkPixels, window = self.getPixelLayout()
+                kwargs.setdefault('darkPixels', darkPixels)
+                kwargs.setdefault('window', window)
+        self.correction = DetectorCorrection(nonlinearity = coeffs, **kwargs)
+        return self.correction
+
+    def disableCorrection(self):
+        self.correction = None
+
+    def enableMeasurement(self, nonlinearity = True, wavelengthRange = None, **kwargs):
+        """Set up transmittance and absorbance measurements.
+
+        Creates a TransmissionMeasurement (keyword arguments are passed on)
+        linearizing with the nonlinearity coefficients of the device. The
+        output covers the active pixels (see getPixelLayout), or only those
+        within wavelengthRange (min, max in nm). Returns the measurement, which can
+        also be applied to streamed or recorded batches directly.
+        """
+        coeffs = None
+        if nonlinearity:
+                coeffs = self.getNonlinearityCoefficients()
+        if wavelengthRange != None:
+                kwargs['window'] = self._pixelWindow(wavelengthRange)
+        elif 'window' not in kwargs:
+                kwargs['window'] = self.getPixelLayout()[1]
+        self.measurement = TransmissionMeasurement(nonlinearity = coeffs, **kwargs)
+        return self.measurement
+
+    def _pixelWindow(self, wavelengthRange):
+        # frame indices inside the wavelength range (clipped to the active pixels)
+        window = self.getPixelLayout()[1]
+        low, high = sorted(wavelengthRange)
+        wavelengths = self.calibration.wavelengths
+        if high < wavelengths.min() or low > wavelengths.max():
+                raise ValueError("Wavelength range %g - %g nm is outside the calibration (%.1f - %.1f nm)"
+                                 % (low, high, wavelengths.min(), wavelengths.max()))
+        first, last = self.calibration.pixelOf([low, high])
+        first = window.start if np.isnan(first) else max(int(np.ceil(first)), window.start)
+        last  = window.stop - 1 if np.isnan(last) else min(int(np.floor(last)), window.stop - 1)
+        if last < first:
+                raise ValueError("No active pixel within %g - %g nm" % (low, high))
+        return slice(first, last + 1)
+
+    def getPixelLayout(self, timeout = None):
+        """(darkPixels, window): slices of the masked and of the active pixels
+        of the raw frames (see frameLayout). The first call reads them from
+        the header of a frame, so call it before startStreaming.
+        """
+        if self._pixelLayout == None:
+                if timeout == None and self.integrationTime == None:
+                        # not set yet, the device knows what it integrates
+                        timeout = self.getIntegrationTime() / 1000000.0 * 2.1
+                # a device that is not ready sends an empty header
+                for i in range(3):
+                        frame = self.getFrame(timeout, copy = False)
+                        if frame == None:
+                                raise ValueError("no frame to take the pixel layout from")
+                        try:
+                                self._pixelLayout = frameLayout(frame.counts)
+                                break
+                        except ValueError as e:
+                                error = e
+                else:
+                        raise error
+        return self._pixelLayout
+
+    def _frames(self, n, timeout):
+        for i in range(n):
+                yield self.getFrame(timeout, copy = False).counts
+
+    def captureDark(self, frames = 10, timeout = None):
+        """Average frames raw spectra into the dark spectrum for the current
+        integration time (enableMeasurement is called if needed)."""
+        if self.measurement == None:
+                self.enableMeasurement()
+        return self.measurement.setDark(self._frames(frames, timeout), self.integrationTime)
+
+    def captureReference(self, frames = 10, timeout = None):
+        """Average frames raw spectra into the reference spectrum for the
+        current integration time."""
+        if self.measurement == None:
+                self.enableMeasurement()
+        return self.measurement.setReference(self._frames(frames, timeout), self.integrationTime)
+
+    def isReferenceStale(self):
+        """True if dark or reference have to be taken (again) for the current
+        integration time, see TransmissionMeasurement.isStale."""
+        return self.measurement == None or self.measurement.isStale(self.integrationTime)
+
+    def getTransmittance(self, out = None, timeout = None):
+        """Acquire one frame and return its transmittance (float32, written
+        to out if given). Raises ValueError without dark and reference."""
+        if self.measurement == None:
+                raise ValueError("no dark and reference spectrum, see captureDark and captureReference")
+        counts = self.getFrame(timeout, copy = False).counts
+        return self.measurement.transmittance(counts, self.integrationTime, out)
+
+    def getAbsorbance(self, out = None, timeout = None):
+        """Acquire one frame and return its absorbance (float32, written to
+        out if given). Raises ValueError without dark and reference."""
+        if self.measurement == None:
+                raise ValueError("no dark and reference spectrum, see captureDark and captureReference")
+        counts = self.getFrame(timeout, copy = False).counts
+        return self.measurement.absorbance(counts, self.integrationTime, out)
+
+    def getNonlinearityCoefficients(self):
+        """Nonlinearity polynomial (constant term first) from the EEPROM.
+
+        Read once and kept in the device cache. None if the interface cannot
+        query the EEPROM.
+        """
+        if self.usedInterface != 'pyusb':
+                return None
+        coeffs = self.deviceInfo.get('nonlinearity')
+        if coeffs == None:
+                order  = min(int(self._query(0x0e, "num")), 7)
+                coeffs = [self._query(0x06 + i, "num") for i in range(order + 1)]
+                self.deviceInfo['nonlinearity'] = coeffs
+                self.deviceCache.store(self.serialNumber, self.deviceInfo)
+        return coeffs
+
+    def getSpectrum(self, timeout = None, copy = True):
         """This function grabs spectral data from the spectrometer. Addidtional
         information is also encoded in the data read from the interface so
         take nothing for granted!
@@ -391,53 +1504,534 @@ class USB4000: ## GUI OoUSB4000 ## Adds this device to the spectrometers listed
         The wavelength correctness was VERY good compared to spectrometers from avantes,
         ocean optics and trios. We estimat an offset of about .4 nm over the whole spectrum
         which lies in the tolerance of of our measurement setup.
+
+        Returns the uint16 counts of all PIXEL_COUNT_USB4000 pixels (header
+        included) or None if the interface cannot deliver spectra. With
+        copy=False the array is a view into a buffer that is reused by the next
+        call. Use getFrame to get the decoded header fields as well.
+
+        With a correction enabled (see enableCorrection) the result is the
+        corrected float32 spectrum instead.
+        """
+        frame = self.getFrame(timeout, copy and self.correction == None)
+        if frame == None:
+                return None
+        if self.correction != None:
+                return self.correction(frame.counts, copy = copy)
+        return frame.counts
+
+    def getFrame(self, timeout = None, copy = True):
+        """Grab one frame and return it as a SpectrumFrame.
+
+        The packets are read into preallocated transfer buffers and decoded as
+        little-endian uint16 without any per-pixel Python work. With copy=False
+        the counts are a view into the reusable frame buffer.
         """
+        if timeout == None:
+                timeout = self.integrationTime / 1000000.0 * 2.1
 
+        #: Grab data from the interface
+        if self.usedInterface not in ('pyusb', 'kernel'):
+                return None
+
+        startT = self._requestFrame()
+        return self._readFrame(startT, timeout, copy)
+
+    def _requestFrame(self):
+        # ask for the data, returns the time of the request
+        # (the kernel driver starts the acquisition when the device is read)
+        startT = time.time()
+        if self.usedInterface == 'pyusb':
+                t0 = _clock()
+                self.ep1Out.write(bytearray([0x09]))
+                if self.instrumentation != None:
+                        self.instrumentation.record('write', _clock() - t0)
+        return startT
+
+    def _readFrame(self, startT, timeout, copy = True):
+        inst = self.instrumentation
+        t0 = _clock()
+        if self.usedInterface == 'kernel':
+                t1 = self._readKernelFrame(startT, timeout)
+        else:
+                # the first read waits until the integration is finished
+                while 1:
+                        try:
+                                n = self.ep6.read(self._ep6Buffer)
+                        except IOError:
+                                if (time.time() - startT) > timeout:
+                                        if inst != None:
+                                                inst.count('timeouts')
+                                        raise TransferError("Timeout")
+                                if inst != None:
+                                        inst.count('retries')
+                                time.sleep(.01)
+                                continue
+                        else:
+                                break
+                t1 = _clock()
+                if n != len(self._ep6Buffer):
+                        if inst != None:
+                                inst.count('shortReads')
+                        raise TransferError("Short read on ep6 (%d bytes)" % (n))
+                n = self.ep2.read(self._ep2Buffer)
+                if n != len(self._ep2Buffer):
+                        if inst != None:
+                                inst.count('shortReads')
+                        raise TransferError("Short read on ep2 (%d bytes)" % (n))
+                self.ep2.read(self._syncBuffer)
+
+                ep6Pixels = len(self._ep6Counts)
+                self._frameBuffer[:ep6Pixels] = self._ep6Counts
+                self._frameBuffer[ep6Pixels:] = self._ep2Counts
+        t2 = _clock()
+        frame = decodeFrame(self._frameBuffer, copy)
+        if inst != None:
+                t3 = _clock()
+                inst.record('wait', t1 - t0)
+                inst.record('transfer', t2 - t1)
+                inst.record('decode', t3 - t2)
+                inst.count('frames')
+        return frame
+
+    def _readKernelFrame(self, startT, timeout, target = None):
+        # one frame from the device node, read into the frame buffer itself
+        # (or target); returns the clock when the first data arrived
+        inst = self.instrumentation
+        if target == None:
+                target = self._frameBytes
+        size = len(target)
+        got  = 0
+        first = None
+        while got < size:
+                remaining = timeout - (time.time() - startT)
+                if remaining <= 0 or not select.select([self._devFile], [], [], remaining)[0]:
+                        if inst != None:
+                                inst.count('timeouts')
+                        raise TransferError("Timeout")
+                if first == None:
+                        first = _clock()
+                n = self._devFile.readinto(target[got:])
+                if not n:
+                        if inst != None:
+                                inst.count('shortReads')
+                        raise TransferError("Short read on %s (%d bytes)" % (self.devicePath, got))
+                got += n
+        return first
+
+    def captureBurst(self, frames, integrationTime = None, out = None, timeout = None):
+        """Capture frames back to back at a fixed integration time (usec,
+        the current one if None) and return a BurstCapture.
+
+        The counts go into out (frames x PIXEL_COUNT_USB4000 uint16, allocated
+        if None) and nothing but the transfers runs between the frames: no
+        decoding, correction or instrumentation timers. Process the burst
+        once it is complete, e.g. spec.correction(burst.counts) corrects all
+        frames in one call.
+
+        The requests cannot be queued ahead: the USB4000 holds one spectrum
+        for the host, and a request written before it has been read replaces
+        it (USB4000Simulator does the same). The frame rate is therefore
+        bound by integration plus transfer time like a getFrame loop; what
+        the burst saves is the work on the host. Over pyusb the next request
+        goes out as soon as a frame is read, and the frame is copied out of
+        the staging buffers while the device integrates the next one; the
+        kernel driver requests every frame itself when it is read.
+
+        Raises TransferError if a frame fails; the frames
+        before it are in out. Raises ValueError if frames is less than one or
+        the integration time is unknown or cannot be set.
+        """
+        if frames < 1:
+                raise ValueError("A burst needs at least one frame, got %d" % (frames))
+        if self.usedInterface not in ('pyusb', 'kernel'):
+                return None
+        if integrationTime != None and integrationTime != self.integrationTime:
+                if not self.setIntegrationTime(integrationTime):
+                        raise ValueError("Integration time %d us could not be set" % (integrationTime))
+        if self.integrationTime == None:
+                raise ValueError("set the integration time before a burst")
         if timeout == None:
                 timeout = self.integrationTime / 1000000.0 * 2.1
+        if out is None:
+                out = np.empty((frames, PIXEL_COUNT_USB4000), dtype = FRAME_DTYPE)
+        elif out.shape != (frames, PIXEL_COUNT_USB4000) or out.dtype != FRAME_DTYPE or not out.flags.c_contiguous:
+                raise ValueError("out has to be a contiguous (%d, %d) uint16 array" % (frames, PIXEL_COUNT_USB4000))
+        requested = np.zeros(frames)
+        completed = np.zeros(frames)
+        startTime = time.time()
+        if self.usedInterface == 'kernel':
+                self._kernelBurst(out, requested, completed, timeout)
+        else:
+                self._pyusbBurst(out, requested, completed, timeout)
+        if self.instrumentation != None:
+                self.instrumentation.count('frames', frames)
+        return BurstCapture(out, requested, completed, self.integrationTime, startTime)
+
+    def _kernelBurst(self, out, requested, completed, timeout):
+        # the rows are read from the device node in place
+        data = memoryview(out.view(np.uint8).reshape(-1))
+        size = out.shape[1] * out.itemsize
+        for i in range(len(out)):
+                requested[i] = _clock()
+                self._readKernelFrame(time.time(), timeout, data[i * size:(i + 1) * size])
+                completed[i] = _clock()
+
+    def _pyusbBurst(self, out, requested, completed, timeout):
+        # _readFrame without the decoding, timers and retry sleeps; the
+        # staging buffers are copied into the rows of out after the request
+        # of the next frame (see captureBurst)
+        write, ep6Read, ep2Read = self.ep1Out.write, self.ep6.read, self.ep2.read
+        ep6Buffer, ep2Buffer, syncBuffer = self._ep6Buffer, self._ep2Buffer, self._syncBuffer
+        ep6Counts, ep2Counts = self._ep6Counts, self._ep2Counts
+        ep6Pixels = len(ep6Counts)
+        request = bytearray([0x09])
+        requested[0] = _clock()
         startT = time.time()
+        write(request)
+        for i in range(len(out)):
+                while 1:
+                        try:
+                                n = ep6Read(ep6Buffer)
+                        except IOError:
+                                if (time.time() - startT) > timeout:
+                                        raise TransferError("Timeout in frame %d of the burst" % (i))
+                                continue
+                        else:
+                                break
+                if n != len(ep6Buffer):
+                        raise TransferError("Short read on ep6 (%d bytes) in frame %d of the burst" % (n, i))
+                n = ep2Read(ep2Buffer)
+                if n != len(ep2Buffer):
+                        raise TransferError("Short read on ep2 (%d bytes) in frame %d of the burst" % (n, i))
+                ep2Read(syncBuffer)
+                if i + 1 < len(out):
+                        requested[i + 1] = _clock()
+                        startT = time.time()
+                        write(request)
+                row = out[i]
+                row[:ep6Pixels] = ep6Counts
+                row[ep6Pixels:] = ep2Counts
+                completed[i] = _clock()
+
+    def enableInstrumentation(self, instrumentation = None):
+        """Time the stages of every acquisition and count USB retries,
+        timeouts and short reads (see Instrumentation). Returns the
+        Instrumentation in use; pass one to share it between devices.
+        """
+        if instrumentation == None:
+                instrumentation = Instrumentation()
+        self.instrumentation = instrumentation
+        return instrumentation
+
+    def disableInstrumentation(self):
+        self.instrumentation = None
+
+    def getInstrumentationStats(self):
+        """Snapshot of the instrumentation as a plain dict, None if disabled."""
+        if self.instrumentation == None:
+                return None
+        return self.instrumentation.snapshot()
+
+    def startStreaming(self, frames = 100, overwrite = True, blockTimeout = None):
+        """Acquire continuously on a background thread.
+
+        The frames go into a FrameRingBuffer holding the given amount of
+        frames (see there for overwrite and blockTimeout). Read them with
+        iterFrames, getLatestFrames or directly from the returned ring. The
+        thread owns the endpoints, so do not call getSpectrum while streaming.
+        """
+        if self._streamThread != None and self._streamThread.is_alive():
+                self._log("USB4000.startStreaming : Already streaming!")
+                return None
+        if self.integrationTime == None:
+                raise ValueError("set the integration time before streaming")
+        self.stream = FrameRingBuffer(frames, PIXEL_COUNT_USB4000, overwrite, blockTimeout)
+        self._streamStop.clear()
+        self._streamThread = threading.Thread(target = self._streamLoop, name = "USB4000-%s" % (self.serialNumber))
+        self._streamThread.daemon = True
+        self._streamThread.start()
+        return self.stream
+
+    def stopStreaming(self, timeout = None):
+        """Stop the acquisition thread. Frames still in the ring can be read afterwards."""
+        if self._streamThread == None:
+                return
+        self._streamStop.set()
+        self.stream.close()
+        self._streamThread.join(timeout)
+        self._streamThread = None
+
+    def isStreaming(self):
+        return self._streamThread != None and self._streamThread.is_alive()
+
+    def iterFrames(self, timeout = None):
+        """Yield StreamedFrames in acquisition order until streaming stops or
+        no frame arrived within timeout seconds.
+        """
+        if self.stream == None:
+                return
         while 1:
-                #: Grab data from the interface
-                if self.usedInterface == 'pyusb':
-                        # ask for the data
-                        self.ep1Out.write(chr(0x09))
-                        resArr = np.zeros(256 * 15)
-                        resArrIndex = 0
-                        # read four times from endpoint 6 an four times from ep2
-                        while 1:
-                                try:
-                                        res = self.ep6.read(512)
-                                except usb.core.USBError:
-                                        if (time.time() - startT) > timeout:
-                                                raise usb.core.USBError("Timeout")
-                                        time.sleep(.01)
-                                        continue
-                                else:
-                                        break
-
-                        for i in range(0,len(res),2):
-                                resArr[resArrIndex] = (res[i+1] << 8) + res[i]
-                                resArrIndex += 1
-
-
-                        for i in range(3):
-                            res = self.ep6.read(512)
-                            for i in range(0,len(res),2):
-                                resArr[resArrIndex] = (res[i+1] << 8) + res[i]
-                                resArrIndex += 1
-                        for i in range(4,15):
-                            res = self.ep2.read(512)
-                            for i in range(0,len(res),2):
-                                resArr[resArrIndex] = (res[i+1] << 8) + res[i]
-                                resArrIndex += 1
-                        sync_packet = self.ep2.read(1)
-                        return resArr
-                else:
-                        return None
+                frame = self.stream.get(timeout)
+                if frame == None:
+                        return
+                yield frame
+
+    def getLatestFrames(self, n = 1):
+        """(counts, timestamps, sequence) of the newest n streamed frames."""
+        return self.stream.latest(n)
+
+    def getStreamingStats(self):
+        return self.stream.stats()
+
+    def _streamLoop(self):
+        ring = self.stream
+        try:
+                while not self._streamStop.is_set():
+                        try:
+                                frame = self.getFrame(copy = False)
+                        except IOError:
+                                ring.errors += 1
+                                continue
+                        if frame == None:
+                                break
+                        ring.put(frame.counts, time.time())
+        finally:
+                # consumers must not wait forever for a thread that died
+                ring.close()
+
+    def _allocateFrameBuffers(self):
+        # pyusb only reads into array.array objects, so the packets land in
+        # these staging buffers. The numpy views on them are created once and
+        # the frame is assembled in self._frameBuffer, which is reused as well.
+        self._ep6Buffer   = array.array('B', [0]) * (USB4000_PACKET_SIZE * USB4000_EP6_PACKETS)
+        self._ep2Buffer   = array.array('B', [0]) * (USB4000_PACKET_SIZE * USB4000_EP2_PACKETS)
+        self._syncBuffer  = array.array('B', [0])
+        self._ep6Counts   = np.frombuffer(self._ep6Buffer, dtype = FRAME_DTYPE)
+        self._ep2Counts   = np.frombuffer(self._ep2Buffer, dtype = FRAME_DTYPE)
+        self._frameBuffer = np.zeros(PIXEL_COUNT_USB4000, dtype = FRAME_DTYPE)
+        # the kernel driver reads into the frame buffer through this view
+        self._frameBytes  = memoryview(self._frameBuffer.view(np.uint8))
+
+
+class PoolFrames(namedtuple('PoolFrames', 'counts timestamps serialNumbers')):
+    """Result of one SpectrometerPool cycle.
+
+    counts is devices x PIXEL_COUNT_USB4000, timestamps is devices x 2 holding
+    the time each worker requested and received its frame.
+    """
+    __slots__ = ()
+
+    @property
+    def skew(self):
+        # spread of the frame completion times over all devices in seconds
+        return float(self.timestamps[:, 1].max() - self.timestamps[:, 1].min())
+
+
+def _listDevices(queue, devices, transport):
+    # runs in a child process so the parent never touches the USB stack;
+    # sends the transport used and serial number -> locator of every device
+    try:
+            spec = USB4000(devices = devices, transport = transport)
+    except SystemExit:
+            queue.put((None, {}))
+            return
+    queue.put((spec.transport, dict((serNr, _deviceLocator(spec, serNr, devices)) for serNr in spec.specs)))
+
+
+def _deviceLocator(spec, serialNumber, devices):
+    # how a pool worker gets at its device without touching the others:
+    # the index in devices, the bus and address for pyusb (which INITIALIZEs
+    # and claims every device it finds) or None if the transport can open a
+    # single device by serial number anyway
+    if devices != None:
+            dev = spec.specs[serialNumber][3]
+            return ('index', [i for i, d in enumerate(devices) if d is dev][0])
+    if spec.transport == 'pyusb':
+            dev = spec.specs[serialNumber][3]
+            return ('bus', dev.bus, dev.address)
+    return None
+
+
+def _locateDevices(locator, devices):
+    # the devices argument of the USB4000 opened by a pool worker
+    if locator == None:
+            return None
+    if locator[0] == 'index':
+            return [devices[locator[1]]]
+    import usb.core
+    return list(usb.core.find(idVendor = USB_USBSPEC_VENDOR_ID, idProduct = USB_USBSPEC_PRODUCT_ID_USB4000,
+                              bus = locator[1], address = locator[2], find_all = True))
+
+
+def _poolWorker(index, serialNumber, locator, devices, transport, frames, timestamps, cycle, cond, intTime, results):
+    try:
+            spec = USB4000(serialNumber, devices = _locateDevices(locator, devices), transport = transport)
+    except SystemExit:
+            results.put((index, 0, "Device %s could not be opened" % (serialNumber)))
+            return
+    counts = np.ctypeslib.as_array(frames).reshape(-1, PIXEL_COUNT_USB4000)[index]
+    times  = np.ctypeslib.as_array(timestamps).reshape(-1, 2)[index]
+    results.put((index, 0, None))
+
+    lastCycle = 0
+    currentIntTime = None
+    while True:
+            with cond:
+                    while cycle.value == lastCycle:
+                            cond.wait()
+                    lastCycle = cycle.value
+            if lastCycle < 0:
+                    break
+            if intTime.value != currentIntTime:
+                    currentIntTime = intTime.value
+                    spec.setIntegrationTime(currentIntTime)
+            error = None
+            times[0] = time.time()
+            try:
+                    counts[:] = spec.getSpectrum(copy = False)
+            except IOError as e:
+                    error = str(e)
+            times[1] = time.time()
+            results.put((index, lastCycle, error))
+
+
+class SpectrometerPool:
+    """Acquire from several USB4000 at the same time, one process per device.
+
+    The devices are searched once in a child process, then every worker
+    opens only its own spectrometer and writes its frames into one shared
+    (devices x pixels) array, so no spectrum is ever pickled. All workers are
+    triggered together by bumping a shared cycle counter. Without serial
+    numbers every connected spectrometer is used. devices and transport are
+    passed on to USB4000 (e.g. simulated devices).
+    """
+
+    def __init__(self, serialNumbers = None, integrationTime = 100000, verbose = False, devices = None,
+                 transport = None):
+        self.verbose = verbose
+        self._devices = list(devices) if devices != None else None
+        self._transportName, self._locators = self._discover(self._devices, transport)
+        if serialNumbers == None:
+                serialNumbers = sorted(self._locators)
+        self.serialNumbers = list(serialNumbers)
+        n = len(self.serialNumbers)
+
+        # imported here, it is the slowest import of the module
+        import multiprocessing, ctypes
+
+        self._frames     = multiprocessing.RawArray(ctypes.c_uint16, n * PIXEL_COUNT_USB4000)
+        self._timestamps = multiprocessing.RawArray(ctypes.c_double, n * 2)
+        self.counts      = np.ctypeslib.as_array(self._frames).reshape(n, PIXEL_COUNT_USB4000)
+        self.timestamps  = np.ctypeslib.as_array(self._timestamps).reshape(n, 2)
+
+        self._cycle   = multiprocessing.RawValue(ctypes.c_long, 0)
+        self._intTime = multiprocessing.RawValue(ctypes.c_long, integrationTime)
+        self._cond    = multiprocessing.Condition()
+        self._results = multiprocessing.Queue()
+        self._workers = []
+        #: index -> error message of the devices that failed in the last cycle
+        self.errors   = {}
+
+    def _discover(self, devices, transport):
+        import multiprocessing
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target = _listDevices, args = (queue, devices, transport))
+        p.start()
+        found = queue.get()
+        p.join()
+        return found
+
+    def start(self, timeout = 10.0):
+        """Start one worker per device and wait until all of them are ready."""
+        import multiprocessing
+        missing = [serialNumber for serialNumber in self.serialNumbers if serialNumber not in self._locators]
+        if missing:
+                self.errors = dict((self.serialNumbers.index(serialNumber), "Device %s not found" % (serialNumber))
+                                   for serialNumber in missing)
+                self._log("SpectrometerPool.start : Devices %s not found!" % (", ".join(missing)))
+                return False
+        for index, serialNumber in enumerate(self.serialNumbers):
+                p = multiprocessing.Process(target = _poolWorker,
+                                            args = (index, serialNumber, self._locators[serialNumber], self._devices,
+                                                    self._transportName, self._frames, self._timestamps,
+                                                    self._cycle, self._cond, self._intTime, self._results),
+                                            name = "USB4000-%s" % (serialNumber))
+                p.daemon = True
+                p.start()
+                self._workers.append(p)
+        try:
+                answers = self._collect(0, timeout)
+        except IOError:
+                self._log("SpectrometerPool.start : Not all spectrometers reported back in time!")
+                self.close()
+                return False
+        self.errors = dict((index, error) for index, error in answers if error != None)
+        for index, error in self.errors.items():
+                self._log("SpectrometerPool.start : %s" % (error))
+        if self.errors:
+                self.close()
+                return False
+        return True
+
+    def _log(self, message):
+        if self.verbose:
+                print (message)
 
-        return resArr
+    def setIntegrationTime(self, intTime):
+        """Takes effect with the next acquire() on every device."""
+        self._intTime.value = intTime
 
+    def acquire(self, timeout = None, copy = True):
+        """Trigger all devices and wait until each delivered its frame.
 
+        Returns a PoolFrames. With copy=False counts and timestamps are the
+        shared arrays that the next cycle overwrites. Failed devices are
+        reported in self.errors (index -> message) and keep their old row.
+        """
+        if timeout == None:
+                timeout = self._intTime.value / 1000000.0 * 2.1 + 1.0
+        with self._cond:
+                self._cycle.value += 1
+                cycle = self._cycle.value
+                self._cond.notify_all()
+        self.errors = dict((index, error) for index, error in self._collect(cycle, timeout) if error != None)
+        if copy:
+                return PoolFrames(self.counts.copy(), self.timestamps.copy(), self.serialNumbers)
+        return PoolFrames(self.counts, self.timestamps, self.serialNumbers)
+
+    def _collect(self, cycle, timeout):
+        deadline = time.time() + timeout
+        answers  = []
+        while len(answers) < len(self._workers):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                        raise TransferError("Timeout")
+                try:
+                        index, answerCycle, error = self._results.get(True, remaining)
+                except queue.Empty:
+                        raise TransferError("Timeout")
+                if answerCycle == cycle:
+                        answers.append((index, error))
+        return answers
+
+    def close(self, timeout = 2.0):
+        with self._cond:
+                self._cycle.value = -1
+                self._cond.notify_all()
+        for p in self._workers:
+                p.join(timeout)
+                if p.is_alive():
+                        p.terminate()
+        self._workers = []
+
+    def __enter__(self):
+        if not self.start():
+                raise RuntimeError("SpectrometerPool could not be started")
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 
@@ -473,10 +2067,10 @@ if __name__ == '__main__':
 
         ham = USB4000()
 
-        print ham.findAllConnectedSpectrometers()
+        print (ham.findAllConnectedSpectrometers())
 
         ham.setIntegrationTime(10000000)
         res = ham.getSpectrum()
-        print res
+        print (res)
 
         #sys.exit()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python -w
+# -*- coding: UTF-8 -*-
+
+# Vectorized peak search and tracking on batches of spectra.
+#
+# PeakFinder works on (frames x pixels) arrays: raw counts from
+# getLatestFrames or a SpectrumRecording slice as well as corrected spectra.
+# The search is done for the whole batch at once, the result is a Peaks tuple
+# of flat arrays with one entry per peak (ordered by frame, then pixel).
+# PeakTracker follows the peaks from batch to batch and assigns every peak
+# the id of the track it belongs to.
+#
+#   tracker = PeakTracker(PeakFinder.forSpectrometer(spec, minProminence = 500))
+#   spec.startStreaming()
+#   while True:
+#           counts, timestamps, sequence = spec.getLatestFrames(100)
+#           peaks = tracker.update(counts)
+#
+#   rec = SpectrumRecording("run1.spec")
+#   peaks = PeakTracker(PeakFinder(rec.calibration, minProminence = 500)).update(rec.counts)
+
+from collections import namedtuple
+import numpy as np
+
+
+class Peaks(namedtuple('Peaks', 'frame pixel position height prominence fwhm')):
+    """Peaks found in a batch, one array entry per peak.
+
+    frame is the row of the batch, pixel the sub-pixel frame index of the
+    maximum and height the interpolated height there. position and fwhm are
+    in nm if the finder has a calibration, otherwise in pixels.
+    """
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.frame)
+
+
+class TrackedPeaks(namedtuple('TrackedPeaks', 'frame pixel position height prominence fwhm track')):
+    """Peaks with the id of the track each peak was assigned to; frame counts
+    all frames the tracker has seen."""
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.frame)
+
+
+def _slidingMin(values, length):
+    # minimum of values[..., i - length + 1 : i + 1], the window is
+    # truncated at the start; log2(length) passes of np.minimum
+    res  = values.copy()
+    tmp  = np.empty_like(values)
+    span = 1
+    while span < length:
+            step = min(span, length - span)
+            np.minimum(res[..., step:], res[..., :-step], out = tmp[..., step:])
+            tmp[..., :step] = res[..., :step]
+            res, tmp = tmp, res
+            span += step
+    return res
+
+
+class PeakFinder:
+    """Peak search on a batch of spectra.
+
+    A peak is a local maximum of at least minHeight whose prominence is at
+    least minProminence and whose full width at half prominence is between
+    minWidth and maxWidth pixels. The prominence is measured against the
+    higher of the two minima left and right of the peak, each taken up to
+    the next higher pixel but at most wlen pixels (like
+    scipy.signal.find_peaks with wlen). The maximum is refined with a
+    parabola through the three highest pixels.
+
+    pixels restricts the search to these columns of the spectra (a slice),
+    firstPixel is the frame index of the first column, e.g. the start of the
+    DetectorCorrection window for trimmed spectra.
+    """
+
+    def __init__(self, calibration = None, minProminence = 100.0, minHeight = None, minWidth = 1.0,
+                 maxWidth = None, wlen = 50, pixels = None, firstPixel = 0):
+        self.calibration   = calibration
+        self.minProminence = minProminence
+        self.minHeight     = minHeight
+        self.minWidth      = minWidth
+        self.maxWidth      = maxWidth
+        self.wlen          = int(wlen)
+        self.pixels        = pixels if pixels != None else slice(None)
+        self.firstPixel    = firstPixel
+
+    @classmethod
+    def forSpectrometer(cls, spec, **kwargs):
+        """Finder with the calibration of a USB4000 for the spectra its
+        getSpectrum returns (raw or corrected, see enableCorrection)."""
+        if spec.correction != None:
+                kwargs.setdefault('firstPixel', spec.correction.window.start or 0)
+        else:
+                # only the active pixels of raw frames
+                kwargs.setdefault('pixels', spec.getPixelLayout()[1])
+        return cls(spec.calibration, **kwargs)
+
+    def __call__(self, spectra):
+        """Peaks of a single spectrum or a (frames x pixels) batch."""
+        spectra = np.asarray(spectra)
+        if spectra.ndim == 1:
+                spectra = spectra[np.newaxis]
+        start = self.pixels.indices(spectra.shape[1])[0]
+        s = np.asarray(spectra[:, self.pixels], dtype = np.float32)
+        pixels = s.shape[1]
+
+        # local maxima (the first pixel of a plateau)
+        mid = s[:, 1:-1]
+        mask = (mid > s[:, :-2]) & (mid >= s[:, 2:])
+        if self.minHeight != None:
+                mask &= mid >= self.minHeight
+
+        # the minima within wlen on both sides give an upper bound of the
+        # prominence, which cheaply rules out most of the noise maxima
+        length = self.wlen + 1
+        leftMin  = _slidingMin(s, length)[:, 1:-1]
+        rightMin = _slidingMin(s[:, ::-1], length)[:, ::-1][:, 1:-1]
+        mask &= (mid - np.maximum(leftMin, rightMin)) >= self.minProminence
+        frame, index = np.nonzero(mask)
+        index += 1
+        peak = s[frame, index]
+
+        # the exact prominence only looks as far as the next higher pixel
+        offsets = np.arange(self.wlen + 1)
+        base = np.maximum(self._base(s, frame, index, -offsets, peak, pixels),
+                          self._base(s, frame, index, offsets, peak, pixels))
+        prominence = peak - base
+        keep = prominence >= self.minProminence
+        frame, index, peak, prominence = frame[keep], index[keep], peak[keep], prominence[keep]
+
+        # crossings of half prominence, searched up to wlen pixels outwards
+        level = peak - 0.5 * prominence
+        left  = self._crossing(s, frame, index, -offsets, level, pixels)
+        right = self._crossing(s, frame, index, offsets, level, pixels)
+        width = right - left
+        keep = width >= self.minWidth
+        if self.maxWidth != None:
+                keep &= width <= self.maxWidth
+        frame, index, prominence = frame[keep], index[keep], prominence[keep]
+        left, right = left[keep], right[keep]
+
+        # sub-pixel maximum from a parabola through the neighbours
+        y0 = s[frame, index - 1]
+        y1 = s[frame, index]
+        y2 = s[frame, index + 1]
+        curvature = y0 - 2.0 * y1 + y2
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                delta = np.where(curvature < 0, 0.5 * (y0 - y2) / curvature, 0.0)
+        delta = np.clip(delta, -0.5, 0.5)
+        height = y1 - 0.25 * (y0 - y2) * delta
+
+        offset = start + self.firstPixel
+        pixel  = index + delta + offset
+        if self.calibration != None:
+                position = self.calibration.wavelengthOf(pixel)
+                fwhm = np.abs(self.calibration.wavelengthOf(right + offset) - self.calibration.wavelengthOf(left + offset))
+        else:
+                position = pixel
+                fwhm = right - left
+        return Peaks(frame, pixel, position, height, prominence, fwhm)
+
+    def _base(self, s, frame, index, offsets, peak, pixels):
+        # minimum along offsets from index up to the first pixel higher
+        # than the peak
+        columns = np.clip(index[:, np.newaxis] + offsets, 0, pixels - 1)
+        values  = s[frame[:, np.newaxis], columns]
+        higher  = values > peak[:, np.newaxis]
+        stop = np.where(higher.any(axis = 1), higher.argmax(axis = 1), len(offsets))
+        values[np.arange(len(offsets)) >= stop[:, np.newaxis]] = np.inf
+        return values.min(axis = 1)
+
+    def _crossing(self, s, frame, index, offsets, level, pixels):
+        # first position from index along offsets where s drops below level,
+        # linearly interpolated; the end of the search range if it does not
+        columns = np.clip(index[:, np.newaxis] + offsets, 0, pixels - 1)
+        values  = s[frame[:, np.newaxis], columns]
+        below   = values < level[:, np.newaxis]
+        k = np.where(below.any(axis = 1), below.argmax(axis = 1), len(offsets) - 1)
+        k = np.maximum(k, 1)
+        rows = np.arange(len(k))
+        inner = values[rows, k - 1]
+        outer = values[rows, k]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                frac = np.where(inner > outer, (inner - level) / (inner - outer), 1.0)
+        step = offsets[1] if len(offsets) > 1 else 1
+        return columns[rows, k - 1] + np.clip(frac, 0.0, 1.0) * step
+
+
+class PeakTracker:
+    """Follows peaks across frames.
+
+    Every frame a peak is assigned to the nearest active track within
+    tolerance (nm with a calibration, otherwise pixels), each track takes at
+    most one peak per frame. Unassigned peaks start new tracks, tracks that
+    have not been seen for more than maxMissed frames are dropped.
+    Position, height and fwhm of a track are exponentially smoothed with
+    smoothing (1: the latest peak).
+    """
+
+    def __init__(self, finder, tolerance = 1.0, smoothing = 1.0, maxMissed = 5):
+        self.finder    = finder
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.maxMissed = maxMissed
+        self.frames    = 0
+        self._nextId   = 0
+        self._ids      = np.zeros(0, dtype = np.int64)
+        self._position = np.zeros(0)
+        self._height   = np.zeros(0)
+        self._fwhm     = np.zeros(0)
+        self._first    = np.zeros(0, dtype = np.int64)
+        self._last     = np.zeros(0, dtype = np.int64)
+        self._hits     = np.zeros(0, dtype = np.int64)
+
+    def update(self, spectra):
+        """Search a single spectrum or a batch and track its peaks."""
+        spectra = np.asarray(spectra)
+        frames = 1 if spectra.ndim == 1 else len(spectra)
+        return self.updatePeaks(self.finder(spectra), frames)
+
+    def updatePeaks(self, peaks, frames):
+        """Track the Peaks already found in a batch of frames."""
+        track = np.empty(len(peaks), dtype = np.int64)
+        bounds = np.searchsorted(peaks.frame, np.arange(frames + 1))
+        for f in range(frames):
+                a, b = bounds[f], bounds[f + 1]
+                track[a:b] = self._assign(peaks.position[a:b], peaks.height[a:b], peaks.fwhm[a:b], self.frames + f)
+        first = self.frames
+        self.frames += frames
+        return TrackedPeaks(peaks.frame + first, peaks.pixel, peaks.position, peaks.height,
+                            peaks.prominence, peaks.fwhm, track)
+
+    def _assign(self, position, height, fwhm, frameNo):
+        n = len(position)
+        slot = np.full(n, -1, dtype = np.int64)
+        if n and len(self._ids):
+                order = np.argsort(self._position)
+                sortedPos = self._position[order]
+                j = np.clip(np.searchsorted(sortedPos, position), 1, len(order)) - 1
+                upper = np.minimum(j + 1, len(order) - 1)
+                useUpper = np.abs(sortedPos[upper] - position) < np.abs(sortedPos[j] - position)
+                j = np.where(useUpper, upper, j)
+                dist = np.abs(sortedPos[j] - position)
+                candidates = np.nonzero(dist <= self.tolerance)[0]
+                # the closest peak wins a track
+                candidates = candidates[np.argsort(dist[candidates], kind = 'mergesort')]
+                tracks, unique = np.unique(order[j[candidates]], return_index = True)
+                slot[candidates[unique]] = tracks
+
+        matched = slot >= 0
+        if matched.any():
+                t = slot[matched]
+                a = self.smoothing
+                self._position[t] += a * (position[matched] - self._position[t])
+                self._height[t]   += a * (height[matched] - self._height[t])
+                self._fwhm[t]     += a * (fwhm[matched] - self._fwhm[t])
+                self._last[t]  = frameNo
+                self._hits[t] += 1
+
+        new = ~matched
+        count = int(new.sum())
+        if count:
+                ids = np.arange(self._nextId, self._nextId + count)
+                self._nextId += count
+                slot[new] = len(self._ids) + np.arange(count)
+                self._ids      = np.concatenate((self._ids, ids))
+                self._position = np.concatenate((self._position, position[new]))
+                self._height   = np.concatenate((self._height, height[new]))
+                self._fwhm     = np.concatenate((self._fwhm, fwhm[new]))
+                self._first    = np.concatenate((self._first, np.full(count, frameNo, dtype = np.int64)))
+                self._last     = np.concatenate((self._last, np.full(count, frameNo, dtype = np.int64)))
+                self._hits     = np.concatenate((self._hits, np.ones(count, dtype = np.int64)))
+        res = self._ids[slot]
+
+        alive = (frameNo - self._last) <= self.maxMissed
+        if not alive.all():
+                self._ids, self._position, self._height = self._ids[alive], self._position[alive], self._height[alive]
+                self._fwhm, self._first, self._last     = self._fwhm[alive], self._first[alive], self._last[alive]
+                self._hits = self._hits[alive]
+        return res
+
+    @property
+    def tracks(self):
+        """The active tracks as dict of arrays: id, position, height, fwhm,
+        firstFrame, lastFrame and hits."""
+        return {'id'         : self._ids.copy(),
+                'position'   : self._position.copy(),
+                'height'     : self._height.copy(),
+                'fwhm'       : self._fwhm.copy(),
+                'firstFrame' : self._first.copy(),
+                'lastFrame'  : self._last.copy(),
+                'hits'       : self._hits.copy()}
+
+    def reset(self):
+        """Forget all tracks (the frame counter continues)."""
+        self._ids = self._ids[:0]
+        self._position, self._height, self._fwhm = self._position[:0], self._height[:0], self._fwhm[:0]
+        self._first, self._last, self._hits = self._first[:0], self._last[:0], self._hits[:0]
@@ -0,0 +1,390 @@
+#!/usr/bin/env python -w
+# -*- coding: UTF-8 -*-
+
+# Fan-out of live frames to other processes through shared memory (needs
+# python 3.8 or newer).
+#
+# The process owning the USB4000 runs a FramePublisher, which writes every
+# frame into a ring in a multiprocessing.shared_memory block. Any number of
+# FrameConsumers in other processes attach to the block by name and read the
+# frames from there, without a lock and without pickling anything:
+#
+#   publisher = FramePublisher(name = "usb4000")
+#   publisher.start(spec)
+#
+#   consumer = FrameConsumer("usb4000")        # in another process
+#   frame = consumer.get(timeout = 1.0)
+#
+# Every slot carries a version number (a seqlock): it is odd while the
+# publisher writes the slot and 2 * sequence + 2 once the frame with that
+# sequence number is complete. A reader checks the version before and after
+# reading, so a frame that was overwritten while it was read is detected
+# instead of returned. The publisher never waits for a consumer; a consumer
+# that falls more than capacity frames behind skips the lost frames. Every
+# consumer keeps its position in a table in the block, which is how the
+# publisher knows how far behind each one is.
+
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+import numpy as np
+
+try:
+        import fcntl
+except ImportError:
+        fcntl = None
+
+from OceanOptics import FRAME_DTYPE, PIXEL_COUNT_USB4000
+
+MAGIC = 0x4f4f5348524d3031      # "OOSHRM01"
+
+# header fields (int64)
+_MAGIC, _CAPACITY, _PIXELS, _CONSUMERS, _WRITTEN = range(5)
+_HEADER_FIELDS = 8
+# consumer table fields (int64): pid of the owner (0: free), next sequence
+# number to read, frames skipped, torn reads
+_OWNER, _POSITION, _SKIPPED, _TORN = range(4)
+_CONSUMER_FIELDS = 4
+
+
+class SharedFrame(namedtuple('SharedFrame', 'sequence timestamp integrationTime counts')):
+    """One frame read from the shared ring. counts is a view into the shared
+    memory unless it was copied (see FrameConsumer.get)."""
+    __slots__ = ()
+
+
+def _layout(capacity, pixels, consumers):
+    # offsets of the arrays in the block, everything 8 byte aligned
+    header   = 0
+    table    = header + _HEADER_FIELDS * 8
+    versions = table + consumers * _CONSUMER_FIELDS * 8
+    meta     = versions + capacity * 8
+    counts   = meta + capacity * 3 * 8
+    size     = counts + ((capacity * pixels * FRAME_DTYPE.itemsize + 7) // 8) * 8
+    return table, versions, meta, counts, size
+
+
+class _SharedRing:
+    # numpy views on a shared memory block laid out by _layout
+
+    def _map(self, capacity, pixels, consumers):
+        buf = self._shm.buf
+        table, versions, meta, counts, size = _layout(capacity, pixels, consumers)
+        self.capacity  = capacity
+        self.pixels    = pixels
+        self._header   = np.ndarray((_HEADER_FIELDS,), np.int64, buf, 0)
+        self._table    = np.ndarray((consumers, _CONSUMER_FIELDS), np.int64, buf, table)
+        self._versions = np.ndarray((capacity,), np.int64, buf, versions)
+        # sequence, timestamp and integration time of every slot
+        self._meta     = np.ndarray((capacity, 3), np.float64, buf, meta)
+        self._counts   = np.ndarray((capacity, pixels), FRAME_DTYPE, buf, counts)
+
+    def _unmap(self):
+        # the views have to go before the block can be closed
+        self._header = self._table = self._versions = self._meta = self._counts = None
+        self._shm.close()
+
+    @property
+    def written(self):
+        """Amount of frames published so far."""
+        return int(self._header[_WRITTEN])
+
+
+class FramePublisher(_SharedRing):
+    """Writes frames into a shared memory ring of capacity frames.
+
+    name is the name of the block (a random one if None, see self.name);
+    up to maxConsumers FrameConsumers can be attached at the same time.
+    """
+
+    def __init__(self, name = None, capacity = 64, pixels = PIXEL_COUNT_USB4000, maxConsumers = 8):
+        size = _layout(capacity, pixels, maxConsumers)[-1]
+        self._shm = shared_memory.SharedMemory(name = name, create = True, size = size)
+        self.name = self._shm.name
+        self._map(capacity, pixels, maxConsumers)
+        self._table[...] = 0
+        self._versions[...] = 0
+        self._header[...] = 0
+        self._header[_CAPACITY]  = capacity
+        self._header[_PIXELS]    = pixels
+        self._header[_CONSUMERS] = maxConsumers
+        # written last: a consumer only attaches to a complete header
+        self._header[_MAGIC] = MAGIC
+
+        self._thread = None
+        self._stop   = threading.Event()
+        #: acquisitions that failed on the USB side (see start)
+        self.errors  = 0
+
+    def publish(self, counts, timestamp = None, integrationTime = 0):
+        """Copy counts into the next slot; returns its sequence number."""
+        if timestamp == None:
+                timestamp = time.time()
+        seq  = int(self._header[_WRITTEN])
+        slot = seq % self.capacity
+        self._versions[slot] = 2 * seq + 1
+        self._counts[slot] = counts
+        self._meta[slot] = (seq, timestamp, integrationTime)
+        self._versions[slot] = 2 * seq + 2
+        self._header[_WRITTEN] = seq + 1
+        return seq
+
+    def consumers(self):
+        """Position of every attached consumer: a list of dicts with the
+        consumer slot, its pid, the next sequence number it will read, its
+        lag (frames published but not read yet, more than capacity means
+        frames will be skipped), the frames it skipped and its torn reads."""
+        written = self.written
+        res = []
+        for index, (owner, position, skipped, torn) in enumerate(self._table.tolist()):
+                if owner == 0:
+                        continue
+                res.append({'consumer' : index,
+                            'pid'      : owner,
+                            'position' : position,
+                            'lag'      : max(written - position, 0),
+                            'skipped'  : skipped,
+                            'torn'     : torn})
+        return res
+
+    def start(self, spec):
+        """Publish the frames of a USB4000 from a background thread until
+        stop() is called."""
+        if self._thread != None:
+                raise RuntimeError("publisher is already running")
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._publishLoop, args = (spec,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout = None):
+        if self._thread == None:
+                return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _publishLoop(self, spec):
+        while not self._stop.is_set():
+                try:
+                        frame = spec.getFrame(copy = False)
+                except IOError:
+                        self.errors += 1
+                        continue
+                if frame == None:
+                        break
+                self.publish(frame.counts, time.time(), spec.integrationTime or 0)
+
+    def close(self):
+        """Stop publishing and remove the block (attached consumers keep
+        their mapping until they close)."""
+        self.stop()
+        self._unmap()
+        self._shm.unlink()
+        # nobody can attach any more, so the lock file can go as well
+        _TableLock(self.name).remove()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _TableLock:
+    # Claiming a consumer slot is the only read-modify-write on the block, it
+    # is serialized with a lock file next to it (where fcntl is available).
+
+    def __init__(self, name):
+        self.path = os.path.join(tempfile.gettempdir(), "%s.consumers.lock" % (name.lstrip("/")))
+        self._fd  = None
+
+    def __enter__(self):
+        if fcntl != None:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if self._fd != None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+                os.close(self._fd)
+                self._fd = None
+
+    def remove(self):
+        # the file only exists once a consumer attached
+        try:
+                os.unlink(self.path)
+        except OSError:
+                pass
+
+
+def _processAlive(pid):
+    try:
+            os.kill(pid, 0)
+    except ProcessLookupError:
+            return False
+    except OSError:
+            pass
+    return True
+
+
+def _attach(name):
+    # Attaching must not register the block with the resource tracker, which
+    # would unlink it when the consumer ends (the default before python 3.13).
+    try:
+            return shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:
+            pass
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    def skipSharedMemory(name, rtype):
+            if rtype != "shared_memory":
+                    register(name, rtype)
+    resource_tracker.register = skipSharedMemory
+    try:
+            return shared_memory.SharedMemory(name = name)
+    finally:
+            resource_tracker.register = register
+
+
+class FrameConsumer(_SharedRing):
+    """Reads the frames of a FramePublisher, attached by the name of its block.
+
+    With start = 'latest' the first frame handed out is the next one
+    published, with 'oldest' it is the oldest one still in the ring.
+    pollInterval (seconds) is how often get() looks for a new frame while
+    waiting.
+    """
+
+    def __init__(self, name, start = 'latest', pollInterval = 0.0005):
+        self._shm = _attach(name)
+        self.name = name
+        self.pollInterval = pollInterval
+        header = np.ndarray((_HEADER_FIELDS,), np.int64, self._shm.buf, 0)
+        if header[_MAGIC] != MAGIC:
+                del header
+                self._shm.close()
+                raise ValueError("%s is not a frame ring" % (name))
+        capacity, pixels, consumers = int(header[_CAPACITY]), int(header[_PIXELS]), int(header[_CONSUMERS])
+        del header
+        self._map(capacity, pixels, consumers)
+        self._buffer = np.empty(pixels, dtype = FRAME_DTYPE)
+
+        self.index = self._claim()
+        self._entry = self._table[self.index]
+        written = self.written
+        self._entry[_POSITION] = written if start == 'latest' else max(written - capacity, 0)
+
+    def _claim(self):
+        with _TableLock(self.name):
+                pid = os.getpid()
+                for index in range(len(self._table)):
+                        owner = int(self._table[index, _OWNER])
+                        # slots of consumers that died without closing are reused
+                        if owner == 0 or (owner != pid and not _processAlive(owner)):
+                                self._table[index] = (pid, 0, 0, 0)
+                                return index
+        self._unmap()
+        raise RuntimeError("all %d consumer slots of %s are taken" % (len(self._table), self.name))
+
+    @property
+    def position(self):
+        """Sequence number of the next frame get() returns."""
+        return int(self._entry[_POSITION])
+
+    @property
+    def lag(self):
+        """Frames published but not read yet."""
+        return max(self.written - self.position, 0)
+
+    @property
+    def skipped(self):
+        return int(self._entry[_SKIPPED])
+
+    @property
+    def torn(self):
+        return int(self._entry[_TORN])
+
+    def get(self, timeout = None, copy = True):
+        """Next frame as SharedFrame, None if none arrived within timeout
+        seconds (wait forever if None).
+
+        With copy the counts are copied out of the ring and checked, the
+        returned counts are reused by the next get() call then (copy them to
+        keep them). Without copy they are a view into the ring that stays
+        valid until the publisher wraps around; check it with valid(frame)
+        after using it.
+        """
+        deadline = None if timeout == None else time.time() + timeout
+        while True:
+                seq = self.position
+                written = self.written
+                if seq >= written:
+                        if deadline != None and time.time() >= deadline:
+                                return None
+                        time.sleep(self.pollInterval)
+                        continue
+                if written - seq > self.capacity:
+                        # overwritten already: continue with the oldest frame left
+                        self._skip(written - self.capacity - seq)
+                        continue
+                if self._versions[seq % self.capacity] != 2 * seq + 2:
+                        # the publisher got there first
+                        self._skip(1)
+                        continue
+                frame = self._read(seq, copy)
+                if frame == None:
+                        # overwritten while we were reading it
+                        self._entry[_TORN] += 1
+                        self._skip(1)
+                        continue
+                self._entry[_POSITION] = seq + 1
+                return frame
+
+    def latest(self, copy = True):
+        """The newest complete frame (None if there is none yet); frames
+        before it are skipped."""
+        written = self.written
+        if written == 0:
+                return None
+        if written - 1 > self.position:
+                self._skip(written - 1 - self.position)
+        return self.get(0, copy)
+
+    def valid(self, frame):
+        """True if the slot of frame still holds it (the counts of a view
+        have not been overwritten)."""
+        return self._versions[frame.sequence % self.capacity] == 2 * frame.sequence + 2
+
+    def _skip(self, n):
+        self._entry[_SKIPPED] += n
+        self._entry[_POSITION] += n
+
+    def _read(self, seq, copy):
+        slot = seq % self.capacity
+        version = 2 * seq + 2
+        counts = self._counts[slot]
+        if copy:
+                self._buffer[...] = counts
+                counts = self._buffer
+        sequence, timestamp, integrationTime = self._meta[slot].tolist()
+        if self._versions[slot] != version:
+                return None
+        return SharedFrame(seq, timestamp, int(integrationTime), counts)
+
+    def close(self):
+        """Detach from the ring and free the consumer slot."""
+        self._entry[_OWNER] = 0
+        self._entry = None
+        self._buffer = None
+        self._unmap()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
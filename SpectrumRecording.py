@@ -0,0 +1,393 @@
+#!/usr/bin/env python -w
+# -*- coding: UTF-8 -*-
+
+# Append-only recording of raw USB4000 frames and offline replay.
+#
+# A recording consists of two files:
+# - <path>      a HEADER_SIZE byte header (magic + json with the calibration
+#               coefficients, pixel offset, serial number, ...) followed by
+#               the frames: raw little-endian uint16 counts, or zlib compressed
+#               blocks of blockFrames frames
+# - <path>.idx  one fixed width INDEX_DTYPE record per frame: timestamp,
+#               sequence number, integration time, serial number and where
+#               the frame is stored
+#
+# Uncompressed recordings are read through numpy.memmap, so indexing and
+# slicing (also by time range) does not copy anything. SpectrumReplay plays a
+# recording back through the USB4000 interface.
+#
+#   rec = SpectrumRecorder.forSpectrometer("run1.spec", spec)
+#   for i in range(1000):
+#           rec.appendFrame(spec.getFrame(copy = False), integrationTime = spec.integrationTime)
+#   rec.close()
+#
+#   replay = SpectrumReplay("run1.spec")
+#   counts = replay.getSpectrum()
+
+import json
+import os
+import time
+import zlib
+import numpy as np
+
+from OceanOptics import USB4000, Calibration, decodeFrame, frameLayout, FRAME_DTYPE, PIXEL_COUNT_USB4000
+
+MAGIC       = b"OOSPEC01"
+HEADER_SIZE = 4096
+INDEX_DTYPE = np.dtype([('timestamp',       '<f8'),
+                        ('sequence',        '<i8'),
+                        ('integrationTime', '<u4'),
+                        ('serialNumber',    'S16'),
+                        ('offset',          '<u8'),   # byte offset of the frame (or its block)
+                        ('size',            '<u4'),   # bytes of the frame (or compressed block)
+                        ('slot',            '<u4')])  # position of the frame in its block
+
+
+def _shuffle(frames):
+    # low bytes of all pixels, then the high bytes: compresses much better
+    return np.ascontiguousarray(frames.view(np.uint8).reshape(-1, 2).T)
+
+
+def _unshuffle(data, frames, pixels):
+    planes = np.frombuffer(data, dtype = np.uint8).reshape(2, -1)
+    return np.ascontiguousarray(planes.T).view(FRAME_DTYPE).reshape(frames, pixels)
+
+
+class SpectrumRecorder:
+    """Append frames to a recording (created if it does not exist).
+
+    compression is None or 'zlib'; compressed frames are collected into
+    blocks of blockFrames frames before they are written.
+    """
+
+    def __init__(self, path, coefficients = (0.0, 1.0, 0.0, 0.0, 0.0, 0.0), pixelOffset = 0,
+                 serialNumber = "", sensorName = "", pixels = PIXEL_COUNT_USB4000,
+                 compression = None, blockFrames = 64, level = 6):
+        self.path = path
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE:
+                self.header = _readHeader(path)
+                if self.header['pixels'] != pixels:
+                        raise ValueError("%s holds frames of %d pixels" % (path, self.header['pixels']))
+                _truncateUnindexed(path, self.header)
+        else:
+                if compression not in (None, 'zlib'):
+                        raise ValueError("Unknown compression %r" % (compression,))
+                self.header = {'version'      : 1,
+                               'pixels'       : pixels,
+                               'coefficients' : [float(c) for c in coefficients],
+                               'pixelOffset'  : pixelOffset,
+                               'serialNumber' : serialNumber,
+                               'sensorName'   : sensorName,
+                               'compression'  : compression,
+                               'blockFrames'  : blockFrames}
+                _writeHeader(path, self.header)
+        self.pixels      = self.header['pixels']
+        self.compression = self.header['compression']
+        self.blockFrames = self.header['blockFrames']
+        self.level       = level
+        self.serialNumber = self.header['serialNumber']
+
+        self._frames = open(path, "ab")
+        self._index  = open(path + ".idx", "ab")
+        self._offset = os.path.getsize(path)
+        self._frameBytes = self.pixels * FRAME_DTYPE.itemsize
+        self._record = np.zeros(1, dtype = INDEX_DTYPE)
+        self._nextSequence = os.path.getsize(path + ".idx") // INDEX_DTYPE.itemsize
+        # compressed frames wait here until their block is full
+        self._block       = np.zeros((self.blockFrames, self.pixels), dtype = FRAME_DTYPE)
+        self._blockIndex  = np.zeros(self.blockFrames, dtype = INDEX_DTYPE)
+        self._blockFill   = 0
+
+    @classmethod
+    def forSpectrometer(cls, path, spec, **kwargs):
+        """Recorder using the calibration and serial number of a USB4000."""
+        return cls(path, spec.calibration.coefficients, spec.pixelOffset,
+                   spec.getSerialNumber() or "", spec.getSensorName() or "", **kwargs)
+
+    def append(self, counts, timestamp = None, sequence = None, integrationTime = 0, serialNumber = None):
+        """Append one frame (uint16 counts)."""
+        if timestamp == None:
+                timestamp = time.time()
+        if sequence == None:
+                sequence = self._nextSequence
+        self._nextSequence = sequence + 1
+        rec = self._record[0]
+        rec['timestamp']       = timestamp
+        rec['sequence']        = sequence
+        rec['integrationTime'] = integrationTime or 0
+        rec['serialNumber']    = (serialNumber if serialNumber != None else self.serialNumber).encode('ascii')
+        counts = np.ascontiguousarray(counts, dtype = FRAME_DTYPE)
+        if self.compression == None:
+                rec['offset'] = self._offset
+                rec['size']   = self._frameBytes
+                rec['slot']   = 0
+                self._frames.write(counts.data)
+                self._offset += self._frameBytes
+                self._index.write(self._record.data)
+        else:
+                self._block[self._blockFill]      = counts
+                self._blockIndex[self._blockFill] = rec
+                self._blockFill += 1
+                if self._blockFill == self.blockFrames:
+                        self._writeBlock()
+
+    def appendFrame(self, frame, timestamp = None, sequence = None, integrationTime = 0):
+        """Append a SpectrumFrame or StreamedFrame."""
+        if sequence == None:
+                sequence = getattr(frame, 'sequence', None)
+        if timestamp == None:
+                timestamp = getattr(frame, 'timestamp', None)
+        self.append(frame.counts, timestamp, sequence, integrationTime)
+
+    def appendBatch(self, counts, timestamps, sequence = None, integrationTime = 0):
+        """Append a (frames x pixels) batch, e.g. from USB4000.getLatestFrames."""
+        for i in range(len(counts)):
+                self.append(counts[i], timestamps[i], None if sequence is None else int(sequence[i]), integrationTime)
+
+    def _writeBlock(self):
+        n = self._blockFill
+        data = zlib.compress(_shuffle(self._block[:n]).data, self.level)
+        index = self._blockIndex[:n]
+        index['offset'] = self._offset
+        index['size']   = len(data)
+        index['slot']   = np.arange(n)
+        self._frames.write(data)
+        self._offset += len(data)
+        self._index.write(index.data)
+        self._blockFill = 0
+
+    def flush(self):
+        """Write pending data. A partial compressed block becomes a short block."""
+        if self._blockFill:
+                self._writeBlock()
+        self._frames.flush()
+        self._index.flush()
+
+    def close(self):
+        self.flush()
+        self._frames.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _writeHeader(path, header):
+    data = MAGIC + json.dumps(header).encode('ascii')
+    if len(data) > HEADER_SIZE:
+            raise ValueError("Header too long")
+    with open(path, "wb") as f:
+            f.write(data + b" " * (HEADER_SIZE - len(data)))
+
+
+def _truncateUnindexed(path, header):
+    # A crash may have left frames (or a compressed block) without index
+    # records, or a partial record. Both files are cut back to the frames
+    # the index covers completely, so appended frames go where their
+    # records point to and uncompressed frames stay back to back.
+    indexPath = path + ".idx"
+    n = os.path.getsize(indexPath) // INDEX_DTYPE.itemsize if os.path.exists(indexPath) else 0
+    dataSize = os.path.getsize(path)
+    if header['compression'] == None:
+            frameBytes = header['pixels'] * FRAME_DTYPE.itemsize
+            n = min(n, (dataSize - HEADER_SIZE) // frameBytes)
+            end = HEADER_SIZE + n * frameBytes
+    elif n:
+            index = np.memmap(indexPath, dtype = INDEX_DTYPE, mode = 'r', shape = (n,))
+            ends = index['offset'] + index['size']
+            # blocks are written in order, keep the records of complete ones
+            n = int(np.count_nonzero(ends <= dataSize))
+            end = int(ends[n - 1]) if n else HEADER_SIZE
+            del index, ends
+    else:
+            end = HEADER_SIZE
+    for name, size in ((path, end), (indexPath, n * INDEX_DTYPE.itemsize)):
+            if os.path.exists(name) and os.path.getsize(name) > size:
+                    with open(name, "r+b") as f:
+                            f.truncate(size)
+
+
+def _readHeader(path):
+    with open(path, "rb") as f:
+            data = f.read(HEADER_SIZE)
+    if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is no spectrum recording" % (path))
+    return json.loads(data[len(MAGIC):].decode('ascii'))
+
+
+class SpectrumRecording:
+    """Read access to a recording.
+
+    rec[i] and rec[a:b] give the counts of frames (views into the memory map
+    for uncompressed recordings), the index columns are available as
+    timestamps, sequence, integrationTime and serialNumbers.
+    """
+
+    def __init__(self, path):
+        self.path   = path
+        self.header = _readHeader(path)
+        self.pixels = self.header['pixels']
+        self.compression = self.header['compression']
+        self.calibration = Calibration(self.header['coefficients'], self.header['pixelOffset'], self.pixels)
+
+        indexPath = path + ".idx"
+        n = os.path.getsize(indexPath) // INDEX_DTYPE.itemsize if os.path.exists(indexPath) else 0
+        frameBytes = self.pixels * FRAME_DTYPE.itemsize
+        if self.compression == None:
+                # a crash may have left a frame without index or the other way round
+                n = min(n, (os.path.getsize(path) - HEADER_SIZE) // frameBytes)
+        if n:
+                self.index = np.memmap(indexPath, dtype = INDEX_DTYPE, mode = 'r', shape = (n,))
+        else:
+                self.index = np.zeros(0, dtype = INDEX_DTYPE)
+        self._counts = None
+        if self.compression == None and n:
+                self._counts = np.memmap(path, dtype = FRAME_DTYPE, mode = 'r', offset = HEADER_SIZE, shape = (n, self.pixels))
+        self._cachedBlock = (None, None)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def timestamps(self):
+        return self.index['timestamp']
+
+    @property
+    def sequence(self):
+        return self.index['sequence']
+
+    @property
+    def integrationTime(self):
+        return self.index['integrationTime']
+
+    @property
+    def serialNumbers(self):
+        return self.index['serialNumber']
+
+    @property
+    def counts(self):
+        """All frames as (frames x pixels); a memory map unless compressed."""
+        if self._counts is not None:
+                return self._counts
+        return self[0:len(self)]
+
+    def __getitem__(self, key):
+        if self._counts is not None:
+                return self._counts[key]
+        if isinstance(key, slice):
+                rows = range(*key.indices(len(self)))
+                out = np.empty((len(rows), self.pixels), dtype = FRAME_DTYPE)
+                for i, row in enumerate(rows):
+                        out[i] = self._frame(row)
+                return out
+        if key < 0:
+                key += len(self)
+        return self._frame(key)
+
+    def _frame(self, i):
+        rec = self.index[i]
+        offset, size = int(rec['offset']), int(rec['size'])
+        if self._cachedBlock[0] != offset:
+                with open(self.path, "rb") as f:
+                        f.seek(offset)
+                        data = zlib.decompress(f.read(size))
+                frames = len(data) // (self.pixels * FRAME_DTYPE.itemsize)
+                self._cachedBlock = (offset, _unshuffle(data, frames, self.pixels))
+        return self._cachedBlock[1][int(rec['slot'])]
+
+    def timeRange(self, start = None, stop = None):
+        """Slice of the frames recorded in [start, stop) (timestamps in s).
+
+        Returns (counts, index); both are views for uncompressed recordings.
+        Assumes the frames were recorded in time order.
+        """
+        ts = self.timestamps
+        a = 0 if start == None else int(np.searchsorted(ts, start, 'left'))
+        b = len(ts) if stop == None else int(np.searchsorted(ts, stop, 'left'))
+        return self[a:b], self.index[a:b]
+
+
+class SpectrumReplay(USB4000):
+    """A recording that behaves like a USB4000.
+
+    getSpectrum, getFrame, streaming, corrections etc. deliver the recorded
+    frames one after the other as fast as they can be read. With realtime
+    the original frame spacing is kept, with loop the recording starts over
+    at its end; otherwise getFrame returns None when it is exhausted.
+    """
+
+    def __init__(self, path, realtime = False, loop = False):
+        self._initState()
+        self.recording     = path if isinstance(path, SpectrumRecording) else SpectrumRecording(path)
+        self.realtime      = realtime
+        self.loop          = loop
+        self.position      = 0
+        self.usedInterface = 'replay'
+        self.transport     = 'replay'
+        self.specs         = {}
+        self.deviceName    = self.recording.path
+        self.basePath      = None
+        self.serialNumber  = self.recording.header['serialNumber']
+        self.sensorName    = self.recording.header['sensorName']
+        self.pixelOffset   = self.recording.header['pixelOffset']
+        self.deviceInfo    = {'coefficients' : self.recording.header['coefficients'],
+                              'sensorName'   : self.sensorName}
+        (self.startWavelength, self.firstKoeff, self.secondKoeff,
+         self.thirdKoeff, self.fourthKoeff, self.fifthKoeff) = self.recording.header['coefficients']
+        self.calibration   = self.recording.calibration
+        self.wlArr         = self.calibration.wavelengths
+        self.integrationTime = int(self.recording.integrationTime[0]) if len(self.recording) else None
+        self._lastReplayed = None
+
+    def findAllConnectedSpectrometers(self):
+        return {self.serialNumber : ('replay', None, "%.0f" % (self.startWavelength))}
+
+    def setIntegrationTime(self, intTime, test = True, force = False):
+        # the recording decides, remember the wish anyway
+        self.integrationTime = intTime
+        return True
+
+    def getIntegrationTime(self):
+        if self._lastReplayed == None:
+                return self.integrationTime
+        return int(self.recording.integrationTime[self._lastReplayed])
+
+    def getNonlinearityCoefficients(self):
+        return None
+
+    def getPixelLayout(self, timeout = None):
+        # from the first recorded frame, without using one up
+        if self._pixelLayout == None:
+                if not len(self.recording):
+                        raise ValueError("no frame to take the pixel layout from")
+                self._pixelLayout = frameLayout(self.recording[0])
+        return self._pixelLayout
+
+    def getFrame(self, timeout = None, copy = True):
+        startT = self._requestFrame()
+        return self._readFrame(startT, timeout, copy)
+
+    def _requestFrame(self):
+        return time.time()
+
+    def _readFrame(self, startT, timeout, copy = True):
+        if self.position >= len(self.recording):
+                if not self.loop or not len(self.recording):
+                        return None
+                self.position = 0
+        i = self.position
+        if self.realtime and i > 0 and self._lastReplayed != None:
+                delay = self.recording.timestamps[i] - self.recording.timestamps[i - 1]
+                wait = self._replayedAt + delay - time.time()
+                if wait > 0:
+                        time.sleep(wait)
+        self._replayedAt   = time.time()
+        self._lastReplayed = i
+        self.position += 1
+        return decodeFrame(self.recording[i], copy)
+
+    def seek(self, position):
+        self.position = position
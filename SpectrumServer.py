@@ -0,0 +1,429 @@
+#!/usr/bin/env python -w
+# -*- coding: UTF-8 -*-
+
+# Serving spectra over TCP.
+#
+# SpectrumServer acquires from a USB4000 (or gets frames through publish())
+# and sends them to every connected SpectrumClient in a binary format:
+#
+# - on connect the server sends HELLO_HEADER followed by a json document with
+#   the serial number, calibration coefficients, pixel offset and pixel count
+# - the client subscribes to a pixel range (SUBSCRIBE_HEADER) and gets frames
+#   from then on; it may change the subscription at any time
+# - every message holds a batch of frames: BATCH_HEADER, then one
+#   FRAME_HEADER_DTYPE record (sequence number, timestamp, integration time)
+#   per frame, then the counts (frames x pixelCount, little-endian uint16) of
+#   the subscribed pixel range
+#
+# The frames are kept once in a ring on the server. Every client has its own
+# sender thread and position in the ring: when it falls behind, the frames
+# waiting for it go out in one batch (up to its maxBatch), and when it falls
+# more than the ring behind, the lost frames are skipped for that client only.
+# Neither the acquisition nor the other clients ever wait for a slow client.
+#
+#   server = SpectrumServer(spec, port = 7700)
+#   server.start()
+#
+#   client = SpectrumClient("spectrometer-host", 7700, wavelengthRange = (400, 700))
+#   batch = client.receive()
+#   batch.counts          # frames x pixels, uint16
+
+import json
+import select
+import socket
+import struct
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+
+from OceanOptics import Calibration, FRAME_DTYPE, PIXEL_COUNT_USB4000
+
+#: magic, length of the json document
+HELLO_HEADER     = struct.Struct("<4sI")
+#: magic, first pixel, pixel count, max frames per batch
+SUBSCRIBE_HEADER = struct.Struct("<4sHHH")
+#: magic, frames, first pixel, pixel count
+BATCH_HEADER     = struct.Struct("<4sHHH")
+FRAME_HEADER_DTYPE = np.dtype([('sequence',        '<i8'),
+                               ('timestamp',       '<f8'),
+                               ('integrationTime', '<u4'),
+                               ('reserved',        '<u4')])
+
+HELLO_MAGIC     = b"OOSH"
+SUBSCRIBE_MAGIC = b"OOSQ"
+BATCH_MAGIC     = b"OOSB"
+
+# offset of the message in the send buffer of a client, see _Client
+_MESSAGE_START = -BATCH_HEADER.size % 8
+
+
+class SpectrumBatch(namedtuple('SpectrumBatch', 'sequence timestamps integrationTimes firstPixel counts')):
+    """Frames received in one message: per frame arrays of the sequence
+    numbers, timestamps and integration times, the frame index of the first
+    pixel and the counts (frames x pixels)."""
+    __slots__ = ()
+
+    def __len__(self):
+        return len(self.sequence)
+
+
+def _clampRange(first, count, pixels):
+    # the pixel range the server serves for a subscription
+    first = min(first, pixels - 1)
+    return first, max(1, min(count, pixels - first))
+
+
+def _recvInto(sock, view):
+    # fill the whole memoryview, False if the connection was closed
+    got = 0
+    while got < len(view):
+            n = sock.recv_into(view[got:])
+            if not n:
+                    return False
+            got += n
+    return True
+
+
+class _Client:
+    # state of one connection on the server
+
+    def __init__(self, sock, address, pixels, maxBatch, position):
+        self.sock       = sock
+        self.address    = address
+        self.firstPixel = 0
+        self.pixelCount = pixels
+        self.maxBatch   = maxBatch
+        self.position   = position
+        self.sent       = 0
+        self.batches    = 0
+        self.skipped    = 0
+        self.closed     = False
+        # the message is assembled in place, the batch header starts at
+        # _MESSAGE_START so that the frame headers behind it are aligned
+        self.buffer     = bytearray(_MESSAGE_START + BATCH_HEADER.size
+                                    + maxBatch * (FRAME_HEADER_DTYPE.itemsize + pixels * FRAME_DTYPE.itemsize))
+
+    def batch(self, n, first, count):
+        # (headers, counts, message): views on the buffer for a batch of n
+        # frames of count pixels, message is what goes on the wire
+        BATCH_HEADER.pack_into(self.buffer, _MESSAGE_START, BATCH_MAGIC, n, first, count)
+        offset  = _MESSAGE_START + BATCH_HEADER.size
+        headers = np.frombuffer(self.buffer, FRAME_HEADER_DTYPE, n, offset)
+        offset += headers.nbytes
+        counts  = np.frombuffer(self.buffer, FRAME_DTYPE, n * count, offset).reshape(n, count)
+        offset += counts.nbytes
+        return headers, counts, memoryview(self.buffer)[_MESSAGE_START:offset]
+
+
+class SpectrumServer:
+    """Streams the frames of a USB4000 to any number of SpectrumClients.
+
+    spec may be None, then frames are only sent when they are given to
+    publish(). With acquire False the server does not acquire from spec
+    either, spec then only supplies the serial number and calibration sent
+    to the clients. capacity is the size of the frame ring, i.e. how far a client
+    may fall behind before it skips frames; maxBatch limits the frames per
+    message (clients can ask for less).
+    """
+
+    def __init__(self, spec = None, host = "127.0.0.1", port = 0, capacity = 256, maxBatch = 64,
+                 pixels = PIXEL_COUNT_USB4000, info = None, acquire = True):
+        self.spec     = spec
+        self.acquire  = acquire
+        self.capacity = capacity
+        self.maxBatch = maxBatch
+        self.pixels   = pixels
+        if info == None:
+                info = {'pixels' : pixels}
+                if spec != None:
+                        info.update(serialNumber = spec.serialNumber, sensorName = spec.sensorName,
+                                    coefficients = list(spec.calibration.coefficients),
+                                    pixelOffset = spec.pixelOffset)
+        self.info = info
+
+        self.frames  = np.zeros((capacity, pixels), dtype = FRAME_DTYPE)
+        self.headers = np.zeros(capacity, dtype = FRAME_HEADER_DTYPE)
+        self._written = 0
+        self._cond    = threading.Condition()
+        self._clients = []
+        self._stop    = threading.Event()
+        self._threads = []
+        #: acquisitions that failed on the USB side
+        self.errors   = 0
+
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(8)
+        self.address = self._listener.getsockname()
+
+    def start(self):
+        """Accept clients and, with a spectrometer to acquire from, start acquiring."""
+        self._stop.clear()
+        self._spawn(self._acceptLoop)
+        if self.spec != None and self.acquire:
+                self._spawn(self._acquireLoop)
+
+    def _spawn(self, target, *args):
+        t = threading.Thread(target = target, args = args)
+        t.daemon = True
+        with self._cond:
+                self._threads = [other for other in self._threads if other.is_alive()]
+                self._threads.append(t)
+        t.start()
+
+    def publish(self, counts, timestamp = None, integrationTime = 0):
+        """Put one frame into the ring for all clients; returns its sequence number."""
+        if timestamp == None:
+                timestamp = time.time()
+        with self._cond:
+                seq  = self._written
+                slot = seq % self.capacity
+                self.frames[slot] = counts
+                self.headers[slot] = (seq, timestamp, integrationTime, 0)
+                self._written += 1
+                self._cond.notify_all()
+        return seq
+
+    def clients(self):
+        """Every connected client: address, subscribed pixel range, how many
+        frames it is behind (lag), frames and batches sent and frames skipped."""
+        with self._cond:
+                return [{'address'    : client.address,
+                         'firstPixel' : client.firstPixel,
+                         'pixelCount' : client.pixelCount,
+                         'lag'        : self._written - client.position,
+                         'sent'       : client.sent,
+                         'batches'    : client.batches,
+                         'skipped'    : client.skipped}
+                        for client in self._clients]
+
+    def _acquireLoop(self):
+        while not self._stop.is_set():
+                try:
+                        frame = self.spec.getFrame(copy = False)
+                except IOError:
+                        self.errors += 1
+                        continue
+                if frame == None:
+                        break
+                self.publish(frame.counts, time.time(), self.spec.integrationTime or 0)
+
+    def _acceptLoop(self):
+        while not self._stop.is_set():
+                try:
+                        sock, address = self._listener.accept()
+                except (socket.error, OSError):
+                        break
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                info = json.dumps(self.info).encode('utf-8')
+                try:
+                        sock.sendall(HELLO_HEADER.pack(HELLO_MAGIC, len(info)) + info)
+                except (socket.error, OSError):
+                        sock.close()
+                        continue
+                with self._cond:
+                        client = _Client(sock, address, self.pixels, self.maxBatch, self._written)
+                        self._clients.append(client)
+                self._spawn(self._receiveLoop, client)
+
+    def _receiveLoop(self, client):
+        # subscriptions from the client, sending starts with the first one
+        buf  = bytearray(SUBSCRIBE_HEADER.size)
+        sending = False
+        view = memoryview(buf)
+        try:
+                while _recvInto(client.sock, view):
+                        magic, first, count, maxBatch = SUBSCRIBE_HEADER.unpack(bytes(buf))
+                        if magic != SUBSCRIBE_MAGIC:
+                                break
+                        first, count = _clampRange(first, count, self.pixels)
+                        with self._cond:
+                                client.firstPixel = first
+                                client.pixelCount = count
+                                client.maxBatch   = max(1, min(maxBatch, self.maxBatch))
+                        if not sending:
+                                self._spawn(self._sendLoop, client)
+                                sending = True
+        except (socket.error, OSError):
+                pass
+        self._drop(client)
+
+    def _sendLoop(self, client):
+        try:
+                while True:
+                        message = self._nextBatch(client)
+                        if message == None:
+                                break
+                        client.sock.sendall(message)
+        except (socket.error, OSError):
+                pass
+        self._drop(client)
+
+    def _nextBatch(self, client):
+        # waits for frames and copies up to maxBatch of them out of the ring
+        # into the send buffer of the client, returns the message in there
+        with self._cond:
+                while client.position >= self._written and not client.closed and not self._stop.is_set():
+                        self._cond.wait(0.5)
+                if client.closed or self._stop.is_set():
+                        return None
+                behind = self._written - client.position
+                if behind > self.capacity:
+                        client.skipped  += behind - self.capacity
+                        client.position += behind - self.capacity
+                n = min(self._written - client.position, client.maxBatch)
+                first, count = client.firstPixel, client.pixelCount
+                slots = np.arange(client.position, client.position + n) % self.capacity
+                headers, counts, message = client.batch(n, first, count)
+                np.take(self.headers, slots, out = headers)
+                counts[...] = self.frames[slots, first:first + count]
+                client.position += n
+                client.sent     += n
+                client.batches  += 1
+        return message
+
+    def _drop(self, client):
+        with self._cond:
+                if client.closed:
+                        return
+                client.closed = True
+                if client in self._clients:
+                        self._clients.remove(client)
+                self._cond.notify_all()
+        try:
+                client.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+                pass
+        client.sock.close()
+
+    def close(self):
+        """Disconnect all clients and stop serving."""
+        self._stop.set()
+        try:
+                self._listener.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+                pass
+        self._listener.close()
+        with self._cond:
+                clients = list(self._clients)
+                self._cond.notify_all()
+        for client in clients:
+                self._drop(client)
+        with self._cond:
+                threads, self._threads = self._threads, []
+        for t in threads:
+                t.join(2.0)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SpectrumClient:
+    """Receives the frames of a SpectrumServer.
+
+    Subscribes to wavelengthRange (min, max in nm, needs the calibration the
+    server sends) or to pixelCount pixels from firstPixel on, all pixels if
+    neither is given. maxBatch is the most frames the server puts into one
+    message.
+
+    firstPixel and pixelCount are the range the server serves: the
+    subscription clamped to its pixels, and after receive() the range of the
+    batch received last.
+    """
+
+    def __init__(self, host, port, wavelengthRange = None, firstPixel = 0, pixelCount = None,
+                 maxBatch = 64, timeout = None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        header = bytearray(HELLO_HEADER.size)
+        if not _recvInto(self.sock, memoryview(header)):
+                raise IOError("Connection closed by the server")
+        magic, length = HELLO_HEADER.unpack(bytes(header))
+        if magic != HELLO_MAGIC:
+                raise IOError("%s:%s is not a spectrum server" % (host, port))
+        info = bytearray(length)
+        if not _recvInto(self.sock, memoryview(info)):
+                raise IOError("Connection closed by the server")
+        self.info   = json.loads(bytes(info).decode('utf-8'))
+        self.pixels = self.info['pixels']
+        self.calibration = None
+        if 'coefficients' in self.info:
+                self.calibration = Calibration(self.info['coefficients'], self.info.get('pixelOffset', 0), self.pixels)
+        self._header = bytearray(BATCH_HEADER.size)
+        self.subscribe(wavelengthRange, firstPixel, pixelCount, maxBatch)
+
+    def subscribe(self, wavelengthRange = None, firstPixel = 0, pixelCount = None, maxBatch = 64):
+        """Change the subscription (see the constructor); batches already on
+        the way still have the old pixel range."""
+        if wavelengthRange != None:
+                if self.calibration == None:
+                        raise ValueError("The server sent no calibration, subscribe to pixels instead")
+                low, high = sorted(wavelengthRange)
+                wavelengths = self.calibration.wavelengths
+                if high < wavelengths.min() or low > wavelengths.max():
+                        raise ValueError("Wavelength range %g - %g nm is outside the calibration (%.1f - %.1f nm)"
+                                         % (low, high, wavelengths.min(), wavelengths.max()))
+                first, last = self.calibration.pixelOf([low, high])
+                firstPixel = 0 if np.isnan(first) else int(np.ceil(first))
+                last       = self.pixels - 1 if np.isnan(last) else int(np.floor(last))
+                pixelCount = max(last - firstPixel + 1, 1)
+        if pixelCount == None:
+                pixelCount = self.pixels - firstPixel
+        # what the server will send, see SpectrumServer._receiveLoop
+        firstPixel, pixelCount = _clampRange(max(firstPixel, 0), pixelCount, self.pixels)
+        self.firstPixel = firstPixel
+        self.pixelCount = pixelCount
+        self.sock.sendall(SUBSCRIBE_HEADER.pack(SUBSCRIBE_MAGIC, firstPixel, pixelCount, maxBatch))
+
+    @property
+    def wavelengths(self):
+        """Wavelengths of the subscribed pixels (None without calibration)."""
+        if self.calibration == None:
+                return None
+        return self.calibration.wavelengths[self.firstPixel:self.firstPixel + self.pixelCount]
+
+    def receive(self, timeout = None):
+        """Next SpectrumBatch; None if nothing arrived within timeout seconds
+        or the server closed the connection. The data is received straight
+        into the arrays of the batch."""
+        # the timeout only applies to the start of a message, a message
+        # is always read completely
+        if timeout != None and not select.select([self.sock], [], [], timeout)[0]:
+                return None
+        if not _recvInto(self.sock, memoryview(self._header)):
+                return None
+        magic, n, first, count = BATCH_HEADER.unpack(bytes(self._header))
+        if magic != BATCH_MAGIC:
+                raise IOError("Invalid batch header")
+        self.firstPixel = first
+        self.pixelCount = count
+        headers = np.empty(n, dtype = FRAME_HEADER_DTYPE)
+        counts  = np.empty((n, count), dtype = FRAME_DTYPE)
+        for arr in (headers, counts):
+                if not _recvInto(self.sock, memoryview(arr.view(np.uint8).reshape(-1))):
+                        return None
+        return SpectrumBatch(headers['sequence'], headers['timestamp'], headers['integrationTime'], first, counts)
+
+    def __iter__(self):
+        # batch after batch until the server closes the connection
+        while True:
+                batch = self.receive()
+                if batch == None:
+                        return
+                yield batch
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python -w
+# -*- coding: UTF-8 -*-
+
+# Per pixel statistics over frame streams.
+#
+# FrameStatistics is updated with single frames or (frames x pixels) batches
+# and keeps the mean, variance, minimum, maximum and saturation count of
+# every pixel in arrays of constant size, however many frames go in. The
+# noise of the electrically dark (masked) pixels and the signal to noise
+# ratio of the active ones are derived from them; for raw frames both are
+# found through the frame header (see OceanOptics.frameLayout).
+#
+#   stats = FrameStatistics()
+#   spec.startStreaming()
+#   for frame in spec.iterFrames(timeout = 1.0):
+#           stats.update(frame.counts)
+#   print(stats.summary())
+#
+# Cumulative statistics of several workers or devices can be merged:
+#
+#   total = FrameStatistics().merge(statsA).merge(statsB)
+
+import numpy as np
+
+from OceanOptics import FRAME_DTYPE, PIXEL_COUNT_USB4000, frameLayout
+
+#: modes of FrameStatistics
+MODES = ('cumulative', 'exponential', 'windowed')
+
+
+class FrameStatistics:
+    """Running per pixel statistics of raw (or corrected) frames.
+
+    mode selects which frames count:
+
+    - 'cumulative': all frames since the last reset, updated with Welford's
+      algorithm (batches are combined with the pairwise formula, so the
+      statistics of two accumulators can be merged as well)
+    - 'exponential': exponentially weighted mean and variance with weight
+      alpha for the newest frame, to follow drifts; minimum, maximum and
+      saturation count still cover all frames since the last reset
+    - 'windowed': the last window frames, which are kept in a ring of
+      window x pixels of dtype
+
+    Pixels at or above saturationLevel are counted as saturated.
+    darkPixels are the masked pixels the dark level and noise are taken from,
+    signalPixels the ones summary() reports the signal to noise ratio of.
+    If not given, they are read from the header of the first frame, which
+    only raw frames have (pass them for corrected spectra).
+    """
+
+    def __init__(self, pixels = PIXEL_COUNT_USB4000, mode = 'cumulative', alpha = 0.05, window = 100,
+                 saturationLevel = 65535, darkPixels = None, signalPixels = None, dtype = FRAME_DTYPE):
+        if mode not in MODES:
+                raise ValueError("Unknown mode %r, use one of %s" % (mode, ", ".join(MODES)))
+        self.pixels          = pixels
+        self.mode            = mode
+        self.alpha           = alpha
+        self.window          = window
+        self.saturationLevel = saturationLevel
+        self.darkPixels      = darkPixels
+        self.signalPixels    = signalPixels
+
+        self.mean      = np.zeros(pixels)
+        self._m2       = np.zeros(pixels)     # sum of squared deviations (exponential: the variance)
+        self._minimum  = np.zeros(pixels)
+        self._maximum  = np.zeros(pixels)
+        self._saturated = np.zeros(pixels, dtype = np.int64)
+        self._delta    = np.zeros(pixels)
+        self._tmp      = np.zeros(pixels)
+        self._mask     = np.zeros(pixels, dtype = bool)
+        self._ring     = np.zeros((window, pixels), dtype = dtype) if mode == 'windowed' else None
+        self.reset()
+
+    def reset(self):
+        #: frames the statistics are taken over
+        self.count = 0
+        #: frames given to update since the last reset
+        self.frames = 0
+        self.mean[...]       = 0
+        self._m2[...]        = 0
+        self._minimum[...]   = np.inf
+        self._maximum[...]   = -np.inf
+        self._saturated[...] = 0
+
+    def update(self, frames):
+        """Add a frame or a (frames x pixels) batch; returns self."""
+        frames = np.asarray(frames)
+        if frames.ndim == 1:
+                frames = frames[np.newaxis]
+        if frames.shape[1] != self.pixels:
+                raise ValueError("Expected frames of %d pixels, got %d" % (self.pixels, frames.shape[1]))
+        if not len(frames):
+                return self
+        if self.darkPixels == None or self.signalPixels == None:
+                darkPixels, window = frameLayout(frames[0])
+                if self.darkPixels == None:
+                        self.darkPixels = darkPixels
+                if self.signalPixels == None:
+                        self.signalPixels = window
+        if self.mode == 'cumulative' and len(frames) > 1:
+                n = len(frames)
+                mean = frames.mean(axis = 0)
+                self._combine(n, mean, frames.var(axis = 0) * n)
+                self._extremes(frames.min(axis = 0), frames.max(axis = 0))
+                self._saturated += (frames >= self.saturationLevel).sum(axis = 0)
+                self.frames += n
+                return self
+        for frame in frames:
+                if self.mode == 'exponential':
+                        self._addExponential(frame)
+                elif self.mode == 'windowed':
+                        self._addWindowed(frame)
+                else:
+                        self._add(frame)
+                if self.mode != 'windowed':
+                        self._extremes(frame, frame)
+                        np.greater_equal(frame, self.saturationLevel, out = self._mask)
+                        self._saturated += self._mask
+                self.frames += 1
+        return self
+
+    def _add(self, frame):
+        # Welford: mean += d / n, m2 += d * (x - new mean)
+        delta, tmp = self._delta, self._tmp
+        self.count += 1
+        np.subtract(frame, self.mean, out = delta)
+        np.divide(delta, self.count, out = tmp)
+        self.mean += tmp
+        np.subtract(frame, self.mean, out = tmp)
+        tmp *= delta
+        self._m2 += tmp
+
+    def _remove(self, frame):
+        # Welford backwards, count > 1
+        delta, tmp = self._delta, self._tmp
+        self.count -= 1
+        np.subtract(frame, self.mean, out = delta)
+        np.divide(delta, self.count, out = tmp)
+        self.mean -= tmp
+        np.subtract(frame, self.mean, out = tmp)
+        tmp *= delta
+        self._m2 -= tmp
+
+    def _addExponential(self, frame):
+        # mean += a * d, var = (1 - a) * (var + a * d^2)
+        delta = self._delta
+        self.count += 1
+        if self.count == 1:
+                self.mean[...] = frame
+                return
+        np.subtract(frame, self.mean, out = delta)
+        self.mean += self.alpha * delta
+        delta *= delta
+        delta *= self.alpha
+        self._m2 += delta
+        self._m2 *= 1.0 - self.alpha
+
+    def _addWindowed(self, frame):
+        slot = self.frames % self.window
+        if self.count == self.window:
+                old = self._ring[slot]
+                if self.count > 1:
+                        self._remove(old)
+                else:
+                        self.count = 0
+                        self.mean[...] = 0
+                        self._m2[...] = 0
+                np.greater_equal(old, self.saturationLevel, out = self._mask)
+                self._saturated -= self._mask
+        self._ring[slot] = frame
+        self._add(frame)
+        np.greater_equal(frame, self.saturationLevel, out = self._mask)
+        self._saturated += self._mask
+
+    def _combine(self, n, mean, m2):
+        # pairwise update (Chan et al.) with n frames of the given mean and m2
+        total = self.count + n
+        delta = mean - self.mean
+        self._m2 += m2 + delta * delta * (self.count * float(n) / total)
+        self.mean += delta * (float(n) / total)
+        self.count = total
+
+    def _extremes(self, minimum, maximum):
+        np.minimum(self._minimum, minimum, out = self._minimum)
+        np.maximum(self._maximum, maximum, out = self._maximum)
+
+    def merge(self, other):
+        """Add the frames of another cumulative FrameStatistics (e.g. of a
+        parallel worker or another device); returns self."""
+        if self.mode != 'cumulative' or other.mode != 'cumulative':
+                raise ValueError("Only cumulative statistics can be merged")
+        if other.pixels != self.pixels:
+                raise ValueError("Cannot merge statistics of %d and %d pixels" % (self.pixels, other.pixels))
+        if self.darkPixels == None:
+                self.darkPixels = other.darkPixels
+        if self.signalPixels == None:
+                self.signalPixels = other.signalPixels
+        if other.count:
+                self._combine(other.count, other.mean, other._m2)
+                self._extremes(other._minimum, other._maximum)
+                self._saturated += other._saturated
+                self.frames += other.frames
+        return self
+
+    @property
+    def variance(self):
+        # sample variance per pixel (exponential: the weighted variance)
+        if self.mode == 'exponential':
+                return self._m2.copy()
+        if self.count < 2:
+                return np.zeros(self.pixels)
+        return np.maximum(self._m2, 0) / (self.count - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def minimum(self):
+        if self.mode == 'windowed':
+                return self._ring[:self.count].min(axis = 0)
+        return self._minimum.copy()
+
+    @property
+    def maximum(self):
+        if self.mode == 'windowed':
+                return self._ring[:self.count].max(axis = 0)
+        return self._maximum.copy()
+
+    @property
+    def saturated(self):
+        # frames in which each pixel was saturated
+        return self._saturated.copy()
+
+    @property
+    def darkLevel(self):
+        # mean of the masked pixels (NaN before the first frame)
+        if self.darkPixels == None:
+                return float('nan')
+        return float(self.mean[self.darkPixels].mean())
+
+    @property
+    def darkNoise(self):
+        # rms frame to frame noise of the masked pixels
+        if self.darkPixels == None:
+                return float('nan')
+        return float(np.sqrt(self.variance[self.darkPixels].mean()))
+
+    @property
+    def snr(self):
+        # dark corrected mean over the noise of every pixel
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                return (self.mean - self.darkLevel) / self.std
+
+    def summary(self):
+        """Scalar figures for live monitoring as a plain dict."""
+        signal = self.signalPixels if self.signalPixels != None else slice(None)
+        snr = self.snr[signal]
+        snr = snr[np.isfinite(snr)]
+        return {'frames'          : self.frames,
+                'count'           : self.count,
+                'darkLevel'       : self.darkLevel,
+                'darkNoise'       : self.darkNoise,
+                'medianSnr'       : float(np.median(snr)) if len(snr) else float('nan'),
+                'maxSnr'          : float(snr.max()) if len(snr) else float('nan'),
+                'saturatedPixels' : int(np.count_nonzero(self._saturated[signal]))}
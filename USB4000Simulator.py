@@ -0,0 +1,318 @@
+#!/usr/bin/env python -w
+# -*- coding: UTF-8 -*-
+
+# Software emulation of an Ocean Optics USB4000 as seen through pyusb.
+#
+# The simulated device speaks the part of the USB4000 protocol used in
+# OceanOptics.py:
+# - 0x01 INITIALIZE
+# - 0x02 set integration time (4 bytes, little endian, usec)
+# - 0x05 query information (EEPROM slot in the second byte: serial number,
+#        wavelength and nonlinearity coefficients)
+# - 0x09 request spectrum (4 packets on ep6, 11 packets and a sync byte on ep2)
+# - 0xfe query status (integration time in bytes 2..5)
+#
+# It mimics the pyusb object tree (device -> configuration -> interface ->
+# endpoints) closely enough for usb.util.find_descriptor and
+# usb.control.get_interface, so USB4000 runs its normal pyusb code path on it.
+# The 'sim' transport uses the endpoints directly and works without pyusb:
+#
+#   spec = USB4000(devices = [SimulatedUSB4000()])
+#   spec = USB4000(transport = 'sim')
+
+import array
+import threading
+import time
+import numpy as np
+
+from OceanOptics import PIXEL_COUNT_USB4000, USB4000_PACKET_SIZE, USB4000_EP6_PACKETS, FRAME_DTYPE, \
+                        DEVICE_CACHE_DIR, TransferError, PyusbTransport, DeviceInfoCache
+
+#: the sync byte that terminates every frame
+SYNC_BYTE = 0x69
+#: header words of a simulated frame (see USB4000.getSpectrum): status,
+#: counter, active pixels, start index, end index, pixel count. The active
+#: pixels are centered in the pixels from the start index on, the masked
+#: ones around them only see the dark level.
+STATUS_READY  = 2
+START_INDEX   = 6
+PIXEL_COUNT   = PIXEL_COUNT_USB4000 - START_INDEX
+ACTIVE_PIXELS = PIXEL_COUNT - 26
+SPECTRUM_START = START_INDEX + (PIXEL_COUNT - ACTIVE_PIXELS) // 2
+#: pyusb's default timeout in ms
+DEFAULT_TIMEOUT = 1000
+
+
+class SimulatedEndpoint:
+    """Endpoint with the write/read interface of usb.core.Endpoint."""
+
+    def __init__(self, device, address):
+        self.device           = device
+        self.bEndpointAddress = address
+        self._data            = bytearray()
+        self._offset          = 0
+        self._readyAt         = 0.0
+
+    def write(self, data, timeout = None):
+        if isinstance(data, type(u'')):
+                data = data.encode('latin-1')
+        data = bytearray(data)
+        self.device._transfer()
+        self.device._command(data)
+        return len(data)
+
+    def read(self, size_or_buffer, timeout = None):
+        if timeout == None:
+                timeout = DEFAULT_TIMEOUT
+        self.device._transfer()
+        # wait for the data like a bulk transfer would
+        wait = self._readyAt - time.time()
+        if self._offset >= len(self._data) or wait > timeout / 1000.0:
+                time.sleep(timeout / 1000.0)
+                raise TransferError("Operation timed out")
+        if wait > 0:
+                time.sleep(wait)
+
+        available = len(self._data) - self._offset
+        if isinstance(size_or_buffer, array.array):
+                n = min(len(size_or_buffer), available)
+                try:
+                        memoryview(size_or_buffer)[:n] = memoryview(self._data)[self._offset:self._offset + n]
+                except TypeError:
+                        # python 2 arrays do not export the new buffer interface
+                        size_or_buffer[:n] = array.array('B', bytes(bytearray(self._data[self._offset:self._offset + n])))
+                self._offset += n
+                return n
+        n = min(size_or_buffer, available)
+        res = array.array('B', bytes(bytearray(self._data[self._offset:self._offset + n])))
+        self._offset += n
+        return res
+
+    def _push(self, data, readyAt = 0.0):
+        self._data     = data
+        self._offset   = 0
+        self._readyAt  = readyAt
+
+
+class SimulatedInterface:
+    bInterfaceNumber  = 0
+    bAlternateSetting = 0
+
+    def __init__(self, endpoints):
+        self._endpoints = endpoints
+
+    def __getitem__(self, index):
+        return self._endpoints[index]
+
+    def __iter__(self):
+        return iter(self._endpoints)
+
+
+class SimulatedConfiguration:
+    bConfigurationValue = 1
+
+    def __init__(self, interface):
+        self._interface = interface
+
+    def __getitem__(self, index):
+        # pyusb indexes interfaces by (number, alternate setting)
+        return self._interface
+
+    def __iter__(self):
+        return iter([self._interface])
+
+
+class SimulatedUSB4000:
+    """A USB4000 living in software.
+
+    The spectrum is a sum of gaussian emission lines on a weak continuum. The
+    counts scale with the integration time, sit on a dark level and carry
+    shot noise; they saturate at 65535. The nonlinearity coefficients are only
+    served from the EEPROM, the counts stay linear. latency (seconds) is added
+    to every transfer, initDelay is how long the device stays busy after
+    INITIALIZE.
+    """
+
+    #: USB4000 uses this transport for a list of these devices
+    transport = 'sim'
+
+    def __init__(self, serialNumber = "USB4SIM01", coefficients = (178.5, 0.2196, -1.16e-05, -6.23e-10, 0.0, 0.0),
+                 latency = 0.0, initDelay = 0.05, noise = True, lines = ((435.8, 8.0), (546.1, 20.0), (611.6, 4.0)),
+                 darkLevel = 1500.0, nonlinearity = (0.95, 4.1e-06, -1.3e-10), seed = None):
+        self.serialNumber = serialNumber
+        self.coefficients = tuple(coefficients)
+        self.latency      = latency
+        self.initDelay    = initDelay
+        self.noise        = noise
+        self.darkLevel    = darkLevel
+        self.nonlinearity = tuple(nonlinearity)
+        self.integrationTime = 10000
+        self.framesServed    = 0
+
+        self._lock     = threading.Lock()
+        self._random   = np.random.RandomState(seed)
+        self._readyAt  = 0.0
+        self._lastFrameEnd = 0.0
+        self._cachedFrame  = (None, None)
+
+        # photo electrons per pixel and usec
+        pix = np.arange(PIXEL_COUNT_USB4000, dtype = float)
+        wl  = np.polyval(self.coefficients[::-1], pix)
+        rate = 0.002 * np.ones(PIXEL_COUNT_USB4000)
+        for center, height in lines:
+                rate += height * np.exp(-0.5 * ((wl - center) / 1.2) ** 2)
+        rate[:SPECTRUM_START] = 0.0
+        rate[SPECTRUM_START + ACTIVE_PIXELS:] = 0.0
+        self._rate = rate / 100.0
+        self._header = np.array([STATUS_READY, 0, ACTIVE_PIXELS, START_INDEX,
+                                 START_INDEX + PIXEL_COUNT, PIXEL_COUNT], dtype = FRAME_DTYPE)
+
+        self.ep1Out = SimulatedEndpoint(self, 0x01)
+        self.ep2    = SimulatedEndpoint(self, 0x82)
+        self.ep6    = SimulatedEndpoint(self, 0x86)
+        self.ep1In  = SimulatedEndpoint(self, 0x81)
+        self._configuration = SimulatedConfiguration(SimulatedInterface([self.ep1Out, self.ep2, self.ep6, self.ep1In]))
+
+    def __getstate__(self):
+        # picklable for the processes of a SpectrometerPool
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    # the parts of usb.core.Device that USB4000 touches
+    def __getitem__(self, index):
+        return self._configuration
+
+    def get_active_configuration(self):
+        return self._configuration
+
+    def set_configuration(self, configuration = None):
+        pass
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue = 0, wIndex = 0, data_or_wLength = None, timeout = None):
+        # only GET_INTERFACE is used: alternate setting 0
+        return array.array('B', [0])
+
+    def spectrum(self, integrationTime = None):
+        """Counts (uint16) of one frame at the given integration time,
+        header words included."""
+        if integrationTime == None:
+                integrationTime = self.integrationTime
+        signal = self._rate * integrationTime
+        counts = self.darkLevel + signal
+        if self.noise:
+                counts += self._random.normal(0.0, 1.0, PIXEL_COUNT_USB4000) * np.sqrt(signal + 100.0)
+        counts = np.clip(counts, 0, 65535).astype(FRAME_DTYPE)
+        counts[:len(self._header)] = self._header
+        counts[1] = self.framesServed % 3
+        return counts
+
+    def _frameBytes(self):
+        # raw frame followed by the sync byte; without noise every frame at
+        # one integration time is the same except for the counter
+        if self.noise:
+                return self.spectrum().tobytes() + bytearray([SYNC_BYTE])
+        if self._cachedFrame[0] != self.integrationTime:
+                self._cachedFrame = (self.integrationTime, bytearray(self.spectrum().tobytes()) + bytearray([SYNC_BYTE]))
+        raw = self._cachedFrame[1]
+        raw[2] = self.framesServed % 3
+        return raw
+
+    def _transfer(self):
+        if self.latency:
+                time.sleep(self.latency)
+
+    def _command(self, cmd):
+        now = time.time()
+        with self._lock:
+                if cmd[0] == 0x01:
+                        self.integrationTime = 10000
+                        self._readyAt = now + self.initDelay
+                elif cmd[0] == 0x02:
+                        self.integrationTime = cmd[1] + (cmd[2] << 8) + (cmd[3] << 16) + (cmd[4] << 24)
+                elif cmd[0] == 0x05:
+                        self.ep1In._push(self._info(cmd[1]), self._readyAt)
+                elif cmd[0] == 0x09:
+                        # the integration starts when the previous one has ended
+                        start = max(now, self._lastFrameEnd)
+                        self._lastFrameEnd = start + self.integrationTime / 1000000.0
+                        raw = self._frameBytes()
+                        split = USB4000_PACKET_SIZE * USB4000_EP6_PACKETS
+                        self.ep6._push(memoryview(raw)[:split], self._lastFrameEnd)
+                        self.ep2._push(memoryview(raw)[split:], self._lastFrameEnd)
+                        self.framesServed += 1
+                elif cmd[0] == 0xfe:
+                        status = bytearray(16)
+                        status[0] = PIXEL_COUNT_USB4000 & 0xFF
+                        status[1] = PIXEL_COUNT_USB4000 >> 8
+                        for i in range(4):
+                                status[2 + i] = (self.integrationTime >> (8 * i)) & 0xFF
+                        self.ep1In._push(status, self._readyAt)
+
+    def _info(self, slot):
+        if slot == 0x00:
+                text = self.serialNumber
+        elif 0x01 <= slot <= 0x04:
+                text = repr(self.coefficients[slot - 1])
+        elif 0x06 <= slot <= 0x0d:
+                coeffs = list(self.nonlinearity) + [0.0] * 8
+                text = repr(coeffs[slot - 0x06])
+        elif slot == 0x0e:
+                text = repr(len(self.nonlinearity) - 1)
+        else:
+                text = ""
+        res = bytearray([0x05, slot]) + bytearray(text.encode('ascii'))
+        return res + bytearray(64 - len(res))
+
+
+def simulatedDevices(n, **kwargs):
+    """n simulated spectrometers with distinct serial numbers."""
+    return [SimulatedUSB4000(serialNumber = "USB4SIM%02d" % (i + 1), **kwargs) for i in range(n)]
+
+
+class MemoryDeviceCache(DeviceInfoCache):
+    """DeviceInfoCache that only lives as long as the process."""
+
+    def __init__(self):
+        self.directory = None
+        self._infos    = {}
+
+    def load(self, serialNumber):
+        info = self._infos.get(serialNumber)
+        return dict(info) if info != None else None
+
+    def store(self, serialNumber, info):
+        self._infos[serialNumber] = dict(info, serialNumber = serialNumber)
+
+    def invalidate(self, serialNumber = None):
+        if serialNumber == None:
+                self._infos.clear()
+        else:
+                self._infos.pop(serialNumber, None)
+
+
+#: the cache of simulated devices unless USB4000 got one
+simulatedDeviceCache = MemoryDeviceCache()
+
+
+class SimulatedTransport(PyusbTransport):
+    """The 'sim' transport: the pyusb protocol on SimulatedUSB4000 devices,
+    without pyusb. Without devices one simulated spectrometer is created.
+    The EEPROM data of simulated devices stays out of the on-disk cache of
+    real devices (DEVICE_CACHE_DIR)."""
+
+    name = 'sim'
+
+    def find(self, spec, devices = None):
+        if devices == None:
+                devices = simulatedDevices(1)
+        if spec.deviceCache.directory == DEVICE_CACHE_DIR:
+                spec.deviceCache = simulatedDeviceCache
+        return PyusbTransport.find(self, spec, devices)
+
+    def _endpoints(self, dev):
+        return [dev.ep1Out, dev.ep1In, dev.ep2, dev.ep6]
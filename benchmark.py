@@ -0,0 +1,286 @@
+#!/usr/bin/env python -w
+# -*- coding: UTF-8 -*-
+
+# Throughput and latency benchmarks for OceanOptics.USB4000.
+#
+# All numbers are taken against USB4000Simulator devices, so they can be
+# tracked across releases without a spectrometer attached. Run
+#
+#   python benchmark.py [--frames 500] [--integration-time 1000] [--latency 0] [--json results.json]
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+try:
+        import tracemalloc
+except ImportError:
+        tracemalloc = None
+
+from OceanOptics import USB4000, Calibration, DeviceInfoCache, decodeFrame, frameLayout, PIXEL_COUNT_USB4000, USB4000_PACKET_SIZE, KERNEL_BASE_PATH
+from USB4000Simulator import SimulatedUSB4000, simulatedDevices
+from PeakTracking import PeakFinder, PeakTracker
+from SpectrumServer import SpectrumServer, SpectrumClient
+from SpectrumStatistics import FrameStatistics
+
+
+def legacyDecode(packets):
+    # the per byte loop getSpectrum used before the numpy decoding, kept as reference
+    resArr = np.zeros(256 * 15)
+    resArrIndex = 0
+    for res in packets:
+            for i in range(0,len(res),2):
+                    resArr[resArrIndex] = (res[i+1] << 8) + res[i]
+                    resArrIndex += 1
+    return resArr
+
+
+def _percentiles(times):
+    times = np.asarray(times) * 1e6
+    return {'median_us' : float(np.median(times)),
+            'p99_us'    : float(np.percentile(times, 99)),
+            'max_us'    : float(times.max())}
+
+
+def benchDecode(repeat = 2000):
+    """Time per frame to turn 15 raw packets into counts."""
+    raw = SimulatedUSB4000(seed = 0).spectrum().tobytes()
+    packets = [bytearray(raw[i:i + USB4000_PACKET_SIZE]) for i in range(0, len(raw), USB4000_PACKET_SIZE)]
+    buf = bytearray(raw)
+
+    times = []
+    for i in range(repeat):
+            t0 = time.time()
+            decodeFrame(buf, copy = True)
+            times.append(time.time() - t0)
+    res = {'decode' : _percentiles(times)}
+
+    times = []
+    for i in range(max(1, repeat // 100)):
+            t0 = time.time()
+            legacyDecode(packets)
+            times.append(time.time() - t0)
+    res['legacyDecode'] = _percentiles(times)
+    return res
+
+
+def benchStartup(devices = 4, latency = 0.0):
+    """Constructor time with an empty (cold) and a filled (warm) device cache."""
+    cacheDir = tempfile.mkdtemp()
+    try:
+            devs = simulatedDevices(devices, latency = latency, noise = False)
+            res  = {}
+            for name in ('cold', 'warm'):
+                    t0 = time.time()
+                    USB4000(devices = devs, deviceCache = DeviceInfoCache(cacheDir))
+                    res[name + '_s'] = time.time() - t0
+            res['devices'] = devices
+    finally:
+            shutil.rmtree(cacheDir, True)
+    return res
+
+
+def benchImport(repeat = 5):
+    """Time to import OceanOptics in a fresh interpreter, next to numpy alone."""
+    code = "import time, sys; t0 = time.time(); import %s; sys.stdout.write(repr(time.time() - t0))"
+    here = os.path.dirname(os.path.abspath(__file__))
+    res  = {}
+    for name, modules in (('numpy_s', 'numpy'), ('OceanOptics_s', 'numpy, OceanOptics')):
+            res[name] = min(float(subprocess.check_output([sys.executable, '-c', code % (modules)], cwd = here))
+                            for i in range(repeat))
+    return res
+
+
+def _openSimulated(integrationTime, latency):
+    cacheDir = tempfile.mkdtemp()
+    spec = USB4000(devices = [SimulatedUSB4000(latency = latency, noise = False)], deviceCache = DeviceInfoCache(cacheDir))
+    shutil.rmtree(cacheDir, True)
+    spec.setIntegrationTime(integrationTime)
+    return spec
+
+
+def _measureThroughput(spec, frames, integrationTime, copy):
+    times = []
+    start = time.time()
+    for i in range(frames):
+            t0 = time.time()
+            spec.getSpectrum(copy = copy)
+            times.append(time.time() - t0)
+    elapsed = time.time() - start
+    res = _percentiles(times)
+    res['frames_per_s'] = frames / elapsed
+    res['limit_frames_per_s'] = 1000000.0 / integrationTime
+    return res
+
+
+def benchThroughput(frames = 500, integrationTime = 1000, latency = 0.0, copy = True):
+    """frames/sec and per frame latency of getSpectrum."""
+    return _measureThroughput(_openSimulated(integrationTime, latency), frames, integrationTime, copy)
+
+
+def benchStages(frames = 500, integrationTime = 1000, latency = 0.0):
+    """Mean time per frame of every acquisition stage (see Instrumentation)
+    and the getSpectrum overhead of the instrumentation itself."""
+    spec = _openSimulated(integrationTime, latency)
+    plain = _measureThroughput(spec, frames, integrationTime, False)
+    stats = spec.enableInstrumentation()
+    timed = _measureThroughput(spec, frames, integrationTime, False)
+    res = {}
+    for stage, values in stats.snapshot()['stages'].items():
+            res[stage + '_us'] = values['mean'] * 1e6
+    res['overhead_us'] = timed['median_us'] - plain['median_us']
+    return res
+
+
+def benchBurst(frames = 500, integrationTime = 1000, latency = 0.0):
+    """Achieved rate and jitter of captureBurst next to the getSpectrum rate."""
+    spec = _openSimulated(integrationTime, latency)
+    burst = spec.captureBurst(frames)
+    return {'frames_per_s'             : burst.rate,
+            'jitter_us'                : burst.jitter * 1e6,
+            'getSpectrum_frames_per_s' : _measureThroughput(spec, frames, integrationTime, True)['frames_per_s'],
+            'limit_frames_per_s'       : 1000000.0 / integrationTime}
+
+
+def benchKernel(frames = 500, integrationTime = 1000, copy = True):
+    """Same as benchThroughput on a real device behind the usbhspec driver.
+
+    Empty if the driver is not loaded. Compare with a benchThroughput run on
+    the same device using pyusb (driver unloaded).
+    """
+    if not os.path.exists(KERNEL_BASE_PATH):
+            return {}
+    spec = USB4000()
+    if spec.usedInterface != 'kernel':
+            return {}
+    spec.setIntegrationTime(integrationTime)
+    return _measureThroughput(spec, frames, integrationTime, copy)
+
+
+def benchMemory(frames = 200, integrationTime = 10):
+    """Bytes allocated per getSpectrum call (needs tracemalloc)."""
+    res = {'frame_bytes' : PIXEL_COUNT_USB4000 * 2}
+    if tracemalloc == None or not hasattr(tracemalloc, 'reset_peak'):
+            return res
+    spec = _openSimulated(integrationTime, 0.0)
+    for copy in (True, False):
+            tracemalloc.start()
+            peaks = []
+            for i in range(frames):
+                    before = tracemalloc.get_traced_memory()[0]
+                    tracemalloc.reset_peak()
+                    spec.getSpectrum(copy = copy)
+                    peaks.append(tracemalloc.get_traced_memory()[1] - before)
+            tracemalloc.stop()
+            res['peak_bytes_per_call_copy' if copy else 'peak_bytes_per_call_view'] = float(np.median(peaks))
+    return res
+
+
+def benchPeaks(frames = 2000, integrationTime = 20000):
+    """frames/sec of the batched peak search and of the tracking."""
+    dev = SimulatedUSB4000(seed = 0)
+    batch = np.array([dev.spectrum(integrationTime) for i in range(100)])
+    batch = np.tile(batch, (max(1, frames // len(batch)), 1))
+    finder = PeakFinder(Calibration(dev.coefficients), minProminence = 1000, pixels = frameLayout(batch[0])[1])
+    t0 = time.time()
+    peaks = finder(batch)
+    t1 = time.time()
+    PeakTracker(finder).updatePeaks(peaks, len(batch))
+    t2 = time.time()
+    return {'find_frames_per_s'  : len(batch) / (t1 - t0),
+            'track_frames_per_s' : len(batch) / (t2 - t1),
+            'peaks_per_frame'    : len(peaks) / float(len(batch))}
+
+
+def benchStatistics(frames = 2000, integrationTime = 20000):
+    """frames/sec of FrameStatistics updates, frame by frame and batched."""
+    dev = SimulatedUSB4000(seed = 0)
+    batch = np.array([dev.spectrum(integrationTime) for i in range(100)])
+    batch = np.tile(batch, (max(1, frames // len(batch)), 1))
+    results = {}
+    for mode in ('cumulative', 'exponential', 'windowed'):
+            stats = FrameStatistics(mode = mode)
+            t0 = time.time()
+            for frame in batch:
+                    stats.update(frame)
+            results[mode + '_frames_per_s'] = len(batch) / (time.time() - t0)
+    t0 = time.time()
+    FrameStatistics().update(batch)
+    results['batch_frames_per_s'] = len(batch) / (time.time() - t0)
+    return results
+
+
+def benchServer(frames = 5000):
+    """frames/sec through a SpectrumServer over loopback, all pixels and a
+    100 pixel subscription."""
+    counts = SimulatedUSB4000(seed = 0).spectrum(1000)
+    results = {}
+    for name, pixelCount in (('full', None), ('subrange', 100)):
+            server = SpectrumServer(capacity = frames)
+            server.start()
+            client = SpectrumClient(server.address[0], server.address[1], pixelCount = pixelCount)
+            time.sleep(0.05)
+            t0 = time.time()
+            for i in range(frames):
+                    server.publish(counts)
+            got = batches = 0
+            while got < frames:
+                    batch = client.receive(5.0)
+                    if batch == None:
+                            break
+                    got += len(batch)
+                    batches += 1
+            t1 = time.time()
+            client.close()
+            server.close()
+            results[name + '_frames_per_s']    = got / (t1 - t0)
+            results[name + '_frames_per_batch'] = got / float(max(batches, 1))
+    return results
+
+
+def runBenchmarks(frames = 500, integrationTime = 1000, latency = 0.0, devices = 4):
+    return {'decode'     : benchDecode(),
+            'import'     : benchImport(),
+            'startup'    : benchStartup(devices, latency),
+            'throughput' : benchThroughput(frames, integrationTime, latency),
+            'stages'     : benchStages(frames, integrationTime, latency),
+            'burst'      : benchBurst(frames, integrationTime, latency),
+            'kernel'     : benchKernel(frames, integrationTime),
+            'memory'     : benchMemory(),
+            'peaks'      : benchPeaks(),
+            'statistics' : benchStatistics(),
+            'server'     : benchServer()}
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark OceanOptics.USB4000 against simulated devices")
+    parser.add_argument("--frames", type = int, default = 500)
+    parser.add_argument("--integration-time", type = int, default = 1000, help = "usec")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "simulated USB latency per transfer in s")
+    parser.add_argument("--devices", type = int, default = 4, help = "devices for the startup benchmark")
+    parser.add_argument("--json", help = "write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = runBenchmarks(args.frames, args.integration_time, args.latency, args.devices)
+    for group in sorted(results):
+            for key in sorted(results[group]):
+                    value = results[group][key]
+                    if isinstance(value, dict):
+                            for k in sorted(value):
+                                    print ("%-12s %-24s %12.2f" % (group, key + "." + k, value[k]))
+                    else:
+                            print ("%-12s %-24s %12.2f" % (group, key, value))
+    if args.json:
+            with open(args.json, "w") as f:
+                    json.dump(results, f, indent = 2, sort_keys = True)
+    return results
+
+
+if __name__ == '__main__':
+        main()
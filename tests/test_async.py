@@ -0,0 +1,80 @@
+# -*- coding: UTF-8 -*-
+
+# AsyncUSB4000 against simulated devices (python 3.7 or newer).
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from OceanOptics import USB4000, PIXEL_COUNT_USB4000
+from USB4000Simulator import SimulatedUSB4000, simulatedDevices
+
+try:
+        import asyncio
+        from AsyncUSB4000 import AsyncUSB4000, gatherSpectra
+except (ImportError, SyntaxError):
+        AsyncUSB4000 = None
+
+
+def openSimulated(device, integrationTime):
+    spec = USB4000(devices = [device])
+    spec.setIntegrationTime(integrationTime)
+    return AsyncUSB4000(spec)
+
+
+@unittest.skipIf(AsyncUSB4000 == None, "needs asyncio of python 3.7")
+class AsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def wait(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_gather(self):
+        specs = [openSimulated(device, 2000) for device in simulatedDevices(2, seed = 0, initDelay = 0.0)]
+        spectra = self.wait(gatherSpectra(specs))
+        self.assertEqual([spectrum.shape for spectrum in spectra], [(PIXEL_COUNT_USB4000,)] * 2)
+        for spec in specs:
+                spec.close()
+
+    def test_concurrent_calls(self):
+        spec = openSimulated(SimulatedUSB4000(seed = 0, initDelay = 0.0), 1000)
+        frames = self.wait(asyncio.gather(*[spec.getFrame() for i in range(10)]))
+        self.assertEqual(len([frame for frame in frames if frame != None]), 10)
+        spec.close()
+
+    def test_timeout(self):
+        device = SimulatedUSB4000(seed = 0, initDelay = 0.0)
+        spec = openSimulated(device, 200000)
+        t0 = time.time()
+        self.assertRaises(asyncio.TimeoutError, self.wait, spec.getSpectrum(timeout = 0.05))
+        self.assertLess(time.time() - t0, 0.15)
+        # the frame of the timed out call is not returned by the next one
+        frame = self.wait(spec.getFrame())
+        self.assertEqual(frame.counter, (device.framesServed - 1) % 3)
+        spec.close()
+
+    def test_cancel(self):
+        device = SimulatedUSB4000(seed = 0, initDelay = 0.0)
+        spec = openSimulated(device, 50000)
+        task = self.loop.create_task(spec.getFrame())
+        self.wait(asyncio.sleep(0.01))
+        task.cancel()
+        self.assertRaises(asyncio.CancelledError, self.wait, task)
+        frame = self.wait(spec.getFrame())
+        self.assertEqual(frame.counter, (device.framesServed - 1) % 3)
+        self.assertEqual(device.framesServed, 2)
+        spec.close()
+
+
+if __name__ == '__main__':
+        unittest.main()
@@ -0,0 +1,68 @@
+# -*- coding: UTF-8 -*-
+
+# DetectorCorrection and TransmissionMeasurement against the formulas.
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from OceanOptics import DetectorCorrection, TransmissionMeasurement, PIXEL_COUNT_USB4000
+
+COEFFICIENTS = [1.0, -2e-6, 1e-11]
+
+
+def linearized(counts):
+    return counts / np.polyval(COEFFICIENTS[::-1], counts)
+
+
+def flatFrame(level):
+    return np.full(PIXEL_COUNT_USB4000, level, dtype = np.uint16)
+
+
+class DetectorCorrectionTest(unittest.TestCase):
+
+    def test_dark_before_nonlinearity(self):
+        counts = flatFrame(1500)
+        counts[6:19] = 1000
+        counts[100] = 40000
+        correction = DetectorCorrection(darkPixels = slice(6, 19), nonlinearity = COEFFICIENTS)
+        out = correction(counts, copy = True)
+        self.assertAlmostEqual(out[100] / linearized(39000.0), 1.0, places = 5)
+        self.assertAlmostEqual(out[200] / linearized(500.0), 1.0, places = 5)
+
+    def test_batch(self):
+        counts = np.random.RandomState(0).randint(900, 60000, (4, PIXEL_COUNT_USB4000)).astype(np.uint16)
+        correction = DetectorCorrection(darkPixels = slice(6, 19), nonlinearity = COEFFICIENTS, window = slice(19, 3827))
+        batch = correction(counts, copy = True)
+        for frame, expected in zip(counts, batch):
+                self.assertTrue(np.array_equal(correction(frame), expected))
+
+
+class TransmissionMeasurementTest(unittest.TestCase):
+
+    def test_transmittance(self):
+        measurement = TransmissionMeasurement(window = slice(19, 3827), nonlinearity = COEFFICIENTS)
+        measurement.setDark([flatFrame(1000)] * 2, 1000)
+        measurement.setReference([flatFrame(41000)] * 2, 1000)
+        expected = linearized(20000.0) / linearized(40000.0)
+        transmittance = measurement.transmittance(flatFrame(21000), 1000)
+        self.assertTrue(np.allclose(transmittance, expected, rtol = 1e-5))
+        absorbance = measurement.absorbance(np.array([flatFrame(21000)] * 2), 1000)
+        self.assertTrue(np.allclose(absorbance, -np.log10(expected), rtol = 1e-4))
+
+    def test_saturated_reference(self):
+        measurement = TransmissionMeasurement(window = slice(19, 3827), saturationLevel = 60000)
+        reference = flatFrame(41000)
+        reference[100] = 65535
+        measurement.setDark([flatFrame(1000)], 1000)
+        measurement.setReference([reference], 1000)
+        transmittance = measurement.transmittance(flatFrame(21000), 1000)
+        self.assertTrue(np.isnan(transmittance[100 - 19]))
+        self.assertAlmostEqual(float(transmittance[0]), 0.5, places = 5)
+
+
+if __name__ == '__main__':
+        unittest.main()
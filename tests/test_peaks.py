@@ -0,0 +1,83 @@
+# -*- coding: UTF-8 -*-
+
+# PeakFinder and PeakTracker on synthetic and simulated spectra.
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from OceanOptics import Calibration, frameLayout
+from PeakTracking import PeakFinder, PeakTracker
+from USB4000Simulator import SimulatedUSB4000
+
+PIXELS = 2000
+
+
+def gaussians(centers, sigma = 4.0, height = 5000.0, baseline = 100.0):
+    x = np.arange(PIXELS, dtype = float)
+    spectrum = np.full(PIXELS, baseline)
+    for center in centers:
+            spectrum += height * np.exp(-0.5 * ((x - center) / sigma) ** 2)
+    return spectrum
+
+
+class PeakFinderTest(unittest.TestCase):
+
+    def test_subpixel_position(self):
+        finder = PeakFinder(minProminence = 100)
+        for center in (1000.0, 1000.3, 1000.5, 1000.8):
+                peaks = finder(gaussians([center]))
+                self.assertEqual(len(peaks), 1)
+                self.assertAlmostEqual(float(peaks.pixel[0]), center, delta = 0.01)
+                self.assertAlmostEqual(float(peaks.fwhm[0]), 2.3548 * 4.0, delta = 0.1)
+
+    def test_batch(self):
+        batch = np.array([gaussians([500.2]), gaussians([]), gaussians([700.6, 1200.4])])
+        peaks = PeakFinder(minProminence = 100)(batch)
+        self.assertEqual(list(peaks.frame), [0, 2, 2])
+        self.assertTrue(np.allclose(peaks.pixel, [500.2, 700.6, 1200.4], atol = 0.01))
+
+    def test_simulated_lines(self):
+        dev = SimulatedUSB4000(seed = 0, noise = False)
+        counts = dev.spectrum(50000)
+        finder = PeakFinder(Calibration(dev.coefficients), minProminence = 1000, pixels = frameLayout(counts)[1])
+        peaks = finder(counts)
+        self.assertTrue(np.allclose(peaks.position, [435.8, 546.1, 611.6], atol = 0.02))
+        # sigma of the simulated lines is 1.2 nm
+        self.assertTrue(np.allclose(peaks.fwhm, 2.3548 * 1.2, atol = 0.05))
+
+
+class PeakTrackerTest(unittest.TestCase):
+
+    def test_ids_are_stable(self):
+        tracker = PeakTracker(PeakFinder(minProminence = 100), tolerance = 1.0)
+        batch = np.array([gaussians([500.0 + 0.2 * i, 900.0 - 0.3 * i]) for i in range(5)])
+        peaks = tracker.update(batch)
+        self.assertEqual(list(peaks.frame), [0, 0, 1, 1, 2, 2, 3, 3, 4, 4])
+        self.assertEqual(list(peaks.track), [0, 1] * 5)
+        # the next batch continues the tracks
+        peaks = tracker.update(gaussians([501.1, 898.4]))
+        self.assertEqual(list(peaks.track), [0, 1])
+        self.assertEqual(list(peaks.frame), [5, 5])
+        self.assertEqual(list(tracker.tracks['hits']), [6, 6])
+
+    def test_retired_after_max_missed(self):
+        tracker = PeakTracker(PeakFinder(minProminence = 100), maxMissed = 3)
+        tracker.update(np.array([gaussians([500.0, 900.0])] * 2))
+        # the peak at 900 misses three frames and survives
+        tracker.update(np.array([gaussians([500.0])] * 3))
+        self.assertEqual(list(tracker.tracks['id']), [0, 1])
+        peaks = tracker.update(gaussians([500.0, 900.0]))
+        self.assertEqual(list(peaks.track), [0, 1])
+        # four missed frames retire it, it comes back as a new track
+        tracker.update(np.array([gaussians([500.0])] * 4))
+        self.assertEqual(list(tracker.tracks['id']), [0])
+        peaks = tracker.update(gaussians([500.0, 900.0]))
+        self.assertEqual(list(peaks.track), [0, 2])
+
+
+if __name__ == '__main__':
+        unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: UTF-8 -*-
+
+# Recording, reopening after a crash and reading back.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from SpectrumRecording import SpectrumRecorder, SpectrumRecording, INDEX_DTYPE
+
+PIXELS = 64
+
+
+def frame(value):
+    return np.full(PIXELS, value, dtype = np.uint16)
+
+
+class ReopenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "run.spec")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def record(self, values, **kwargs):
+        with SpectrumRecorder(self.path, pixels = PIXELS, **kwargs) as rec:
+                for value in values:
+                        rec.append(frame(value))
+
+    def crash(self, frameBytes, indexBytes = 0):
+        # what a crash in the middle of an append leaves behind
+        with open(self.path, "ab") as f:
+                f.write(b"\x63" * frameBytes)
+        with open(self.path + ".idx", "ab") as f:
+                f.write(b"\x00" * indexBytes)
+
+    def assertFrames(self, values):
+        rec = SpectrumRecording(self.path)
+        self.assertEqual(len(rec), len(values))
+        self.assertEqual([int(counts[0]) for counts in rec[0:len(rec)]], values)
+        self.assertEqual(list(rec.sequence), list(range(len(values))))
+        for i, value in enumerate(values):
+                self.assertTrue((rec[i] == value).all())
+
+    def test_partial_frame(self):
+        self.record([1, 2, 3])
+        self.crash(PIXELS)
+        self.record([4, 5])
+        self.assertFrames([1, 2, 3, 4, 5])
+
+    def test_frame_without_index(self):
+        self.record([1, 2, 3])
+        self.crash(PIXELS * 2, INDEX_DTYPE.itemsize // 2)
+        self.record([4, 5])
+        self.assertFrames([1, 2, 3, 4, 5])
+
+    def test_compressed_block_without_index(self):
+        self.record([1, 2, 3], compression = 'zlib', blockFrames = 2)
+        self.crash(100, 10)
+        self.record([4, 5, 6], compression = 'zlib', blockFrames = 2)
+        self.assertFrames([1, 2, 3, 4, 5, 6])
+
+    def test_compressed_index_without_block(self):
+        self.record([1, 2], compression = 'zlib', blockFrames = 2)
+        # the last block lost its end
+        with open(self.path, "r+b") as f:
+                f.truncate(os.path.getsize(self.path) - 1)
+        self.record([3], compression = 'zlib', blockFrames = 2)
+        self.assertFrames([3])
+
+
+if __name__ == '__main__':
+        unittest.main()
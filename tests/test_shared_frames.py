@@ -0,0 +1,86 @@
+# -*- coding: UTF-8 -*-
+
+# FramePublisher and FrameConsumer (python 3.8 or newer).
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+try:
+        from SharedFrames import FramePublisher, FrameConsumer
+except ImportError:
+        FramePublisher = None
+
+PIXELS = 32
+
+
+def frame(value):
+    return np.full(PIXELS, value, dtype = np.uint16)
+
+
+def consume(name, frames, results):
+    # runs in another process
+    with FrameConsumer(name, start = 'oldest') as consumer:
+            got = []
+            for i in range(frames):
+                    f = consumer.get(timeout = 5.0)
+                    got.append(None if f == None else (f.sequence, int(f.counts[0]), int(f.counts[-1]), f.integrationTime))
+            results.put((got, consumer.skipped))
+
+
+@unittest.skipIf(FramePublisher == None, "needs multiprocessing.shared_memory of python 3.8")
+class SharedFramesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = FramePublisher(capacity = 8, pixels = PIXELS)
+
+    def tearDown(self):
+        if self.publisher != None:
+                self.publisher.close()
+
+    def test_other_process(self):
+        for i in range(5):
+                self.assertEqual(self.publisher.publish(frame(100 + i), integrationTime = 1000), i)
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target = consume, args = (self.publisher.name, 8, results))
+        process.start()
+        # three more while the consumer reads
+        for i in range(5, 8):
+                self.publisher.publish(frame(100 + i), integrationTime = 1000)
+        got, skipped = results.get(timeout = 10.0)
+        process.join(5.0)
+        self.assertEqual(got, [(i, 100 + i, 100 + i, 1000) for i in range(8)])
+        self.assertEqual(skipped, 0)
+
+    def test_slow_consumer_skips(self):
+        consumer = FrameConsumer(self.publisher.name)
+        for i in range(8 + 3):
+                self.publisher.publish(frame(i))
+        self.assertEqual(self.publisher.consumers()[0]['lag'], 11)
+        first = consumer.get(timeout = 1.0)
+        # the three oldest frames were overwritten
+        self.assertEqual((first.sequence, int(first.counts[0])), (3, 3))
+        self.assertEqual(consumer.skipped, 3)
+        self.assertEqual([consumer.get(timeout = 1.0).sequence for i in range(7)], list(range(4, 11)))
+        self.assertEqual(consumer.get(timeout = 0.01), None)
+        self.assertEqual(consumer.lag, 0)
+        consumer.close()
+
+    def test_close_removes_block_and_lock(self):
+        name = self.publisher.name
+        FrameConsumer(name).close()
+        lock = os.path.join(tempfile.gettempdir(), "%s.consumers.lock" % (name.lstrip("/")))
+        self.assertTrue(os.path.exists(lock))
+        self.publisher.close()
+        self.publisher = None
+        self.assertFalse(os.path.exists(lock))
+        self.assertRaises(OSError, FrameConsumer, name)
+
+
+if __name__ == '__main__':
+        unittest.main()
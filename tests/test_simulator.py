@@ -0,0 +1,310 @@
+# -*- coding: UTF-8 -*-
+
+# Smoke tests of the acquisition paths against USB4000Simulator devices.
+#
+#   python -m pytest tests
+#   python -m unittest discover tests
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import warnings
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import OceanOptics
+from OceanOptics import USB4000, SpectrometerPool, PIXEL_COUNT_USB4000
+from SpectrumRecording import SpectrumRecorder, SpectrumReplay
+from SpectrumServer import SpectrumServer, SpectrumClient
+import USB4000Simulator
+from USB4000Simulator import SimulatedUSB4000, simulatedDevices
+
+
+def openSimulated(integrationTime = 1000, **kwargs):
+    spec = USB4000(devices = [SimulatedUSB4000(seed = 0, initDelay = 0.0, **kwargs)])
+    spec.setIntegrationTime(integrationTime)
+    return spec
+
+
+class GetFrameTest(unittest.TestCase):
+
+    def test_frame(self):
+        spec  = openSimulated()
+        frame = spec.getFrame()
+        self.assertEqual(frame.counts.shape, (PIXEL_COUNT_USB4000,))
+        self.assertEqual(frame.counts.dtype, np.uint16)
+        self.assertEqual(frame.status, USB4000Simulator.STATUS_READY)
+        self.assertEqual(frame.activePixels, USB4000Simulator.ACTIVE_PIXELS)
+        self.assertEqual(frame.spectrumStart, USB4000Simulator.SPECTRUM_START)
+        self.assertEqual(frame.startIndex + frame.pixelCount, frame.endIndex)
+
+    def test_counter(self):
+        spec = openSimulated()
+        counters = [spec.getFrame().counter for i in range(4)]
+        self.assertEqual(counters[1], (counters[0] + 1) % 3)
+        self.assertEqual(counters[3], counters[0])
+
+    def test_signal_scales_with_integration_time(self):
+        spec = openSimulated(noise = False)
+        short = spec.getSpectrum().astype(float)
+        spec.setIntegrationTime(4000)
+        self.assertEqual(spec.getIntegrationTime(), 4000)
+        long = spec.getSpectrum().astype(float)
+        window = slice(USB4000Simulator.SPECTRUM_START, USB4000Simulator.SPECTRUM_START + USB4000Simulator.ACTIVE_PIXELS)
+        self.assertGreater(long[window].max(), short[window].max())
+
+    def test_layout(self):
+        spec = openSimulated()
+        darkPixels, window = spec.getPixelLayout()
+        self.assertEqual(darkPixels, slice(USB4000Simulator.START_INDEX, USB4000Simulator.SPECTRUM_START))
+        self.assertEqual(window.stop - window.start, USB4000Simulator.ACTIVE_PIXELS)
+        correction = spec.enableCorrection()
+        self.assertEqual(correction.darkPixels, darkPixels)
+        self.assertEqual(spec.getSpectrum().shape, (USB4000Simulator.ACTIVE_PIXELS,))
+
+    def test_wavelength_range(self):
+        spec = openSimulated()
+        window = spec.getPixelLayout()[1]
+        wavelengths = spec.calibration.wavelengths
+        whole = spec.enableMeasurement(wavelengthRange = (wavelengths.min() - 100, wavelengths.max() + 100))
+        self.assertEqual(whole.window, window)
+        self.assertRaises(ValueError, spec.enableMeasurement, wavelengthRange = (wavelengths.max() + 10, wavelengths.max() + 20))
+        self.assertRaises(ValueError, spec.enableMeasurement, wavelengthRange = (wavelengths.min() - 20, wavelengths.min() - 10))
+
+    def test_auto_expose_without_integration_time(self):
+        spec = USB4000(devices = [SimulatedUSB4000(seed = 0, initDelay = 0.0)])
+        self.assertEqual(spec.integrationTime, None)
+        result = spec.autoExpose()
+        self.assertEqual(spec.integrationTime, result.integrationTime)
+        self.assertGreater(result.peak, 0)
+
+    def test_layout_without_integration_time(self):
+        spec = USB4000(devices = [SimulatedUSB4000(seed = 0, initDelay = 0.0)])
+        self.assertEqual(spec.getPixelLayout()[0], slice(USB4000Simulator.START_INDEX, USB4000Simulator.SPECTRUM_START))
+
+    def test_view(self):
+        spec = openSimulated()
+        first = spec.getSpectrum(copy = False)
+        second = spec.getSpectrum(copy = False)
+        self.assertTrue(np.shares_memory(first, second))
+
+    def test_cache_stays_in_memory(self):
+        spec = USB4000(transport = 'sim')
+        self.assertIsInstance(spec.deviceCache, USB4000Simulator.MemoryDeviceCache)
+        self.assertEqual(spec.deviceCache.load(spec.serialNumber)['serialNumber'], spec.serialNumber)
+
+
+class StreamingTest(unittest.TestCase):
+
+    def test_stream(self):
+        spec = openSimulated()
+        ring = spec.startStreaming(frames = 8)
+        frames = []
+        for frame in spec.iterFrames(timeout = 2.0):
+                frames.append(frame)
+                if len(frames) == 5:
+                        break
+        spec.stopStreaming(2.0)
+        self.assertFalse(spec.isStreaming())
+        self.assertEqual(len(frames), 5)
+        sequence = [frame.sequence for frame in frames]
+        self.assertEqual(sequence, sorted(sequence))
+        self.assertGreaterEqual(ring.stats()['consumed'], 5)
+        counts, timestamps, seq = spec.getLatestFrames(2)
+        self.assertEqual(counts.shape, (2, PIXEL_COUNT_USB4000))
+
+    def test_stream_needs_integration_time(self):
+        spec = openSimulated()
+        spec.integrationTime = None
+        self.assertRaises(ValueError, spec.startStreaming)
+
+    def test_consumers_return_when_thread_dies(self):
+        spec = openSimulated()
+        def broken(*args, **kwargs):
+                raise RuntimeError("broken")
+        spec.getFrame = broken
+        ring = spec.startStreaming(frames = 4)
+        self.assertEqual(ring.get(5.0), None)
+        spec.stopStreaming(2.0)
+
+
+class BurstTest(unittest.TestCase):
+
+    def test_burst(self):
+        spec  = openSimulated()
+        burst = spec.captureBurst(4, integrationTime = 2000)
+        self.assertEqual(burst.counts.shape, (4, PIXEL_COUNT_USB4000))
+        self.assertEqual(burst.integrationTime, 2000)
+        self.assertGreater(burst.rate, 0)
+        self.assertEqual(burst.frame(0).status, USB4000Simulator.STATUS_READY)
+
+    def test_no_request_left_behind(self):
+        device = SimulatedUSB4000(seed = 0, initDelay = 0.0)
+        spec   = USB4000(devices = [device])
+        spec.setIntegrationTime(1000)
+        served = device.framesServed
+        burst = spec.captureBurst(5)
+        self.assertEqual(device.framesServed - served, 5)
+        self.assertEqual([burst.frame(i).counter for i in range(5)], [(served + i) % 3 for i in range(5)])
+        self.assertTrue((np.diff(burst.requested) > 0).all())
+        self.assertTrue((burst.requested[1:] < burst.completed[:-1]).all())
+        self.assertEqual(spec.getFrame().counter, (served + 5) % 3)
+
+    def test_invalid(self):
+        spec = openSimulated()
+        self.assertRaises(ValueError, spec.captureBurst, 0)
+        self.assertRaises(ValueError, spec.captureBurst, 2, integrationTime = 5)
+        spec.integrationTime = None
+        self.assertRaises(ValueError, spec.captureBurst, 2)
+
+
+class TransportTest(unittest.TestCase):
+
+    def setUp(self):
+        # a loaded driver without findUSBserialDevice
+        self.basePath = OceanOptics.KERNEL_BASE_PATH
+        OceanOptics.KERNEL_BASE_PATH = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.rmdir(OceanOptics.KERNEL_BASE_PATH)
+        OceanOptics.KERNEL_BASE_PATH = self.basePath
+
+    def test_loaded_driver_warns(self):
+        with warnings.catch_warnings(record = True) as caught:
+                warnings.simplefilter("always")
+                spec = USB4000(transport = ['kernel', 'sim'])
+        self.assertEqual(spec.transport, 'sim')
+        self.assertEqual([w.category for w in caught], [RuntimeWarning])
+        self.assertIn("kernel", str(caught[0].message))
+
+    def test_requested_transport_raises(self):
+        self.assertRaises(ImportError, USB4000, transport = 'kernel')
+        self.assertRaises(ImportError, USB4000, transport = ['kernel'])
+
+
+class PoolTest(unittest.TestCase):
+
+    def test_acquire(self):
+        devices = simulatedDevices(2, seed = 0, initDelay = 0.0)
+        with SpectrometerPool(integrationTime = 1000, devices = devices) as pool:
+                self.assertEqual(pool.serialNumbers, ["USB4SIM01", "USB4SIM02"])
+                frames = pool.acquire(timeout = 10.0)
+                self.assertEqual(pool.errors, {})
+                self.assertEqual(frames.counts.shape, (2, PIXEL_COUNT_USB4000))
+                self.assertTrue((frames.counts[:, USB4000Simulator.SPECTRUM_START:] > 0).any(axis = 1).all())
+
+    def test_unknown_serial(self):
+        pool = SpectrometerPool(["USB4SIM09"], devices = simulatedDevices(1, initDelay = 0.0))
+        self.assertFalse(pool.start())
+        pool.close()
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def record(self, spec, frames, **kwargs):
+        path = os.path.join(self.directory, "run.spec")
+        recorded = []
+        with SpectrumRecorder.forSpectrometer(path, spec, **kwargs) as rec:
+                for i in range(frames):
+                        frame = spec.getFrame()
+                        recorded.append(frame.counts)
+                        rec.appendFrame(frame, integrationTime = spec.integrationTime)
+        return path, np.array(recorded)
+
+    def test_replay(self):
+        spec = openSimulated()
+        path, recorded = self.record(spec, 5)
+        replay = SpectrumReplay(path)
+        self.assertEqual(replay.serialNumber, spec.serialNumber)
+        self.assertEqual(replay.getIntegrationTime(), spec.integrationTime)
+        for counts in recorded:
+                self.assertTrue((replay.getSpectrum() == counts).all())
+        self.assertEqual(replay.getFrame(), None)
+
+    def test_compressed_replay(self):
+        spec = openSimulated()
+        path, recorded = self.record(spec, 7, compression = 'zlib', blockFrames = 3)
+        replay = SpectrumReplay(path, loop = True)
+        got = np.array([replay.getSpectrum() for i in range(len(recorded) + 1)])
+        self.assertTrue((got[:-1] == recorded).all())
+        self.assertTrue((got[-1] == recorded[0]).all())
+
+    def test_replay_streams(self):
+        spec = openSimulated()
+        path, recorded = self.record(spec, 3)
+        replay = SpectrumReplay(path)
+        replay.startStreaming(frames = 8)
+        frames = list(replay.iterFrames(timeout = 2.0))
+        replay.stopStreaming(2.0)
+        self.assertEqual(len(frames), 3)
+        self.assertTrue((frames[-1].counts == recorded[-1]).all())
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spec   = openSimulated()
+        # frames are published by hand, the server does not acquire
+        self.server = SpectrumServer(self.spec, capacity = 16, acquire = False)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.close()
+
+    def connect(self, **kwargs):
+        return SpectrumClient(self.server.address[0], self.server.address[1], timeout = 2.0, **kwargs)
+
+    def test_subrange(self):
+        client = self.connect(firstPixel = 100, pixelCount = 50)
+        # frames published before the server took the client on are not sent
+        batch = None
+        while batch == None:
+                self.server.publish(np.zeros(PIXEL_COUNT_USB4000, dtype = np.uint16))
+                batch = client.receive(0.1)
+        self.assertEqual(batch.counts.shape[1], 50)
+        frames = [self.spec.getFrame().counts for i in range(3)]
+        first = self.server.publish(frames[0])
+        for counts in frames[1:]:
+                self.server.publish(counts)
+        got = []
+        while len(got) < len(frames):
+                batch = client.receive(2.0)
+                self.assertNotEqual(batch, None)
+                got.extend(counts for seq, counts in zip(batch.sequence, batch.counts) if seq >= first)
+        self.assertTrue((np.array(got) == np.array(frames)[:, 100:150]).all())
+        client.close()
+
+    def test_clamped_range(self):
+        client = self.connect(firstPixel = PIXEL_COUNT_USB4000 - 40, pixelCount = 100)
+        self.assertEqual((client.firstPixel, client.pixelCount), (PIXEL_COUNT_USB4000 - 40, 40))
+        batch = None
+        while batch == None:
+                self.server.publish(np.arange(PIXEL_COUNT_USB4000, dtype = np.uint16))
+                batch = client.receive(0.1)
+        self.assertEqual((batch.firstPixel, batch.counts.shape[1]), (PIXEL_COUNT_USB4000 - 40, 40))
+        self.assertEqual(int(batch.counts[0, 0]), PIXEL_COUNT_USB4000 - 40)
+        self.assertEqual(len(client.wavelengths), 40)
+        client.subscribe(firstPixel = PIXEL_COUNT_USB4000 + 10, pixelCount = 5)
+        self.assertEqual((client.firstPixel, client.pixelCount), (PIXEL_COUNT_USB4000 - 1, 1))
+        client.close()
+
+    def test_wavelength_range(self):
+        client = self.connect()
+        wavelengths = self.spec.calibration.wavelengths
+        self.assertRaises(ValueError, client.subscribe, wavelengthRange = (wavelengths.max() + 10, wavelengths.max() + 20))
+        client.subscribe(wavelengthRange = ((wavelengths[199] + wavelengths[200]) / 2, (wavelengths[299] + wavelengths[300]) / 2))
+        self.assertEqual((client.firstPixel, client.pixelCount), (200, 100))
+        client.close()
+
+
+if __name__ == '__main__':
+        unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+
+# FrameStatistics against numpy over the same frames.
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from OceanOptics import PIXEL_COUNT_USB4000, frameLayout
+from SpectrumStatistics import FrameStatistics
+from USB4000Simulator import SimulatedUSB4000
+
+FRAMES = 20
+
+
+def simulatedFrames(frames = FRAMES, integrationTime = 20000):
+    dev = SimulatedUSB4000(seed = 0)
+    return np.array([dev.spectrum(integrationTime) for i in range(frames)])
+
+
+class FrameStatisticsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.frames = simulatedFrames()
+
+    def assertMatches(self, stats, frames):
+        darkPixels, window = frameLayout(frames[0])
+        mean = frames.mean(axis = 0)
+        variance = frames.var(axis = 0, ddof = 1)
+        self.assertEqual(stats.count, len(frames))
+        self.assertTrue(np.allclose(stats.mean, mean, rtol = 1e-12, atol = 1e-9))
+        self.assertTrue(np.allclose(stats.variance, variance, rtol = 1e-9, atol = 1e-6))
+        self.assertAlmostEqual(stats.darkLevel, mean[darkPixels].mean(), places = 6)
+        snr = (mean[window] - mean[darkPixels].mean()) / np.sqrt(variance[window])
+        self.assertTrue(np.allclose(stats.snr[window], snr, rtol = 1e-6))
+        self.assertTrue(np.array_equal(stats.minimum, frames.min(axis = 0)))
+        self.assertTrue(np.array_equal(stats.maximum, frames.max(axis = 0)))
+
+    def test_single_frames(self):
+        stats = FrameStatistics()
+        for frame in self.frames:
+                stats.update(frame)
+        self.assertMatches(stats, self.frames)
+        self.assertEqual(stats.signalPixels, frameLayout(self.frames[0])[1])
+
+    def test_batches(self):
+        stats = FrameStatistics()
+        stats.update(self.frames[:7])
+        stats.update(self.frames[7])
+        stats.update(self.frames[8:])
+        self.assertMatches(stats, self.frames)
+        self.assertEqual(stats.frames, FRAMES)
+
+    def test_merge(self):
+        first, second = FrameStatistics(), FrameStatistics()
+        for frame in self.frames[:8]:
+                first.update(frame)
+        second.update(self.frames[8:])
+        total = FrameStatistics().merge(first).merge(second)
+        self.assertMatches(total, self.frames)
+        self.assertEqual(total.darkPixels, first.darkPixels)
+        self.assertRaises(ValueError, total.merge, FrameStatistics(mode = 'windowed', window = 4))
+
+    def test_windowed(self):
+        stats = FrameStatistics(mode = 'windowed', window = 6)
+        stats.update(self.frames[:4])
+        self.assertMatches(stats, self.frames[:4])
+        stats.update(self.frames[4:])
+        self.assertMatches(stats, self.frames[-6:])
+        self.assertEqual(stats.frames, FRAMES)
+
+    def test_corrected_spectra_need_pixels(self):
+        corrected = self.frames.astype(float) - 1500.0
+        self.assertRaises(ValueError, FrameStatistics().update, corrected)
+        # neither does a uint16 frame without a header
+        self.assertRaises(ValueError, FrameStatistics().update, np.zeros(PIXEL_COUNT_USB4000, dtype = np.uint16))
+        self.assertRaises(ValueError, FrameStatistics(darkPixels = slice(6, 19)).update, corrected)
+        darkPixels, window = frameLayout(self.frames[0])
+        stats = FrameStatistics(darkPixels = darkPixels, signalPixels = window)
+        stats.update(corrected)
+        self.assertTrue(np.allclose(stats.mean, self.frames.mean(axis = 0) - 1500.0))
+
+
+if __name__ == '__main__':
+        unittest.main()